@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Archive of raw answers from scan and their offline replay into DB.
+#
+# Scanner with processing.archive option appends every answer passed to
+# parsers to segment files in the archive directory. Segments consist of
+# zlib-compressed blocks of records; each block is listed in the index file
+# (segment name, offset, length, record count) after it's written, so
+# blocks of a crashed scan without index line are ignored.
+#
+# Replay runs the scanner's parsers over the archive and fills the schema
+# from config, without any DNS queries:
+#
+#   ./archive.py [--workers N] archive_dir dns_scraper.config
+
+import os
+import sys
+import time
+import zlib
+import glob
+import struct
+import marshal
+import logging
+import threading
+import multiprocessing
+
+from optparse import OptionParser
+from ConfigParser import SafeConfigParser
+
+
+lengthStruct = struct.Struct("!I")
+
+class ArchivedResult(object):
+	"""Stand-in for ub_result restored from archive, it has attributes of
+	ub_result used by parsers.
+	"""
+
+	fields = ("qname", "qtype", "havedata", "secure", "bogus", "why_bogus",
+		"rcode", "rcode_str", "packet")
+
+	def __init__(self, values):
+		for (field, value) in zip(self.fields, values):
+			setattr(self, field, value)
+
+	@classmethod
+	def values(cls, result):
+		"""Returns tuple of archived attributes of ub_result."""
+		return tuple([getattr(result, field) for field in cls.fields])
+
+
+class ArchiveWriter(object):
+	"""Appends answers to segment files, thread-safe. Every writer (i.e.
+	worker process) has its own segments and index file.
+	"""
+
+	blockRecords = 1000 #records compressed together
+
+	def __init__(self, directory, name, segmentSize=256*1024*1024):
+		"""@param directory: archive directory, created if missing
+		@param name: name of this writer, unique among concurrent writers
+		@param segmentSize: bytes after which new segment is started
+		"""
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				if not os.path.isdir(directory): #other worker may have created it
+					raise
+
+		self.directory = directory
+		self.name = name
+		self.segmentSize = segmentSize
+		#continue numbering after segments of previous (e.g. resumed) scan
+		self.segmentNo = len(glob.glob(os.path.join(directory, "%s-*.seg" % name)))
+		self.segment = None
+		self.segmentName = None
+		self.index = file(os.path.join(directory, "%s.index" % name), "a")
+		self.block = []
+		self.holders = [] #released once the block is written
+		self.records = 0
+		self.lock = threading.Lock()
+
+	def add(self, domain, parserName, result, holder=None):
+		"""Archive answer for domain.
+		@param parserName: class name of parser that got the answer
+		@param result: ub_result
+		@param holder: optional object with acquire()/release() methods
+		(like JournalEntry) held until the answer is written
+		"""
+		record = marshal.dumps((domain, parserName) + ArchivedResult.values(result))
+		if holder is not None:
+			holder.acquire()
+		with self.lock:
+			self.block.append(record)
+			if holder is not None:
+				self.holders.append(holder)
+			if len(self.block) >= self.blockRecords:
+				self.flushBlock()
+
+	def flushBlock(self):
+		"""Compress and write buffered records, caller holds the lock."""
+		if not self.block:
+			return
+
+		data = zlib.compress("".join([lengthStruct.pack(len(record)) + record
+			for record in self.block]))
+
+		if self.segment is None or self.segment.tell() + len(data) > self.segmentSize:
+			if self.segment is not None:
+				self.segment.close()
+			self.segmentName = "%s-%06d.seg" % (self.name, self.segmentNo)
+			self.segmentNo += 1
+			self.segment = file(os.path.join(self.directory, self.segmentName), "ab")
+
+		offset = self.segment.tell()
+		self.segment.write(data)
+		self.segment.flush()
+		self.index.write("%s %d %d %d\n" % (self.segmentName, offset, len(data), len(self.block)))
+		self.index.flush()
+
+		self.records += len(self.block)
+		self.block = []
+		for holder in self.holders:
+			holder.release()
+		self.holders = []
+
+	def close(self):
+		with self.lock:
+			self.flushBlock()
+			if self.segment is not None:
+				self.segment.close()
+			self.index.close()
+		logging.info("Archived %d answers to %s", self.records, self.directory)
+
+
+def readIndex(directory):
+	"""Returns list of (segmentName, offset, length, recordCount) tuples of
+	all blocks in archive. Incomplete index lines are skipped.
+	"""
+	blocks = []
+	for indexFilename in sorted(glob.glob(os.path.join(directory, "*.index"))):
+		for line in file(indexFilename):
+			fields = line.split()
+			if not line.endswith("\n") or len(fields) != 4:
+				continue
+			blocks.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3])))
+	return blocks
+
+def readBlock(directory, block):
+	"""Generator of (domain, parserName, ArchivedResult) from block."""
+	(segmentName, offset, length, recordCount) = block
+	segment = file(os.path.join(directory, segmentName), "rb")
+	try:
+		segment.seek(offset)
+		data = zlib.decompress(segment.read(length))
+	finally:
+		segment.close()
+
+	pos = 0
+	while pos < len(data):
+		(recordLen,) = lengthStruct.unpack_from(data, pos)
+		pos += lengthStruct.size
+		values = marshal.loads(data[pos:pos+recordLen])
+		pos += recordLen
+		yield (values[0], values[1], ArchivedResult(values[2:]))
+
+
+def replayBlocks(directory, scraperConfig, blocks, progress=None):
+	"""Run parsers over archived answers and store results in schema
+	given by config, using storage threads like the scan.
+
+	@param blocks: list of blocks from readIndex() to replay
+	@param progress: optional multiprocessing.Value counting answers
+	@returns: number of answers replayed
+	"""
+	import dns_scraper
+	from db import DbPool
+
+	prefix = ""
+	if scraperConfig.has_option("database", "prefix"):
+		prefix = scraperConfig.get("database", "prefix")
+	dns_scraper.InsertStatement.configure(scraperConfig)
+	opts = dns_scraper.DnsConfigOptions(scraperConfig)
+
+	storageThreads = scraperConfig.getint("processing", "storage_threads")
+	db = DbPool(scraperConfig, max_connections=storageThreads)
+	dbQueue = dns_scraper.StorageRouter(storageThreads, 500)
+	domainIds = dns_scraper.DomainIdCache.fromConfig(scraperConfig)
+	for i in range(storageThreads):
+		t = dns_scraper.StorageThread.fromConfig(db, dbQueue.queues[i], scraperConfig, domainIds)
+		t.setDaemon(True)
+		t.start()
+
+	answers = 0
+	for block in blocks:
+		for (domain, parserName, result) in readBlock(directory, block):
+			try:
+				parserClass = dns_scraper.parserClassByName(parserName)
+				parser = parserClass(domain, None, opts, dbQueue, prefix)
+				parser.store(result, dns_scraper.result2pkt(result, opts.packetParser))
+			except Exception:
+				logging.exception("Failed to replay %s answer for %s", parserName, domain)
+			answers += 1
+
+		if progress is not None:
+			with progress.get_lock():
+				progress.value += block[3]
+
+	dbQueue.join()
+	return answers
+
+def replayWorker(directory, scraperConfig, blocks, progress):
+	"""Entry point of replay worker process."""
+	try:
+		answers = replayBlocks(directory, scraperConfig, blocks, progress)
+		logging.info("Replayed %d answers", answers)
+	except:
+		logging.exception("Replay worker failed")
+		sys.exit(1)
+
+def replay(directory, scraperConfig, workerCount, progressInterval=60):
+	"""Replay whole archive with blocks split among worker processes.
+	@returns: number of answers replayed
+	"""
+	blocks = readIndex(directory)
+	logging.info("Replaying %d blocks with %d answers from %s", len(blocks),
+		sum([block[3] for block in blocks]), directory)
+
+	progress = multiprocessing.Value("L", 0)
+	workers = []
+	for i in range(workerCount):
+		worker = multiprocessing.Process(target=replayWorker, name="replay-%d" % (i + 1),
+			args=(directory, scraperConfig, blocks[i::workerCount], progress))
+		worker.start()
+		workers.append(worker)
+
+	startTime = time.time()
+	for worker in workers:
+		while worker.is_alive():
+			worker.join(progressInterval)
+			logging.info("Progress: %d answers replayed, %.1f answers/s", progress.value,
+				progress.value / (time.time() - startTime))
+
+		if worker.exitcode != 0:
+			logging.error("Worker %s exited with code %s", worker.name, worker.exitcode)
+
+	return progress.value
+
+
+if __name__ == '__main__':
+	optionParser = OptionParser(usage="%prog [options] <archive_dir> <scraper_config>")
+	optionParser.add_option("-w", "--workers", type="int", default=multiprocessing.cpu_count(),
+		help="number of worker processes (default number of CPUs)")
+	(options, args) = optionParser.parse_args()
+
+	if len(args) != 2 or options.workers < 1:
+		optionParser.print_usage(sys.stderr)
+		sys.exit(1)
+
+	scraperConfig = SafeConfigParser()
+	scraperConfig.read(args[1])
+
+	logfile = scraperConfig.get("log", "logfile")
+	logformat = "%(asctime)s %(levelname)s %(processName)s %(message)s [%(pathname)s:%(lineno)d]"
+	loglevel = getattr(logging, scraperConfig.get("log", "loglevel").upper())
+	if logfile == "-":
+		logging.basicConfig(stream=sys.stderr, level=loglevel, format=logformat)
+	else:
+		logging.basicConfig(filename=logfile, level=loglevel, format=logformat)
+
+	startTime = time.time()
+	answers = replay(args[0], scraperConfig, options.workers)
+	logging.info("Replay of %d answers took %.2f seconds", answers, time.time() - startTime)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of RDF/RR data extraction on 2048-bit RSA DNSKEY and RRSIG,
+# comparing the original byte-by-byte buffer loop with current getRdfData()
+# and getRrData(). Usage: python benchmark_rdf.py [iterations]
+
+import os
+import sys
+import time
+import base64
+
+import ldns
+
+from dns_scraper import getRdfData, getRrData, RDF_HAS_BYTEARRAY
+
+
+def byteLoopBufferData(buf, l):
+	"""Original implementation of getLdnsBufferData()"""
+	buf.flip()
+	s = ""
+	for i in range(l):
+		s += chr(buf.read_u8())
+	return s
+
+def byteLoopRdfData(rdf):
+	l = rdf.size()
+	buf = ldns.ldns_buffer(l)
+	rdf.write_to_buffer_canonical(buf)
+	return byteLoopBufferData(buf, l)
+
+def byteLoopRrData(rr):
+	l = rr.uncompressed_size()
+	buf = ldns.ldns_buffer(l)
+	rr.write_to_buffer_canonical(buf, ldns.LDNS_SECTION_ANSWER)
+	return byteLoopBufferData(buf, l)
+
+def newRr(text):
+	rr = ldns.ldns_rr.new_frm_str(text)
+	if rr is None:
+		raise ValueError("Can't parse RR: %s" % text)
+	return rr
+
+def bench(name, func, args, iterations):
+	start = time.time()
+	for i in xrange(iterations):
+		func(*args)
+	elapsed = time.time() - start
+	print "%-28s %8.2f us per call" % (name, 1e6 * elapsed / iterations)
+	return elapsed
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	
+	#random key material - only sizes matter here
+	modulus = base64.b64encode("\x03\x01\x00\x01" + os.urandom(256))
+	signature = base64.b64encode(os.urandom(256))
+	dnskey = newRr("example.com. 3600 IN DNSKEY 257 3 8 %s" % modulus)
+	rrsig = newRr("example.com. 3600 IN RRSIG DNSKEY 8 2 3600 20120501000000 "
+		"20120401000000 12345 example.com. %s" % signature)
+	
+	print "data_as_bytearray available: %s" % RDF_HAS_BYTEARRAY
+	
+	for (label, rr, rdfIndex) in (("DNSKEY key", dnskey, 3), ("RRSIG signature", rrsig, 8)):
+		rdf = rr.rdf(rdfIndex)
+		assert getRdfData(rdf) == byteLoopRdfData(rdf)
+		assert getRrData(rr) == byteLoopRrData(rr)
+		
+		old = bench("%s rdf, byte loop" % label, byteLoopRdfData, (rdf,), iterations)
+		new = bench("%s rdf, bulk" % label, getRdfData, (rdf,), iterations)
+		print "%-28s %8.1fx" % ("speedup", old / new)
+		old = bench("%s rr, byte loop" % label, byteLoopRrData, (rr,), iterations)
+		new = bench("%s rr, bulk" % label, getRrData, (rr,), iterations)
+		print "%-28s %8.1fx" % ("speedup", old / new)
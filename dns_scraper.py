@@ -23,6 +23,7 @@ work. See README.md.
 Unbound >= 1.4.17 already has the necessary patch.
 """
 
+import os
 import time
 import sys
 import threading
@@ -30,22 +31,40 @@ import Queue
 import logging
 import struct
 import re
+import select
+import bisect
+import heapq
+import itertools
+import resource
+import multiprocessing
+import hashlib
+import base64
+import string
+import copy
+import tempfile
+import cPickle
+
+from collections import OrderedDict, deque
 
 from binascii import hexlify
 from ConfigParser import SafeConfigParser
+from optparse import OptionParser
 
 import ldns
 
 from psycopg2 import IntegrityError
 from db import DbPool
+from wire import WirePacket, WireRR, WireRdf, WireFormatError, comparePackets, isVerified
+from archive import ArchiveWriter
+import rrtypes
 from unbound import ub_ctx, ub_version, ub_strerror, ub_ctx_config, \
 	RR_CLASS_IN, RR_TYPE_DNSKEY, RR_TYPE_A, \
-	RR_TYPE_AAAA, RR_TYPE_SSHFP, RR_TYPE_MX, RR_TYPE_DS, RR_TYPE_NSEC, \
-	RR_TYPE_NSEC3, RR_TYPE_NSEC3PARAMS, RR_TYPE_RRSIG, RR_TYPE_SOA, \
-	RR_TYPE_NS, RR_TYPE_TXT, RR_TYPE_CNAME, RR_TYPE_DNAME, RCODE_SERVFAIL
+	RR_TYPE_AAAA, RR_TYPE_MX, RR_TYPE_DS, RR_TYPE_NSEC, \
+	RR_TYPE_NSEC3, RR_TYPE_RRSIG, RR_TYPE_SOA, \
+	RR_TYPE_NS, RR_TYPE_TXT, RR_TYPE_CNAME, RR_TYPE_DNAME, RCODE_SERVFAIL, \
+	RCODE_NXDOMAIN
 
 RR_TYPE_SPF = 99
-RR_TYPE_TLSA = 52
 
 class DnsError(RuntimeError):
 	"""Exception for reporting internal unbound and ldns errors"""
@@ -53,6 +72,10 @@ class DnsError(RuntimeError):
 	def __init__(self, reason):
 		super(DnsError, self).__init__(reason)
 
+class QueryTimeout(DnsError):
+	"""Exception for query that was not answered before its deadline"""
+	pass
+
 class DnsConfigOptions(object):
 	"""Container for parameters present in config file related to DNS
 	resolution.
@@ -64,8 +87,85 @@ class DnsConfigOptions(object):
 		"""
 		self.unboundConfig = None
 		self.forwarder = None
+		self.asyncQueries = False
 		self.attempts = scraperConfig.getint("dns", "retries")
 		
+		if scraperConfig.has_option("dns", "async_queries"):
+			self.asyncQueries = scraperConfig.getboolean("dns", "async_queries")
+		
+		self.cacheHitTime = 0.005
+		if scraperConfig.has_option("dns", "cache_hit_time"):
+			self.cacheHitTime = scraperConfig.getfloat("dns", "cache_hit_time")
+		
+		#seconds after which domain is moved to slow lane after NS/DS queries
+		self.slowLaneBudget = 0
+		if scraperConfig.has_option("processing", "slow_lane_budget"):
+			self.slowLaneBudget = scraperConfig.getfloat("processing", "slow_lane_budget")
+		
+		#per-query and per-domain deadlines in seconds, 0 means unlimited
+		self.queryTimeout = 0
+		self.domainTimeout = 0
+		self.retryBackoff = 0
+		if scraperConfig.has_option("dns", "query_timeout"):
+			self.queryTimeout = scraperConfig.getfloat("dns", "query_timeout")
+		if scraperConfig.has_option("dns", "domain_timeout"):
+			self.domainTimeout = scraperConfig.getfloat("dns", "domain_timeout")
+		
+		#seconds before first deferred retry of SERVFAIL, doubled for every next
+		#attempt; 0 means immediate retries
+		if scraperConfig.has_option("dns", "retry_backoff"):
+			self.retryBackoff = scraperConfig.getfloat("dns", "retry_backoff")
+		
+		#queries per second and burst allowed per nameserver, 0 means unlimited
+		self.nsRateLimit = 0
+		self.nsRateBurst = 0
+		self.nsRateKey = "nameserver"
+		if scraperConfig.has_option("dns", "ns_rate_limit"):
+			self.nsRateLimit = scraperConfig.getfloat("dns", "ns_rate_limit")
+			self.nsRateBurst = self.nsRateLimit
+		if scraperConfig.has_option("dns", "ns_rate_burst"):
+			self.nsRateBurst = scraperConfig.getfloat("dns", "ns_rate_burst")
+		if scraperConfig.has_option("dns", "ns_rate_key"):
+			self.nsRateKey = scraperConfig.get("dns", "ns_rate_key")
+		
+		#"ldns", "wire" or "verify" (wire checked against ldns, ldns used)
+		self.packetParser = "ldns"
+		if scraperConfig.has_option("dns", "packet_parser"):
+			self.packetParser = scraperConfig.get("dns", "packet_parser")
+			if self.packetParser not in ("ldns", "wire", "verify"):
+				raise ValueError("Unknown packet_parser %s" % self.packetParser)
+			#experimental until checked against ldns on recorded answers
+			if self.packetParser == "wire" and not isVerified():
+				raise ValueError("packet_parser = wire needs passed 'make verify_wire' "
+					"on recorded corpus, use 'ldns' or 'verify'")
+		
+		#max number of validated NSEC/NSEC3 records kept for answering
+		#queries without sending them, 0 disables the cache
+		self.negativeCache = 0
+		if scraperConfig.has_option("dns", "negative_cache"):
+			self.negativeCache = scraperConfig.getint("dns", "negative_cache")
+		
+		#service prefixes per registry RR type (e.g. tlsa_prefixes) the
+		#domain is queried under, instead of the type's default prefix
+		self.servicePrefixes = {}
+		for spec in rrtypes.registry:
+			option = spec.name.lower() + "_prefixes"
+			if spec.servicePrefix is not None and scraperConfig.has_option("dns", option):
+				self.servicePrefixes[spec.name] = parsePrefixes(scraperConfig.get("dns", option))
+		
+		#TLSA prefixes queried under MX target hosts in host lane
+		self.mxTlsaPrefixes = []
+		if scraperConfig.has_option("dns", "mx_tlsa_prefixes"):
+			self.mxTlsaPrefixes = parsePrefixes(scraperConfig.get("dns", "mx_tlsa_prefixes"))
+		
+		#"array" stores NSEC/NSEC3 bitmaps as decoded INTEGER[] of RR
+		#types, "bytea" as raw window bitmap
+		self.nsecBitmap = "array"
+		if scraperConfig.has_option("database", "nsec_bitmap"):
+			self.nsecBitmap = scraperConfig.get("database", "nsec_bitmap")
+			if self.nsecBitmap not in ("array", "bytea"):
+				raise ValueError("Unknown nsec_bitmap %s" % self.nsecBitmap)
+		
 		if scraperConfig.has_option("dns", "unbound_config"):
 			self.unboundConfig = scraperConfig.get("dns", "unboundConfig")
 		if scraperConfig.has_option("dns", "forwarder"):
@@ -73,16 +173,41 @@ class DnsConfigOptions(object):
 			
 			
 		
-def result2pkt(result):
-	"""Extract ldns packet from ub_result.
+def parsePrefixes(value):
+	"""Parse comma-separated list of service prefixes like "_443._tcp.",
+	trailing dot is added where missing.
+	"""
+	prefixes = [prefix.strip() for prefix in value.split(",") if prefix.strip()]
+	return [prefix.endswith(".") and prefix or prefix + "." for prefix in prefixes]
+
+def result2pkt(result, packetParser="ldns"):
+	"""Extract packet from ub_result.
 	
+	@param packetParser: "ldns" for ldns_pkt, "wire" for wire.WirePacket
+	offering the same API to parsers, "verify" for ldns_pkt that is
+	compared with WirePacket and differences logged
 	@raises DnsError: on malformed packet
 	"""
+	if packetParser == "wire":
+		try:
+			return WirePacket(result.packet)
+		except WireFormatError, e:
+			raise DnsError("Failed to parse DNS packet: %s" % e)
+	
 	status, pkt = ldns.ldns_wire2pkt(result.packet)
 	
 	if status != 0:
 		raise DnsError("Failed to parse DNS packet: %s" % ldns.ldns_get_errorstr_by_id(status))
 	
+	if packetParser == "verify":
+		try:
+			diffs = comparePackets(pkt, WirePacket(result.packet), getRdfData)
+		except WireFormatError, e:
+			diffs = ["wire parser failed: %s" % e]
+		if diffs:
+			logging.warn("Wire parser mismatch for %s type %d: %s", result.qname, result.qtype,
+				"; ".join(diffs))
+	
 	return pkt
 	
 def validationToDbEnum(result):
@@ -97,13 +222,18 @@ def validationToDbEnum(result):
 	else:
 		return "insecure"
 
+#newer ldns bindings can copy rdf data in one call
+RDF_HAS_BYTEARRAY = hasattr(ldns.ldns_rdf, "data_as_bytearray")
+
 def getLdnsBufferData(buf, l):
-	"""Return data from ldns_buffer buf of size l as pythonic string."""
+	"""Return data from ldns_buffer buf of size l as pythonic string.
+	Data are read in 32-bit words and joined once, SWIG calls are the
+	main cost here.
+	"""
 	buf.flip()
-	s = ""
-	for i in range(l):
-		s += chr(buf.read_u8())
-	return s
+	words = l // 4
+	s = struct.pack("!%dI" % words, *[buf.read_u32() for i in xrange(words)])
+	return s + "".join([chr(buf.read_u8()) for i in xrange(l % 4)])
 	
 def getRdfData(rdf):
 	"""Return RDF bytes as pythonic string from ldns_rdf.
@@ -111,6 +241,12 @@ def getRdfData(rdf):
 	"""
 	if rdf is None:
 		return None
+	if isinstance(rdf, WireRdf):
+		return rdf.data
+	#canonical form differs from raw data only for domain names (lowercased)
+	if RDF_HAS_BYTEARRAY and rdf.get_type() != ldns.LDNS_RDF_TYPE_DNAME:
+		return str(rdf.data_as_bytearray())
+	
 	l = rdf.size()
 	buf = ldns.ldns_buffer(l)
 	rdf.write_to_buffer_canonical(buf)
@@ -125,6 +261,14 @@ def getRrData(rr, section=ldns.LDNS_SECTION_ANSWER):
 	
 	return getLdnsBufferData(buf, l)
 
+def getRrRdata(rr):
+	"""Return rdata of ldns_rr or wire.WireRR in wire format, domain
+	names in it uncompressed (lowercased for ldns_rr).
+	"""
+	if isinstance(rr, WireRR):
+		return rr.rdata()
+	return "".join([getRdfData(rr.rdf(i)) for i in range(rr.rd_count())])
+
 def rdfConvert(rdf, fmt, conv=lambda x: x):
 	"""Unpack and convert data from ldns_rdf.
 	
@@ -135,6 +279,9 @@ def rdfConvert(rdf, fmt, conv=lambda x: x):
 	return conv(struct.unpack(fmt, getRdfData(rdf))[0])
 		
 
+#bit positions set in byte, MSB is position 0, as in NSEC type bitmaps
+NSEC_BITMAP_BITS = [tuple([i for i in range(8) if (value << i) & 0x80]) for value in range(256)]
+
 def assertRdfCount(count, rr):
 	"""Check that ldns_rr has correct number of RDFs.
 	
@@ -145,6 +292,422 @@ def assertRdfCount(count, rr):
 	if rr.rd_count() != count:
 		raise DnsError("Invalid RDF count in RR %s" % str(rr))
 		
+class LatencyHistogram(object):
+	"""Histogram of query latencies with logarithmic buckets, used for
+	tail-latency summary.
+	"""
+	
+	#upper bounds of buckets in seconds, from 1 ms to ~12 minutes
+	bounds = [0.001 * 2 ** (i / 2.0) for i in range(40)]
+	
+	def __init__(self):
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.maxLatency = 0.0
+	
+	def add(self, seconds):
+		self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+		self.maxLatency = max(self.maxLatency, seconds)
+	
+	def merge(self, other):
+		"""Add counts of other histogram to this one."""
+		self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+		self.maxLatency = max(self.maxLatency, other.maxLatency)
+	
+	def percentile(self, p):
+		"""Returns upper bound of latency of p percent of queries."""
+		threshold = sum(self.counts) * p / 100.0
+		cumulative = 0
+		for (i, count) in enumerate(self.counts):
+			cumulative += count
+			if cumulative >= threshold and cumulative > 0:
+				if i < len(self.bounds):
+					return min(self.bounds[i], self.maxLatency)
+				return self.maxLatency
+		return 0.0
+	
+	def __str__(self):
+		return ", ".join(["p%s %.1f ms" % (p, 1000 * self.percentile(p)) for p in (50, 90, 99, 99.9)] + \
+			["max %.1f ms" % (1000 * self.maxLatency)])
+
+
+def isServfail(status, result):
+	"""Returns True if ub_resolve status and result mean SERVFAIL answer."""
+	return status == 0 and result is not None and result.rcode == RCODE_SERVFAIL
+
+
+class ResolverStats(object):
+	"""Thread-safe counters of queries answered by one ResolverContext.
+	
+	Libunbound doesn't expose its cache statistics, so answers that came
+	faster than cacheHitTime are counted as cache hits and the rest as
+	queries that needed to go upstream.
+	"""
+	
+	def __init__(self, cacheHitTime):
+		"""@param cacheHitTime: answers faster than this (in seconds) are
+		considered to be served from cache
+		"""
+		self.cacheHitTime = cacheHitTime
+		self.queries = 0
+		self.cacheHits = 0
+		self.timeouts = 0
+		self.servfails = 0
+		self.totalTime = 0.0
+		self.latencies = LatencyHistogram()
+		self.lock = threading.Lock()
+	
+	def record(self, seconds, servfail=False):
+		"""Account one answered query that took given time.
+		@param servfail: True if the answer was SERVFAIL
+		"""
+		with self.lock:
+			self.queries += 1
+			self.totalTime += seconds
+			self.latencies.add(seconds)
+			if seconds < self.cacheHitTime:
+				self.cacheHits += 1
+			if servfail:
+				self.servfails += 1
+	
+	def recordTimeout(self, seconds):
+		"""Account one query dropped after given time."""
+		with self.lock:
+			self.queries += 1
+			self.timeouts += 1
+			self.totalTime += seconds
+			self.latencies.add(seconds)
+	
+	def merge(self, other):
+		"""Add counters of other ResolverStats to this one."""
+		with self.lock:
+			self.queries += other.queries
+			self.cacheHits += other.cacheHits
+			self.timeouts += other.timeouts
+			self.servfails += other.servfails
+			self.totalTime += other.totalTime
+			self.latencies.merge(other.latencies)
+	
+	def upstreamQueries(self):
+		"""Estimated number of queries that were not answered from cache."""
+		return self.queries - self.cacheHits
+	
+	def __str__(self):
+		queries = self.queries or 1 #avoid division by zero
+		return "%d queries, %d cache hits (%.1f%%), %d upstream, %d timeouts, %d SERVFAILs, mean latency %.1f ms" % \
+			(self.queries, self.cacheHits, 100.0 * self.cacheHits / queries,
+			self.upstreamQueries(), self.timeouts, self.servfails, 1000.0 * self.totalTime / queries)
+
+
+class ResolverContext(object):
+	"""Wrapper of ub_ctx that may be shared by several scan threads. Every
+	context has its own libunbound cache (delegations, DNSKEYs, validated
+	chains), which is shared by all threads using it. It provides the
+	subset of ub_ctx methods used by parsers and measures answer times.
+	"""
+	
+	pollInterval = 0.1 #seconds to wait for answers before checking deadline again
+	
+	def __init__(self, taFile, opts):
+		"""Create and configure the ub_ctx.
+		
+		@param taFile: trust anchor file for libunbound
+		@param opts: instance of DnsConfigOptions
+		"""
+		self.ctx = ub_ctx()
+		#asynchronous queries (async_queries, timeouts, service prefix
+		#waves) are resolved in thread sharing the cache instead of forked
+		#process, which would have own cache and fork multi-threaded scanner
+		self.ctx.set_async(True)
+		if opts.forwarder:
+			self.ctx.set_fwd(opts.forwarder)
+		self.ctx.add_ta_file(taFile) #read public keys for DNSSEC verification
+		
+		self.stats = ResolverStats(opts.cacheHitTime)
+	
+	def resolve(self, name, rrType, rrClass, timeout=None):
+		"""Same as ub_ctx.resolve(), but if timeout is given, the query
+		is sent asynchronously and cancelled if not answered in time.
+		
+		@param timeout: seconds to wait for the answer
+		@throws: QueryTimeout if the query was not answered in time
+		"""
+		start = time.time()
+		if timeout is None:
+			(status, result) = self.ctx.resolve(name, rrType, rrClass)
+			self.stats.record(time.time() - start, isServfail(status, result))
+			return (status, result)
+		
+		answers = []
+		def answered(mydata, status, result):
+			answers.append((status, result))
+		
+		(status, asyncId) = self.resolve_async(name, None, answered, rrType, rrClass)
+		if status != 0:
+			return (status, None)
+		
+		fd = self.fd()
+		deadline = start + timeout
+		while not answers:
+			remaining = deadline - time.time()
+			if remaining <= 0 and self.cancel(asyncId) == 0:
+				self.stats.recordTimeout(time.time() - start)
+				raise QueryTimeout("Query %s type %d timed out" % (name, rrType))
+			
+			select.select([fd], [], [], max(0, min(remaining, self.pollInterval)))
+			status = self.process()
+			if status != 0:
+				return (status, None)
+		
+		return answers[0]
+	
+	def resolve_async(self, name, mydata, callback, rrType, rrClass):
+		"""Same as ub_ctx.resolve_async()"""
+		start = time.time()
+		
+		def timedCallback(mydata, status, result):
+			self.stats.record(time.time() - start, isServfail(status, result))
+			callback(mydata, status, result)
+		
+		return self.ctx.resolve_async(name, mydata, timedCallback, rrType, rrClass)
+	
+	def fd(self):
+		"""Same as ub_ctx.fd()"""
+		return self.ctx.fd()
+	
+	def process(self):
+		"""Same as ub_ctx.process()"""
+		return self.ctx.process()
+	
+	def cancel(self, asyncId):
+		"""Same as ub_ctx.cancel()"""
+		return self.ctx.cancel(asyncId)
+
+
+class ResolverPool(object):
+	"""Small pool of ResolverContexts shared by scan threads.
+	
+	With size equal to number of scan threads every thread gets its own
+	context like before. Smaller pool means threads share caches, so the
+	root/TLD delegations and keys are fetched and validated only once per
+	context instead of once per thread.
+	"""
+	
+	def __init__(self, size, taFile, opts, name="resolver"):
+		"""Create the contexts.
+		
+		@param size: number of ub_ctx to create
+		@param taFile: trust anchor file for libunbound
+		@param opts: instance of DnsConfigOptions
+		@param name: name of pool used in log
+		"""
+		self.contexts = [ResolverContext(taFile, opts) for i in range(size)]
+		self.name = name
+	
+	def context(self, threadIndex):
+		"""Return context for scan thread with given index, contexts are
+		assigned round-robin.
+		"""
+		return self.contexts[threadIndex % len(self.contexts)]
+	
+	def totalStats(self):
+		"""Returns ResolverStats summed over all contexts."""
+		total = ResolverStats(0)
+		for context in self.contexts:
+			total.merge(context.stats)
+		return total
+	
+	def logStats(self):
+		"""Log query and cache counters of all contexts.
+		@returns: ResolverStats summed over all contexts
+		"""
+		for (i, context) in enumerate(self.contexts):
+			logging.info("%s context %d: %s", self.name.capitalize(), i, context.stats)
+		total = self.totalStats()
+		
+		logging.info("All %d %s contexts: %s", len(self.contexts), self.name, total)
+		logging.info("Query latency: %s", total.latencies)
+		logging.info("Max RSS of scanner: %d kB",
+			resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+		
+		return total
+
+
+class InsertStatement(object):
+	"""INSERT of one row into table of the schema. Value of fqdn_id column
+	is given as domain name and translated by insert_unique_domain().
+	Statements are compiled once per schema prefix and shared by parsers;
+	StorageThread may run them as server-side prepared statements, or run
+	their byId variant with ids resolved by DomainIdCache.
+	"""
+	
+	statements = {} #(prefix, table, columns) -> InsertStatement
+	lock = threading.Lock()
+	tableSuffix = "" #"_staging" to insert into staging tables, see finalize.py
+	
+	def __init__(self, name, prefix, table, columns, valueExprs):
+		"""@param name: name of prepared statement, unique in process
+		@param prefix: prefix of schema
+		@param table: table name without prefix
+		@param columns: tuple of column names
+		@param valueExprs: dict of SQL expressions for some columns with
+		%s in place of the value, default is plain %s
+		"""
+		self.name = name
+		self.table = table
+		self.columns = columns
+		
+		exprs = dict(valueExprs)
+		exprs.setdefault("fqdn_id", prefix + "insert_unique_domain(%s)")
+		values = [exprs.get(column, "%s") for column in columns]
+		
+		self.sql = "INSERT INTO %s%s (%s) VALUES (%s)" % (prefix, table,
+			", ".join(columns), ", ".join(values))
+		#parameters of prepared statement are numbered
+		numbered = [value.replace("%s", "$%d" % (i + 1)) for (i, value) in enumerate(values)]
+		self.prepareSql = "PREPARE %s AS INSERT INTO %s%s (%s) VALUES (%s)" % (name,
+			prefix, table, ", ".join(columns), ", ".join(numbered))
+		self.executeSql = "EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(columns)))
+		#multi-row INSERT is batchHead followed by rowSql for every row
+		self.batchHead = "INSERT INTO %s%s (%s) VALUES " % (prefix, table, ", ".join(columns))
+		self.rowSql = "(%s)" % ", ".join(values)
+		
+		#same INSERT taking integer fqdn_id instead of domain name
+		self.fqdnIndex = None
+		self.byId = None
+		if "fqdn_id" in columns and "fqdn_id" not in valueExprs:
+			self.fqdnIndex = columns.index("fqdn_id")
+			self.byId = InsertStatement(name + "_id", prefix, table, columns,
+				dict(valueExprs, fqdn_id="%s"))
+	
+	def withId(self, sql_data, ids):
+		"""Returns sql_data with domain name replaced by its id for byId.
+		@param ids: dict of domain name -> id
+		"""
+		i = self.fqdnIndex
+		return sql_data[:i] + (ids[sql_data[i]],) + sql_data[i+1:]
+	
+	@classmethod
+	def configure(cls, scraperConfig):
+		"""Set up statements by options of database section, before any
+		statement is compiled.
+		"""
+		if scraperConfig.has_option("database", "staging") and \
+				scraperConfig.getboolean("database", "staging"):
+			cls.tableSuffix = "_staging"
+	
+	@classmethod
+	def compile(cls, prefix, table, columns, valueExprs={}):
+		"""Returns statement for table and columns in schema with given
+		prefix, created on first use. Rows go to staging table instead
+		if tableSuffix is set.
+		"""
+		key = (prefix, table, columns)
+		statement = cls.statements.get(key)
+		if statement is None:
+			with cls.lock:
+				statement = cls.statements.get(key)
+				if statement is None:
+					statement = cls("insert_%d" % len(cls.statements), prefix,
+						table + cls.tableSuffix, columns, valueExprs)
+					cls.statements[key] = statement
+		return statement
+	
+	def __str__(self):
+		return self.sql
+
+
+class DomainIdCache(object):
+	"""Bounded LRU cache of domain name -> id in domains table, shared by
+	storage threads. Names missing in cache are upserted all at once by a
+	single INSERT ... ON CONFLICT, so rows can be inserted with integer
+	fqdn_id instead of calling insert_unique_domain() for every row.
+	"""
+	
+	def __init__(self, prefix, maxEntries):
+		"""@param prefix: prefix of schema
+		@param maxEntries: ids kept, least recently used are dropped first
+		"""
+		self.maxEntries = maxEntries
+		self.ids = OrderedDict() #fqdn -> id
+		self.lookups = 0
+		self.hits = 0
+		self.lock = threading.Lock()
+		#sorted, so that concurrent upserts lock rows in the same order
+		self.upsertSql = "INSERT INTO %sdomains (fqdn) SELECT DISTINCT fqdn " \
+			"FROM unnest(%%s::VARCHAR[]) AS fqdn ORDER BY fqdn " \
+			"ON CONFLICT (fqdn) DO NOTHING" % prefix
+		self.selectSql = "SELECT fqdn, id FROM %sdomains WHERE fqdn = ANY(%%s)" % prefix
+	
+	@classmethod
+	def fromConfig(cls, scraperConfig):
+		"""Returns cache sized by domain_cache option of database section,
+		None if the option is unset or 0.
+		"""
+		if not scraperConfig.has_option("database", "domain_cache"):
+			return None
+		maxEntries = scraperConfig.getint("database", "domain_cache")
+		if maxEntries <= 0:
+			return None
+		
+		prefix = ""
+		if scraperConfig.has_option("database", "prefix"):
+			prefix = scraperConfig.get("database", "prefix")
+		
+		return cls(prefix, maxEntries)
+	
+	def resolve(self, conn, fqdns):
+		"""Returns dict of domain name -> id for all fqdns. Missing domains
+		are inserted and committed in their own transaction, so ids stay
+		valid even if the caller's rows are rolled back.
+		
+		@param conn: connection of the calling storage thread
+		@param fqdns: iterable of domain names
+		"""
+		ids = {}
+		misses = set()
+		with self.lock:
+			for fqdn in fqdns:
+				if fqdn in ids or fqdn in misses:
+					continue
+				self.lookups += 1
+				domainId = self.ids.pop(fqdn, None)
+				if domainId is None:
+					misses.add(fqdn)
+					continue
+				self.hits += 1
+				self.ids[fqdn] = domainId
+				ids[fqdn] = domainId
+		
+		if not misses:
+			return ids
+		
+		try:
+			cursor = conn.cursor()
+			misses = list(misses)
+			cursor.execute(self.upsertSql, (misses,))
+			#other thread's conflicting row is committed once upsert returns
+			cursor.execute(self.selectSql, (misses,))
+			fetched = dict(cursor.fetchall())
+			conn.commit()
+		except Exception:
+			conn.rollback()
+			raise
+		
+		ids.update(fetched)
+		with self.lock:
+			for (fqdn, domainId) in fetched.iteritems():
+				self.ids[fqdn] = domainId
+			while len(self.ids) > self.maxEntries:
+				self.ids.popitem(last=False)
+		
+		return ids
+	
+	def logStats(self):
+		with self.lock:
+			logging.info("Domain id cache: %d hits of %d lookups, %d ids cached",
+				self.hits, self.lookups, len(self.ids))
+
+
 class StorageQueueClient(object):
 	"""Client for storing data passing it through queue to StorageThread."""
 	
@@ -172,14 +735,20 @@ class DnsMetadata(StorageQueueClient):
 	nsecRdfCount = 2
 	nsec3RdfCount = 5 # that's without bitmap, since some RRs don't have bitmap
 	
-	def __init__(self, pkt, dbQueue, prefix):
+	def __init__(self, pkt, dbQueue, prefix, nsecBitmap="array", negativeCache=None):
 		"""Fills self with parsed data from DNS answer.
 		
-		@param pkt: ldns_pkt DNS answer packet
+		@param pkt: ldns_pkt or wire.WirePacket DNS answer packet
 		@param dbQueue: DB queue for passing to StorageThread
+		@param nsecBitmap: "array" to store NSEC/NSEC3 bitmaps as list of
+		covered types, "bytea" to store raw bitmap
+		@param negativeCache: optional NegativeCache where NSEC/NSEC3
+		records of validated NODATA answers are added
 		"""
 		self.pkt = pkt
 		self.prefix = prefix
+		self.nsecBitmap = nsecBitmap
+		self.negativeCache = negativeCache
 		
 		StorageQueueClient.__init__(self, dbQueue)
 		
@@ -197,14 +766,10 @@ class DnsMetadata(StorageQueueClient):
 		@param section: section to look for RRSIGs
 		"""
 		rrsigs = self.rrsigs(section)
-		sql = "INSERT INTO %srrsig_rr " % self.prefix
-		sql = sql + """(fqdn_id, ttl, rr_type, algo, labels, orig_ttl,
-			sig_expiration, sig_inception,
-			keytag, signer, signature)
-			VALUES ("""+self.prefix+"""insert_unique_domain(%s), %s, %s, %s, %s, %s,
-				to_timestamp(%s), to_timestamp(%s),
-				%s, %s, %s)
-			"""
+		sql = InsertStatement.compile(self.prefix, "rrsig_rr",
+			("fqdn_id", "ttl", "rr_type", "algo", "labels", "orig_ttl",
+			"sig_expiration", "sig_inception", "keytag", "signer", "signature"),
+			{"sig_expiration": "to_timestamp(%s)", "sig_inception": "to_timestamp(%s)"})
 		
 		for rr in rrsigs:
 			try:
@@ -235,13 +800,12 @@ class DnsMetadata(StorageQueueClient):
 		covered RR types as integers.
 		"""
 		rrTypeList = []
+		base = windowNum << 8
 		for (charPos, c) in enumerate(bitmap):
-			value = ord(c)
-			for i in range(8):
-				isset = (value << i) & 0x80
-				if isset:
-					bitpos = (windowNum << 8) + (charPos << 3) + i
-					rrTypeList.append(bitpos)
+			bits = NSEC_BITMAP_BITS[ord(c)]
+			if bits:
+				bytePos = base + (charPos << 3)
+				rrTypeList.extend([bytePos + i for i in bits])
 		return rrTypeList
 		
 	@staticmethod
@@ -269,6 +833,23 @@ class DnsMetadata(StorageQueueClient):
 			raise DnsError("Malformed NSEC/NSEC3 bitmap: %s", hexlify(bitmap))
 			
 		
+	def bitmapColumn(self):
+		"""Returns column of nsec_rr/nsec3_rr where bitmap is stored."""
+		return self.nsecBitmap == "bytea" and "type_bitmap_raw" or "type_bitmap"
+	
+	def bitmapValue(self, bitmap):
+		"""Returns value of bitmap column for binary bitmap from RDF."""
+		if self.nsecBitmap == "bytea":
+			return buffer(bitmap)
+		return self.nsecBitmapCoveredTypes(bitmap)
+	
+	def cacheable(self, result):
+		"""Returns True if NSEC/NSEC3 records of answer should be added
+		to negative cache - only validated NODATA answers are.
+		"""
+		return self.negativeCache is not None and result.secure and \
+			not result.havedata and result.rcode == 0
+	
 	def nsecs(self):
 		"""Return NSEC records from authority section"""
 		nsecs  = self.pkt.rr_list_by_type(RR_TYPE_NSEC,  ldns.LDNS_SECTION_AUTHORITY)
@@ -284,11 +865,10 @@ class DnsMetadata(StorageQueueClient):
 		nsecs = self.nsecs()
 		secure = validationToDbEnum(result)
 		rcode = result.rcode
+		cacheable = self.cacheable(result)
 		
-		sql = "INSERT INTO %snsec_rr " % self.prefix
-		sql = sql + """(secure, fqdn_id, rr_type, owner, ttl, rcode, next_domain, type_bitmap)
-			VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s, %s, %s, %s)
-		"""
+		sql = InsertStatement.compile(self.prefix, "nsec_rr",
+			("secure", "fqdn_id", "rr_type", "owner", "ttl", "rcode", "next_domain", self.bitmapColumn()))
 		
 		for rr in nsecs:
 			try:
@@ -296,7 +876,11 @@ class DnsMetadata(StorageQueueClient):
 				ttl = rr.ttl()
 				owner = str(rr.owner()).rstrip(".").lower()
 				next_domain = str(rr.rdf(0)).rstrip(".").lower()
-				type_bitmap = self.nsecBitmapCoveredTypes(getRdfData(rr.rdf(1)))
+				bitmap = getRdfData(rr.rdf(1))
+				type_bitmap = self.bitmapValue(bitmap)
+				
+				if cacheable:
+					self.negativeCache.addNsec(owner, ttl, self.nsecBitmapCoveredTypes(bitmap))
 				
 				sql_data = (secure, domain, result.qtype, owner, ttl, rcode,
 					next_domain, type_bitmap)
@@ -322,13 +906,11 @@ class DnsMetadata(StorageQueueClient):
 		nsec3s = self.nsec3s()
 		secure = validationToDbEnum(result)
 		rcode = result.rcode
+		cacheable = self.cacheable(result)
 		
-		sql = "INSERT INTO %snsec3_rr " % self.prefix
-		sql = sql + """(secure, fqdn_id, rr_type, owner, ttl, rcode, hash_algo, flags,
-			iterations, salt, next_owner, type_bitmap)
-			VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s, %s, %s, %s,
-				%s, %s, %s, %s)
-		"""
+		sql = InsertStatement.compile(self.prefix, "nsec3_rr",
+			("secure", "fqdn_id", "rr_type", "owner", "ttl", "rcode", "hash_algo", "flags",
+			"iterations", "salt", "next_owner", self.bitmapColumn()))
 		
 		for rr in nsec3s:
 			try:
@@ -336,18 +918,19 @@ class DnsMetadata(StorageQueueClient):
 					raise DnsError("Invalid RDF count for NSEC3: %s" % str(rr))
 				ttl = rr.ttl()
 				owner = str(rr.owner()).rstrip(".").lower()
-				hash_algo = ldns.ldns_nsec3_algorithm(rr)
-				flags = ldns.ldns_nsec3_flags(rr)
-				iterations = ldns.ldns_nsec3_iterations(rr)
-				salt = getRdfData(ldns.ldns_nsec3_salt(rr))
-				next_owner = str(ldns.ldns_nsec3_next_owner(rr)).rstrip(".").lower()
-				bitmapRdf = getRdfData(ldns.ldns_nsec3_bitmap(rr))
+				#same RDFs as ldns_nsec3_*() functions return, but works
+				#with wire.WireRR as well
+				hash_algo = rdfConvert(rr.rdf(0), "B")
+				flags = rdfConvert(rr.rdf(1), "B")
+				iterations = rdfConvert(rr.rdf(2), "!H")
+				salt = getRdfData(rr.rdf(3))
+				next_owner = str(rr.rdf(4)).rstrip(".").lower()
+				bitmapRdf = getRdfData(rr.rdf(5))
 				
-				if bitmapRdf is not None:
-					type_bitmap = self.nsecBitmapCoveredTypes(bitmapRdf)
-				else:
+				if bitmapRdf is None:
 					logging.warn("Empty NSEC3 bitmap for %s: %s", domain, rr)
-					type_bitmap = []
+					bitmapRdf = ""
+				type_bitmap = self.bitmapValue(bitmapRdf)
 				
 				if len(salt) < 1:
 					logging.warn("Short NSEC3 salt for %s: %s",
@@ -361,6 +944,11 @@ class DnsMetadata(StorageQueueClient):
 						logging.warn("NSEC3 salt length mismatch for %s, %d != %d: %s",
 							domain, saltLen, len(salt), rr)
 				
+				#only SHA-1 is defined for NSEC3 hashing
+				if cacheable and hash_algo == 1:
+					self.negativeCache.addNsec3(owner, ttl,
+						self.nsecBitmapCoveredTypes(bitmapRdf), salt, iterations)
+				
 				sql_data = (secure, domain, result.qtype, owner, ttl, rcode,
 					hash_algo, flags, iterations, buffer(salt),
 					next_owner, type_bitmap)
@@ -378,11 +966,12 @@ class RRTypeParser(StorageQueueClient):
 	rrType = 0 #undefined RR type
 	rrClass = RR_CLASS_IN
 	rdfCount = -1 #bogus number of RDFs
+	servicePrefix = None #prefix of queried name like "_443._tcp.", if any
 	
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		"""Create instance.
 		@param domain: domain to scan for
-		@param resolver: ub_ctx to use for resolving
+		@param resolver: ResolverContext to use for resolving
 		@param opts: instance of DnsConfigOptions
 		@param dbQueue: DB queue for passing to StorageThread
 		@param prefix: prefix to use for schema
@@ -391,32 +980,240 @@ class RRTypeParser(StorageQueueClient):
 		self.resolver = resolver
 		self.opts = opts
 		self.prefix = prefix
+		self.deadline = None #time after which no more queries are sent for the domain
+		self.attempt = 0 #attempts used so far, including previous deferred ones
+		self.deferred = False #SERVFAIL answer was deferred to retry lane
+		self.startTime = None
+		self.sentTime = None
+		self.result = None #ub_result of answered query, consulted by QueryPlanner
+		self.archive = None #ArchiveWriter where answers are archived
+		self.negativeCache = None #NegativeCache answering queries without sending them
+		self.hostLane = None #HostLane collecting NS/MX target hosts
 		
 		StorageQueueClient.__init__(self, dbQueue)
 	
+	def archiveResult(self, result):
+		"""Write answer to archive if archiving is on."""
+		if self.archive is not None:
+			#JournalQueue's entry keeps domain uncompleted until written
+			self.archive.add(self.domain, self.__class__.__name__, result,
+				getattr(self.dbQueue, "entry", None))
+	
+	def collectHosts(self, hosts, role):
+		"""Pass target hosts found in answer to host lane, if enabled.
+		@param role: "ns" or "mx"
+		"""
+		if self.hostLane is not None:
+			self.hostLane.addHosts(hosts, role)
+	
+	def negativeCacheHit(self):
+		"""Check whether cached NSEC/NSEC3 record already proves that the
+		query has no data. The hit is recorded in query_outcome table.
+		
+		@returns: True if the query needn't be sent
+		"""
+		if self.negativeCache is None:
+			return False
+		
+		proof = self.negativeCache.lookup(self.queryName(), self.rrType)
+		if proof is None:
+			return False
+		
+		logging.debug("Domain %s type %s: no data proven by cached %s", \
+			self.queryName(), self.__class__.__name__, proof.upper())
+		self.storeOutcome("negative_cache", proof)
+		return True
+	
+	def queryName(self):
+		"""Returns name that is put into question of the query. By
+		default it's the scanned domain, subclasses like TLSAParser
+		prepend service prefix.
+		"""
+		return self.domain
+	
+	def queryDeadline(self):
+		"""Returns time when the query sent last must be answered, given
+		both per-query and per-domain deadline, or None if unlimited.
+		"""
+		deadlines = []
+		if self.opts.queryTimeout and self.sentTime is not None:
+			deadlines.append(self.sentTime + self.opts.queryTimeout)
+		if self.deadline is not None:
+			deadlines.append(self.deadline)
+		
+		return deadlines and min(deadlines) or None
+	
+	def storeOutcome(self, outcome, reason=None):
+		"""Record in DB that the query didn't end with usable answer.
+		@param outcome: value of query_outcome_kind DB enum
+		@param reason: optional explanation, e.g. rule of QueryPlanner
+		that skipped the query
+		"""
+		sql = InsertStatement.compile(self.prefix, "query_outcome",
+			("fqdn_id", "service_prefix", "rr_type", "outcome", "reason", "attempts", "duration"))
+		duration = None #skipped query was never sent
+		if self.startTime is not None:
+			duration = time.time() - self.startTime
+		#keyed on scanned domain like the RR tables, not on prefixed name
+		sql_data = (self.domain, self.servicePrefix, self.rrType, outcome, reason,
+			self.attempt, duration)
+		self.sqlExecute(sql, sql_data)
+	
 	def fetch(self):
 		"""Generic fetching of record that are not of special form like
 		SRV and TLSA.
 		
-		@returns: result part from (status, result) tupe of ub_ctx.resolve() or None on permanent SERVFAIL
+		@returns: result part from (status, result) tupe of ub_ctx.resolve() or None on permanent SERVFAIL, timeout
+		or deferred SERVFAIL (self.deferred is set in that case)
 		@throws: DnsError if unbound reports error
 		"""
-		for i in range(self.opts.attempts):
-			(status, result) = self.resolver.resolve(self.domain, self.rrType, self.rrClass)
+		#retried query keeps start of its first attempt
+		if self.startTime is None:
+			self.startTime = time.time()
+		
+		while self.attempt < self.opts.attempts:
+			self.attempt += 1
+			self.sentTime = time.time()
+			deadline = self.queryDeadline()
+			
+			try:
+				if deadline is None:
+					(status, result) = self.resolver.resolve(self.queryName(), self.rrType, self.rrClass)
+				else:
+					(status, result) = self.resolver.resolve(self.queryName(), self.rrType, self.rrClass,
+						deadline - self.sentTime)
+			except QueryTimeout:
+				logging.info("Timeout: domain %s type %s", \
+					self.queryName(), self.__class__.__name__)
+				self.storeOutcome("timeout")
+				return None
 			
 			if status != 0:
 				raise DnsError("Resolving %s for %s: %s" % \
-					(self.__class__.__name__, self.domain, ub_strerror(status)))
+					(self.__class__.__name__, self.queryName(), ub_strerror(status)))
 			
 			if result.rcode != RCODE_SERVFAIL:
 				logging.debug("Domain %s type %s: havedata %s, rcode %s", \
-					self.domain, self.__class__.__name__, result.havedata, result.rcode_str)
+					self.queryName(), self.__class__.__name__, result.havedata, result.rcode_str)
+				if self.attempt > 1:
+					self.storeOutcome("retried")
 				return result
 			
+			if self.opts.retryBackoff and self.attempt < self.opts.attempts:
+				self.deferRetry()
+				return None
+			
 		logging.info("Permanent SERVFAIL: domain %s type %s", \
-			self.domain, self.__class__.__name__)
+			self.queryName(), self.__class__.__name__)
+		self.storeOutcome("servfail")
 		return None
 	
+	def fetchAsync(self, callback):
+		"""Send the query via ub_ctx.resolve_async(). The answer is
+		parsed and stored from within ub_ctx.process() of the resolver,
+		SERVFAIL answers are re-sent up to opts.attempts times.
+		
+		@param callback: called as callback(parser, rrCount) once the
+		query is finished; rrCount has same meaning as return value of
+		fetchAndStore()
+		@returns: True if the query was answered from negative cache, it
+		is finished without sending and callback is not called
+		@throws: DnsError if the query could not be sent
+		"""
+		if self.negativeCacheHit():
+			return True
+		
+		self.asyncCallback = callback
+		if self.startTime is None:
+			self.startTime = time.time()
+		self.sendAsync()
+		return False
+	
+	def sendAsync(self):
+		"""Send (or re-send) the asynchronous query. If the domain's
+		deadline already passed, the query is finished as timed out
+		without sending it.
+		@throws: DnsError if unbound reports error
+		"""
+		self.attempt += 1
+		self.sentTime = time.time()
+		
+		if self.deadline is not None and self.sentTime >= self.deadline:
+			self.asyncTimedOut()
+			return
+		
+		(status, self.asyncId) = self.resolver.resolve_async(self.queryName(), None,
+			self.asyncResolved, self.rrType, self.rrClass)
+		
+		if status != 0:
+			raise DnsError("Sending query %s for %s: %s" % \
+				(self.__class__.__name__, self.queryName(), ub_strerror(status)))
+	
+	def asyncResolved(self, mydata, status, result):
+		"""Callback for ub_ctx.resolve_async(), see fetchAsync()."""
+		rrCount = -1
+		try:
+			if status != 0:
+				raise DnsError("Resolving %s for %s: %s" % \
+					(self.__class__.__name__, self.queryName(), ub_strerror(status)))
+			
+			if result.rcode != RCODE_SERVFAIL:
+				logging.debug("Domain %s type %s: havedata %s, rcode %s", \
+					self.queryName(), self.__class__.__name__, result.havedata, result.rcode_str)
+				if self.attempt > 1:
+					self.storeOutcome("retried")
+				self.result = result
+				self.archiveResult(result)
+				rrCount = self.store(result, result2pkt(result, self.opts.packetParser))
+			elif self.attempt < self.opts.attempts and self.opts.retryBackoff:
+				self.deferRetry()
+			elif self.attempt < self.opts.attempts:
+				self.sendAsync()
+				return
+			else:
+				logging.info("Permanent SERVFAIL: domain %s type %s", \
+					self.queryName(), self.__class__.__name__)
+				self.storeOutcome("servfail")
+		except Exception:
+			logging.exception("Fetching of RR type %d for %s failed",
+				self.rrType, self.queryName())
+		
+		self.asyncCallback(self, rrCount)
+	
+	def deferRetry(self):
+		"""Mark SERVFAILed query to be retried later from retry lane
+		instead of re-sending it immediately.
+		"""
+		logging.info("SERVFAIL: domain %s type %s, deferring attempt %d", \
+			self.queryName(), self.__class__.__name__, self.attempt + 1)
+		self.deferred = True
+	
+	def cancelAsync(self):
+		"""Cancel asynchronous query whose deadline has passed and finish
+		it as timed out.
+		
+		@returns: False if the query could not be cancelled because its
+		answer is just being processed, True otherwise
+		"""
+		if self.resolver.cancel(self.asyncId) != 0:
+			return False
+		
+		self.resolver.stats.recordTimeout(time.time() - self.sentTime)
+		self.asyncTimedOut()
+		return True
+	
+	def asyncTimedOut(self):
+		"""Record timeout of asynchronous query and finish it."""
+		logging.info("Timeout: domain %s type %s", \
+			self.queryName(), self.__class__.__name__)
+		try:
+			self.storeOutcome("timeout")
+		except Exception:
+			logging.exception("Failed to store timeout of %s for %s",
+				self.__class__.__name__, self.queryName())
+		
+		self.asyncCallback(self, -1)
+	
 	def _assertRdfCount(self, rr):
 		"""Check that ldns_rr has correct number of RDFs.
 		
@@ -437,11 +1234,13 @@ class RRTypeParser(StorageQueueClient):
 			if not result:
 				return (None, None)
 			
-			pkt = result2pkt(result)
+			self.result = result
+			self.archiveResult(result)
+			pkt = result2pkt(result, self.opts.packetParser)
 			return (result, pkt)
 		except DnsError:
 			logging.exception("Fetching of RR type %d for %s failed",
-				self.rrType, self.domain)
+				self.rrType, self.queryName())
 			return (None, None)
 		
 	def fetchAndStore(self):
@@ -449,6 +1248,21 @@ class RRTypeParser(StorageQueueClient):
 		@return: number of records of given RR type found, or -1 if
 		permanent SERVFAIL was encountered
 		"""
+		if self.negativeCacheHit():
+			return 0
+		
+		(result, pkt) = self.fetchAndParse()
+		if not result:
+			return -1
+		
+		return self.store(result, pkt)
+	
+	def store(self, result, pkt):
+		"""Store RRs from the answer in DB.
+		@param result: ub_result of the query
+		@param pkt: ldns_pkt parsed from result
+		@return: number of records of given RR type found
+		"""
 		raise NotImplementedError
 	
 	def storeRedirects(self, result, pkt):
@@ -464,10 +1278,8 @@ class RRTypeParser(StorageQueueClient):
 			if rrs is None:
 				continue #stupid None instead of empty rr_list
 			
-			sql = "INSERT INTO %s%s_rr " % (self.prefix, table)
-			sql = sql + """(secure, fqdn_id, ttl, dest)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s)
-					"""
+			sql = InsertStatement.compile(self.prefix, table + "_rr",
+				("secure", "fqdn_id", "ttl", "dest"))
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
@@ -487,7 +1299,8 @@ class RRTypeParser(StorageQueueClient):
 		@param result: ub_result from which pkt was created
 		@param extraSections: list of ldns.LDNS_SECTION_* to reap RRSIGs from
 		"""
-		meta = DnsMetadata(pkt, self.dbQueue, prefix)
+		meta = DnsMetadata(pkt, self.dbQueue, self.prefix, self.opts.nsecBitmap,
+			self.negativeCache)
 		
 		if result.havedata:
 			meta.rrsigsStore(self.domain, self.rrType)
@@ -503,16 +1316,22 @@ class AParser(RRTypeParser):
 	
 	rrType = RR_TYPE_A
 	rdfCount = 1
+	table = "aa_rr"
 	
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
+		rrCount = self.storeAddresses(r, pkt)
+		self.storeDnssecData(pkt, r)
+		
+		return rrCount
+	
+	def storeAddresses(self, r, pkt):
+		"""Store A/AAAA RRs of answer into self.table.
+		@returns: number of RRs
+		"""
 		rrCount = 0
 		
 		if r.havedata:
@@ -520,10 +1339,8 @@ class AParser(RRTypeParser):
 			
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %saa_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl, addr)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, self.table,
+				("secure", "fqdn_id", "ttl", "addr"))
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
@@ -538,14 +1355,30 @@ class AParser(RRTypeParser):
 				
 			rrCount = rrs.rr_count()
 		
-		self.storeDnssecData(pkt, r)
-		
 		return rrCount
 
 class AAAAParser(AParser):
 	
 	rrType = RR_TYPE_AAAA
 	
+class HostAParser(AParser):
+	"""Addresses of NS/MX target host resolved by host lane. Only host_addr
+	rows are stored, so CNAMEs, DNSSEC data and query outcomes of hosts
+	don't mix with those of scanned domains.
+	"""
+	
+	table = "host_addr"
+	
+	def store(self, r, pkt):
+		return self.storeAddresses(r, pkt)
+	
+	def storeOutcome(self, outcome, reason=None):
+		pass
+	
+class HostAAAAParser(HostAParser):
+	
+	rrType = RR_TYPE_AAAA
+	
 class NSParser(RRTypeParser):
 	
 	rrType = RR_TYPE_NS
@@ -553,12 +1386,9 @@ class NSParser(RRTypeParser):
 	
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
+		self.nameservers = [] #names from answer, used for rate limiting
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
 		rrCount = 0
 		
@@ -567,16 +1397,15 @@ class NSParser(RRTypeParser):
 			
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %sns_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl, nameserver)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, "ns_rr",
+				("secure", "fqdn_id", "ttl", "nameserver"))
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
 					self._assertRdfCount(rr)
 					nameserver = str(rr.ns_nsdname()).rstrip(".").lower()
 					ttl = rr.ttl()
+					self.nameservers.append(nameserver)
 					
 					sql_data = (secure, self.domain, ttl, nameserver)
 					self.sqlExecute(sql, sql_data)
@@ -584,6 +1413,7 @@ class NSParser(RRTypeParser):
 					logging.exception("Failed to parse %s for domain %s: %s" % (rr.get_type_str(), self.domain, rr))
 				
 			rrCount = rrs.rr_count()
+			self.collectHosts(self.nameservers, "ns")
 		
 		self.storeDnssecData(pkt, r)
 		
@@ -613,11 +1443,7 @@ class DNSKEYParser(RRTypeParser):
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
-	def fetchAndStore(self):
-		(result, pkt) = self.fetchAndParse()
-		if not result:
-			return -1
-		
+	def store(self, result, pkt):
 		self.storeRedirects(result, pkt)
 		secure = validationToDbEnum(result)
 		rrCount = 0
@@ -625,10 +1451,9 @@ class DNSKEYParser(RRTypeParser):
 		if result.havedata:
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %sdnskey_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl, flags, protocol, algo, rsa_exp, rsa_mod, other_key)
-					VALUES(%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s, %s, %s, %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, "dnskey_rr",
+				("secure", "fqdn_id", "ttl", "flags", "protocol", "algo",
+				"rsa_exp", "rsa_mod", "other_key"))
 			
 			for i in range(rrs.rr_count()):
 				try:
@@ -687,55 +1512,6 @@ class DNSKEYParser(RRTypeParser):
 		return rrCount
 	
 
-class DSParser(RRTypeParser):
-	
-	rrType = RR_TYPE_DS
-	rdfCount = 4
-	
-	def __init__(self, domain, resolver, opts, dbQueue, prefix):
-		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
-	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
-		self.storeRedirects(r, pkt)
-		rrCount = 0
-		
-		if r.havedata:
-			secure = validationToDbEnum(r)
-			
-			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
-			
-			sql = "INSERT INTO %sds_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl, keytag,
-					algo, digest_type, digest)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s,
-					%s, %s, %s)
-				"""
-			for i in range(rrs.rr_count()):
-				try:
-					rr = rrs.rr(i)
-					self._assertRdfCount(rr)
-					ttl = rr.ttl()
-					keytag = rdfConvert(rr.rdf(0), "!H")
-					algo = rdfConvert(rr.rdf(1), "B")
-					digest_type = rdfConvert(rr.rdf(2), "B")
-					digest = getRdfData(rr.rdf(3))
-					
-					sql_data = (secure, self.domain, ttl, keytag,
-						algo, digest_type, buffer(digest))
-					self.sqlExecute(sql, sql_data)
-				except:
-					logging.exception("Failed to parse %s for domain %s: %s" % (rr.get_type_str(), self.domain, rr))
-				
-			rrCount = rrs.rr_count()
-		
-		self.storeDnssecData(pkt, r)
-		
-		return rrCount
-
 class SOAParser(RRTypeParser):
 	
 	rrType = RR_TYPE_SOA
@@ -744,11 +1520,7 @@ class SOAParser(RRTypeParser):
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
 		rrCount = 0
 		secure = validationToDbEnum(r)
@@ -759,12 +1531,9 @@ class SOAParser(RRTypeParser):
 			if not rrs:
 				continue #if no RRs are in given section, rr_list_by_type returns None instead of empty list
 			
-			sql = "INSERT INTO %ssoa_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, authority, ttl, zone,
-				mname, rname, serial, refresh, retry, expire, minimum)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s,
-					%s, %s, %s, %s, %s, %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, "soa_rr",
+				("secure", "fqdn_id", "authority", "ttl", "zone",
+				"mname", "rname", "serial", "refresh", "retry", "expire", "minimum"))
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
@@ -793,101 +1562,404 @@ class SOAParser(RRTypeParser):
 		
 		return rrCount
 
-class SSHFPParser(RRTypeParser):
-	
-	rrType = RR_TYPE_SSHFP
-	rdfCount = 3
+class SpillQueue(Queue.Queue):
+	"""Storage queue whose put() never blocks: rows beyond memorySize are
+	appended to an unlinked temporary file and read back in order once the
+	in-memory rows are taken, so DB stalls don't stall scan threads.
+	
+	Rows are pickled; InsertStatements and JournalEntries stay in memory
+	and the pickle refers to them by persistent id, so they keep their
+	identity (and journal references) while spilled.
+	"""
 	
-	def __init__(self, domain, resolver, opts, dbQueue, prefix):
-		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
+	def __init__(self, memorySize, spillDir):
+		"""@param memorySize: rows kept in memory
+		@param spillDir: directory of the spill file
+		"""
+		self.memorySize = memorySize
+		(fd, filename) = tempfile.mkstemp(prefix="storage-spill-", dir=spillDir)
+		os.unlink(filename) #the file disappears with the process
+		self.spillFile = os.fdopen(fd, "w+b")
+		#unbounded, the in-memory bound is kept by _put()
+		Queue.Queue.__init__(self)
+	
+	def _init(self, maxsize):
+		self.queue = deque()
+		self.spilled = 0 #rows in spill file
+		self.readPos = 0
+		self.maxSpilled = 0
+		self.maxSpillBytes = 0
+		self.objects = {} #id -> [object, references from spill file]
+	
+	def _qsize(self, len=len):
+		return len(self.queue) + self.spilled
+	
+	def _put(self, item):
+		#once spilling, rows must go to file to keep their order
+		if self.spilled or len(self.queue) >= self.memorySize:
+			self.spill(item)
+		else:
+			self.queue.append(item)
+	
+	def _get(self):
+		if not self.queue:
+			self.unspill()
+		return self.queue.popleft()
+	
+	def persistentId(self, obj):
+		if isinstance(obj, buffer):
+			return ("buffer", str(obj))
+		if isinstance(obj, (InsertStatement, JournalEntry)):
+			entry = self.objects.setdefault(id(obj), [obj, 0])
+			entry[1] += 1
+			return ("object", id(obj))
+		return None
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
-		self.storeRedirects(r, pkt)
-		rrCount = 0
-		
-		if r.havedata:
-			secure = validationToDbEnum(r)
-			
-			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
-			
-			sql = "INSERT INTO %ssshfp_rr " %  self.prefix
-			sql = sql + """(secure, fqdn_id, ttl,
-				algo, fp_type, fingerprint)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s,
-					%s, %s, %s)
-				"""
-			for i in range(rrs.rr_count()):
-				try:
-					rr = rrs.rr(i)
-					self._assertRdfCount(rr)
-					ttl = rr.ttl()
-					
-					algo = rdfConvert(rr.rdf(0), "B")
-					fp_type = rdfConvert(rr.rdf(1), "B")
-					fingerprint = getRdfData(rr.rdf(2))
-					
-					sql_data = (secure, self.domain, ttl,
-						algo, fp_type, buffer(fingerprint))
-					self.sqlExecute(sql, sql_data)
-				except:
-					logging.exception("Failed to parse %s for domain %s: %s" % (rr.get_type_str(), self.domain, rr))
-				
-			rrCount = rrs.rr_count()
-		
-		self.storeDnssecData(pkt, r)
-		
-		return rrCount
-
+	def persistentLoad(self, pid):
+		(kind, value) = pid
+		if kind == "buffer":
+			return buffer(value)
+		entry = self.objects[value]
+		entry[1] -= 1
+		if not entry[1]:
+			del self.objects[value]
+		return entry[0]
+	
+	def spill(self, item):
+		"""Append row to spill file, caller holds the mutex."""
+		if not self.spilled:
+			logging.info("Storage queue full, spilling rows to disk")
+		
+		self.spillFile.seek(0, os.SEEK_END)
+		pickler = cPickle.Pickler(self.spillFile, cPickle.HIGHEST_PROTOCOL)
+		pickler.persistent_id = self.persistentId
+		pickler.dump(item)
+		self.spilled += 1
+		self.maxSpilled = max(self.maxSpilled, self.spilled)
+		self.maxSpillBytes = max(self.maxSpillBytes, self.spillFile.tell() - self.readPos)
+	
+	def unspill(self):
+		"""Read next memorySize rows back from spill file, caller holds
+		the mutex. File is truncated once it's read completely.
+		"""
+		self.spillFile.flush()
+		self.spillFile.seek(self.readPos)
+		while self.spilled and len(self.queue) < self.memorySize:
+			unpickler = cPickle.Unpickler(self.spillFile)
+			unpickler.persistent_load = self.persistentLoad
+			self.queue.append(unpickler.load())
+			self.spilled -= 1
+		self.readPos = self.spillFile.tell()
+		
+		if not self.spilled:
+			self.spillFile.seek(0)
+			self.spillFile.truncate()
+			self.readPos = 0
+			logging.info("Storage queue drained spilled rows")
 
-class StorageThread(threading.Thread):
-	"""Thread taking sql/sql_data from queue and executing it for storage in DB"""
 
-	def __init__(self, db, dbQueue):
-		"""Create storage thread.
-		
-		@param db: database connection pool, instance of db.DbPool
-		@param dbQueue: instance of Queue.Queue that stores (sql,
-		sql_data) tuples to be executed
+class StorageRouter(object):
+	"""Storage queue split into one Queue.Queue per storage thread. Rows
+	are routed by hash of their domain name, so all rows of a domain are
+	stored by the same thread on its own connection and threads don't race
+	on insert_unique_domain() of the same domain. Rows without domain go to
+	the first queue.
+	"""
+	
+	def __init__(self, queueCount, queueSize, spillDir=None):
+		"""@param queueCount: number of queues, i.e. storage threads
+		@param queueSize: maxsize of each queue, i.e. rows kept in memory
+		@param spillDir: if given, queues are SpillQueues with spill files
+		in this directory, otherwise put() blocks when queue is full
 		"""
-		self.db = db
-		self.dbQueue = dbQueue
+		if spillDir:
+			self.queues = [SpillQueue(queueSize, spillDir) for i in range(queueCount)]
+		else:
+			self.queues = [Queue.Queue(queueSize) for i in range(queueCount)]
+		self.maxsize = queueCount * queueSize
+	
+	def route(self, sqlTuple):
+		"""Returns queue for (sql, sql_data) tuple."""
+		fqdnIndex = getattr(sqlTuple[0], "fqdnIndex", None)
+		if fqdnIndex is None:
+			return self.queues[0]
+		return self.queues[hash(sqlTuple[1][fqdnIndex]) % len(self.queues)]
+	
+	def put(self, sqlTuple):
+		self.route(sqlTuple).put(sqlTuple)
+	
+	def qsize(self):
+		"""Returns number of rows waiting in memory."""
+		return sum([queue.qsize() - self.spilled(queue) for queue in self.queues])
+	
+	@staticmethod
+	def spilled(queue):
+		return getattr(queue, "spilled", 0)
+	
+	def spilledRows(self):
+		"""Returns number of rows waiting in spill files."""
+		return sum([self.spilled(queue) for queue in self.queues])
+	
+	def logStats(self):
+		if isinstance(self.queues[0], SpillQueue):
+			logging.info("Storage queues: at most %d rows (%.1f MB) spilled to disk",
+				sum([queue.maxSpilled for queue in self.queues]),
+				sum([queue.maxSpillBytes for queue in self.queues]) / 1048576.0)
+	
+	def join(self):
+		"""Block until rows of all queues are stored."""
+		for queue in self.queues:
+			queue.join()
+
+
+class StorageMonitor(threading.Thread):
+	"""Logs depth of storage queues and rows spilled to disk every
+	interval, with a warning when spilled rows exceed spillWarning.
+	"""
+	
+	def __init__(self, dbQueue, interval, spillWarning=0):
+		"""@param dbQueue: StorageRouter to watch
+		@param interval: seconds between log messages
+		@param spillWarning: spilled rows above which a warning is logged,
+		0 for no warning
+		"""
+		self.dbQueue = dbQueue
+		self.interval = interval
+		self.spillWarning = spillWarning
+		
+		threading.Thread.__init__(self)
+	
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			spilled = self.dbQueue.spilledRows()
+			logging.info("Storage queues: %d rows in memory, %d rows spilled to disk",
+				self.dbQueue.qsize(), spilled)
+			if self.spillWarning and spilled > self.spillWarning:
+				logging.warning("Storage is falling behind, %d rows spilled to disk", spilled)
+
+
+class StorageThread(threading.Thread):
+	"""Thread taking sql/sql_data from queue and executing it for storage in DB"""
+
+	def __init__(self, db, dbQueue, prepared=False, batchRows=0, batchTime=1.0,
+			domainIds=None):
+		"""Create storage thread.
+		
+		@param db: database connection pool, instance of db.DbPool
+		@param dbQueue: instance of Queue.Queue that stores (sql,
+		sql_data) tuples to be executed; sql is string or InsertStatement
+		@param prepared: run InsertStatements as prepared statements, so
+		that only parameters are parsed by the server for every row
+		@param batchRows: if nonzero, rows of InsertStatements are
+		collected per table and stored by multi-row INSERTs in one
+		transaction once this many rows are collected
+		@param batchTime: seconds after which collected rows are stored
+		even if the batch isn't full
+		@param domainIds: DomainIdCache shared by storage threads; if
+		given, InsertStatements are run with fqdn_id resolved by it
+		instead of insert_unique_domain()
+		"""
+		self.db = db
+		self.dbQueue = dbQueue
+		self.prepared = prepared
+		self.preparedNames = set() #statements prepared on our connection
+		self.batchRows = batchRows
+		self.batchTime = batchTime
+		self.domainIds = domainIds
+		self.rows = 0
+		self.busyTime = 0.0 #seconds spent executing and committing
+		self.commits = 0
+		self.commitTime = 0.0 #seconds spent in commit
+		self.failedBatches = 0
 		
 		threading.Thread.__init__(self)
+	
+	@classmethod
+	def fromConfig(cls, db, dbQueue, scraperConfig, domainIds=None):
+		"""Create storage thread with options from database section.
+		@param domainIds: DomainIdCache shared by storage threads, see
+		DomainIdCache.fromConfig()
+		"""
+		prepared = False
+		batchRows = 0
+		batchTime = 1.0
+		if scraperConfig.has_option("database", "prepared_statements"):
+			prepared = scraperConfig.getboolean("database", "prepared_statements")
+		if scraperConfig.has_option("database", "batch_rows"):
+			batchRows = scraperConfig.getint("database", "batch_rows")
+		if scraperConfig.has_option("database", "batch_time"):
+			batchTime = scraperConfig.getfloat("database", "batch_time")
+		
+		return cls(db, dbQueue, prepared, batchRows, batchTime, domainIds)
+	
+	def execute(self, conn, sql, sql_data):
+		"""Execute one row's SQL on conn, preparing the statement first if
+		it wasn't prepared on this connection yet.
+		"""
+		if not isinstance(sql, InsertStatement):
+			conn.cursor().execute(sql, sql_data)
+		elif not self.prepared:
+			conn.cursor().execute(sql.sql, sql_data)
+		else:
+			if sql.name not in self.preparedNames:
+				#in its own transaction, so rollback of a row can't affect it
+				conn.cursor().execute(sql.prepareSql)
+				self.commit(conn)
+				self.preparedNames.add(sql.name)
+			conn.cursor().execute(sql.executeSql, sql_data)
+	
+	def commit(self, conn):
+		start = time.time()
+		conn.commit()
+		self.commitTime += time.time() - start
+		self.commits += 1
+	
+	def resolveDomains(self, conn, batch):
+		"""Replace domain names by ids from cache in rows of statements
+		having byId variant.
+		
+		@param batch: dict of InsertStatement -> list of sqlTuples
+		@returns: list of (statement, list of sql_data) to execute
+		"""
+		if self.domainIds is None:
+			return [(statement, [sqlTuple[1] for sqlTuple in sqlTuples])
+				for (statement, sqlTuples) in batch.iteritems()]
+		
+		fqdns = [sqlTuple[1][statement.fqdnIndex]
+			for (statement, sqlTuples) in batch.iteritems() if statement.byId
+			for sqlTuple in sqlTuples]
+		ids = self.domainIds.resolve(conn, fqdns)
+		
+		rows = []
+		for (statement, sqlTuples) in batch.iteritems():
+			if statement.byId:
+				rows.append((statement.byId, [statement.withId(sqlTuple[1], ids)
+					for sqlTuple in sqlTuples]))
+			else:
+				rows.append((statement, [sqlTuple[1] for sqlTuple in sqlTuples]))
+		return rows
+	
+	def storeRow(self, conn, sqlTuple):
+		"""Store single row in its own transaction."""
+		lastIntegrityError = None
+		
+		#To workaround for non-atomicity of
+		#insert_unique_domain, we'll do two attempts - if the
+		#first fails on duplicate key, second will work.
+		for attempt in range(2):
+			try:
+				sql, sql_data = sqlTuple[:2]
+				if isinstance(sql, InsertStatement):
+					[(sql, [sql_data])] = self.resolveDomains(conn, {sql: [sqlTuple]})
+				self.execute(conn, sql, sql_data)
+				self.rows += 1
+				break
+			except IntegrityError:
+				logging.debug("IntegrityError: failed attempt %d to execute `%s` with `%s`",
+					attempt+1, sql, sql_data)
+				lastIntegrityError = sys.exc_info()
+			except Exception:
+				logging.exception("Failed to execute `%s` with `%s`",
+					sql, sql_data)
+				break
+			finally:
+				self.commit(conn)
+		else: #this will run unless 'break' is executed in the above for loop
+			logging.error("Multiple integrity failures to execute `%s` with `%s`",
+				sql, sql_data, exc_info=lastIntegrityError)
+	
+	def storeBatch(self, conn, batch):
+		"""Store rows collected per InsertStatement by one multi-row INSERT
+		per table, all in one transaction. If the transaction fails, the
+		rows are stored one by one, so a bad row can't spoil the others.
+		
+		@param batch: dict of InsertStatement -> list of sqlTuples
+		"""
+		rowCount = sum([len(sqlTuples) for sqlTuples in batch.itervalues()])
+		try:
+			cursor = conn.cursor()
+			for (statement, rows) in self.resolveDomains(conn, batch):
+				values = ",".join([cursor.mogrify(statement.rowSql, sql_data)
+					for sql_data in rows])
+				cursor.execute(statement.batchHead + values)
+			self.commit(conn)
+			self.rows += rowCount
+		except Exception:
+			conn.rollback()
+			self.failedBatches += 1
+			logging.debug("Batch of %d rows failed, storing them one by one", rowCount,
+				exc_info=True)
+			for sqlTuples in batch.itervalues():
+				for sqlTuple in sqlTuples:
+					self.storeRow(conn, sqlTuple)
+	
+	def logStats(self):
+		logging.info("%s: %d rows, %.1f rows/s while busy, %d commits, %.2f ms per commit, "
+			"%d failed batches", self.name, self.rows, self.rows / (self.busyTime or 1),
+			self.commits, 1000 * self.commitTime / (self.commits or 1), self.failedBatches)
+	
+	def finished(self, sqlTuples):
+		"""Release journal entries of stored rows and mark them done."""
+		for sqlTuple in sqlTuples:
+			#rows from JournalQueue carry the domain's journal entry
+			if len(sqlTuple) > 2:
+				sqlTuple[2].release()
+			self.dbQueue.task_done()
 
 	def run(self):
 		conn = self.db.connection()
+		if self.batchRows > 0:
+			self.runBatched(conn)
+		
 		while True:
 			sqlTuple = self.dbQueue.get()
-			lastIntegrityError = None
+			start = time.time()
+			self.storeRow(conn, sqlTuple)
+			self.busyTime += time.time() - start
+			self.finished([sqlTuple])
+	
+	def runBatched(self, conn):
+		"""Collect rows until batch is full or batchTime passes since its
+		first row, then store them.
+		"""
+		batch = {} #InsertStatement -> list of sqlTuples
+		sqlTuples = []
+		flushTime = None
+		while True:
+			try:
+				if sqlTuples:
+					sqlTuple = self.dbQueue.get(True, max(flushTime - time.time(), 0.001))
+				else:
+					sqlTuple = self.dbQueue.get()
+			except Queue.Empty:
+				sqlTuple = None
 			
-			#To workaround for non-atomicity of
-			#insert_unique_domain, we'll do two attempts - if the
-			#first fails on duplicate key, second will work.
-			for attempt in range(2):
-				try:
-					cursor = conn.cursor()
-					sql, sql_data = sqlTuple
-					cursor.execute(sql, sql_data)
-					break
-				except IntegrityError:
-					logging.debug("IntegrityError: failed attempt %d to execute `%s` with `%s`",
-						attempt+1, sql, sql_data)
-					lastIntegrityError = sys.exc_info()
-				except Exception:
-					logging.exception("Failed to execute `%s` with `%s`",
-						sql, sql_data)
-					break
-				finally:
-					conn.commit()
-			else: #this will run unless 'break' is executed in the above for loop
-				logging.error("Multiple integrity failures to execute `%s` with `%s`",
-					sql, sql_data, exc_info=lastIntegrityError)
-				
-			self.dbQueue.task_done()
+			if sqlTuple is not None:
+				if not sqlTuples:
+					flushTime = time.time() + self.batchTime
+				sqlTuples.append(sqlTuple)
+				if isinstance(sqlTuple[0], InsertStatement):
+					batch.setdefault(sqlTuple[0], []).append(sqlTuple)
+				else:
+					#plain SQL isn't batched, rows before it are stored first
+					start = time.time()
+					if batch:
+						self.storeBatch(conn, batch)
+					self.storeRow(conn, sqlTuple)
+					self.busyTime += time.time() - start
+					self.finished(sqlTuples)
+					batch = {}
+					sqlTuples = []
+					continue
+			
+			if sqlTuples and (len(sqlTuples) >= self.batchRows or time.time() >= flushTime):
+				start = time.time()
+				self.storeBatch(conn, batch)
+				self.busyTime += time.time() - start
+				self.finished(sqlTuples)
+				batch = {}
+				sqlTuples = []
 
 class TXTParser(RRTypeParser):
 	
@@ -898,11 +1970,7 @@ class TXTParser(RRTypeParser):
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
 		rrCount = 0
 		
@@ -911,9 +1979,8 @@ class TXTParser(RRTypeParser):
 			
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %s%s " % (self.prefix, self.dbTable)
-			sql = sql + """(secure, fqdn_id, ttl, value)
-					VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s)"""
+			sql = InsertStatement.compile(self.prefix, self.dbTable,
+				("secure", "fqdn_id", "ttl", "value"))
 			
 			for i in range(rrs.rr_count()):
 				try:
@@ -945,19 +2012,15 @@ class SPFParser(TXTParser):
 		TXTParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
 	
-class NSEC3PARAMParser(RRTypeParser):
+class MXParser(RRTypeParser):
 	
-	rrType = RR_TYPE_NSEC3PARAMS
-	rdfCount = 4
+	rrType = RR_TYPE_MX
+	rdfCount = 2
 	
 	def __init__(self, domain, resolver, opts, dbQueue, prefix):
 		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
 		rrCount = 0
 		
@@ -966,60 +2029,44 @@ class NSEC3PARAMParser(RRTypeParser):
 			
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %snsec3param_rr" % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl,
-				hash_algo, flags, iterations, salt)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s,
-					%s, %s, %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, "mx_rr",
+				("secure", "fqdn_id", "ttl", "preference", "exchange"))
+			exchanges = []
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
 					self._assertRdfCount(rr)
-					self._assertRdfCount(rr)
 					ttl = rr.ttl()
-					
-					hash_algo = rdfConvert(rr.rdf(0), "B")
-					flags = rdfConvert(rr.rdf(1), "B")
-					iterations = rdfConvert(rr.rdf(2), "!H")
-					salt = getRdfData(rr.rdf(3))
-					
-					if len(salt) < 1:
-						logging.warn("Short NSEC3PARAM salt for %s: %s",
-							self.domain, rr)
-					else:
-						#again, salt is prefixed by length byte
-						saltLen = ord(salt[0])
-						salt = salt[1:]
-						if saltLen != len(salt):
-							logging.warn("NSEC3PARAM salt length mismatch for %s, %d != %d: %s",
-								self.domain, saltLen, len(salt), rr)
+					preference = rdfConvert(rr.mx_preference(), "!H")
+					exchange = str(rr.mx_exchange()).rstrip(".").lower()
+					exchanges.append(exchange)
 					
 					sql_data = (secure, self.domain, ttl,
-						hash_algo, flags, iterations, buffer(salt))
+						preference, exchange)
 					self.sqlExecute(sql, sql_data)
 				except:
 					logging.exception("Failed to parse %s for domain %s: %s" % (rr.get_type_str(), self.domain, rr))
 				
 			rrCount = rrs.rr_count()
+			self.collectHosts(exchanges, "mx")
 		
 		self.storeDnssecData(pkt, r)
 		
 		return rrCount
 
-class MXParser(RRTypeParser):
+class RegistryParser(RRTypeParser):
+	"""Parser of RR type declared in rrtypes registry, its rdata decoding
+	and INSERT are generated from the declaration in spec.
+	"""
 	
-	rrType = RR_TYPE_MX
-	rdfCount = 2
+	spec = None #rrtypes.RRType
 	
-	def __init__(self, domain, resolver, opts, dbQueue, prefix):
-		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
+	def queryName(self):
+		if self.servicePrefix is not None:
+			return self.servicePrefix + self.domain
+		return self.domain
 	
-	def fetchAndStore(self):
-		(r, pkt) = self.fetchAndParse()
-		if not r:
-			return -1
-		
+	def store(self, r, pkt):
 		self.storeRedirects(r, pkt)
 		rrCount = 0
 		
@@ -1028,24 +2075,21 @@ class MXParser(RRTypeParser):
 			
 			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
 			
-			sql = "INSERT INTO %smx_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl,
-				preference, exchange)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s)
-				"""
+			sql = InsertStatement.compile(self.prefix, self.spec.table, self.spec.columns)
+			serviceColumns = self.servicePrefix is not None and (self.servicePrefix,) or ()
+			
 			for i in range(rrs.rr_count()):
 				try:
 					rr = rrs.rr(i)
-					self._assertRdfCount(rr)
-					ttl = rr.ttl()
-					preference = rdfConvert(rr.mx_preference(), "!H")
-					exchange = str(rr.mx_exchange()).rstrip(".").lower()
-					
-					sql_data = (secure, self.domain, ttl,
-						preference, exchange)
+					#raw rdata of WireRR may contain compressed names
+					if isinstance(rr, WireRR):
+						values = self.spec.decode(rr.rdata(), rr.packet, rr.rdataStart)
+					else:
+						values = self.spec.decode(getRrRdata(rr))
+					sql_data = (secure, self.domain, rr.ttl()) + serviceColumns + values
 					self.sqlExecute(sql, sql_data)
 				except:
-					logging.exception("Failed to parse %s for domain %s: %s" % (rr.get_type_str(), self.domain, rr))
+					logging.exception("Failed to parse %s for domain %s: %s" % (self.spec.name, self.domain, rr))
 				
 			rrCount = rrs.rr_count()
 		
@@ -1053,120 +2097,1539 @@ class MXParser(RRTypeParser):
 		
 		return rrCount
 
-class TLSAParser(RRTypeParser):
-	
-	rrType = RR_TYPE_TLSA
-	rdfCount = 1
-	servicePrefix = "_443._tcp." #by default scan for port 443 tcp TLSAs
+def registryParser(spec):
+	"""Returns RegistryParser subclass for rrtypes.RRType."""
+	return type(spec.name + "Parser", (RegistryParser,),
+		{"spec": spec, "rrType": spec.code, "servicePrefix": spec.servicePrefix})
+
+#parser classes of registry types by their name; they are module globals
+#as well, so archive replay finds them by class name
+registryParsers = dict((spec.name, registryParser(spec)) for spec in rrtypes.registry)
+globals().update((parser.__name__, parser) for parser in registryParsers.values())
+DSParser = registryParsers["DS"]
+NSEC3PARAMParser = registryParsers["NSEC3PARAM"]
+TLSAParser = registryParsers["TLSA"]
+
+prefixedParsers = {} #(parserClass, prefix) -> subclass querying under prefix
+
+def prefixedParser(parserClass, prefix):
+	"""Returns subclass of RegistryParser class that queries under given
+	service prefix. It's named like "TLSAParser[_25._tcp.]", so rows and
+	archived answers of different prefixes stay apart.
+	"""
+	key = (parserClass, prefix)
+	if key not in prefixedParsers:
+		prefixedParsers[key] = type("%s[%s]" % (parserClass.__name__, prefix),
+			(parserClass,), {"servicePrefix": prefix})
+	return prefixedParsers[key]
+
+def parserClassByName(name):
+	"""Returns parser class by its name, including prefixed ones."""
+	if name.endswith("]"):
+		(baseName, prefix) = name[:-1].split("[", 1)
+		return prefixedParser(globals()[baseName], prefix)
+	return globals()[name]
+
+
+NSEC3_HASH_CHARS = string.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567",
+	"0123456789abcdefghijklmnopqrstuv")
+
+def nsec3Hash(name, salt, iterations):
+	"""Returns NSEC3 hashed owner label of name - base32hex of iterated
+	SHA-1 of the name in wire format (RFC 5155).
+	"""
+	wireName = "".join([chr(len(label)) + label for label in name.lower().split(".") if label]) + "\0"
+	digest = hashlib.sha1(wireName + salt).digest()
+	for i in xrange(iterations):
+		digest = hashlib.sha1(digest + salt).digest()
+	return base64.b32encode(digest).translate(NSEC3_HASH_CHARS)
+
+
+class NegativeCache(object):
+	"""Validated NSEC/NSEC3 records from NODATA answers, kept until their
+	TTL expires. Record whose owner matches queried name exactly proves
+	that RR types missing from its bitmap don't exist, so such query
+	needn't be sent. Covering (NXDOMAIN) ranges are not used, they would
+	need wildcard proofs as well.
+	"""
 	
-	def __init__(self, domain, resolver, opts, dbQueue, prefix):
-		RRTypeParser.__init__(self, domain, resolver, opts, dbQueue, prefix)
+	def __init__(self, maxEntries):
+		"""@param maxEntries: records kept, oldest are dropped first"""
+		self.maxEntries = maxEntries
+		self.entries = OrderedDict() #(kind, owner) -> (expires, frozenset of RR types)
+		self.nsec3Params = OrderedDict() #zone -> (salt, iterations)
+		self.lookups = 0
+		self.hits = 0
+		self.lock = threading.Lock()
 	
-	def fetchAndStore(self):
-		# a bit dirty handling of the prefix
-		domainUnprefixed = self.domain
-		self.domain = self.servicePrefix + self.domain
-		(r, pkt) = self.fetchAndParse()
-		self.domain = domainUnprefixed
-		if not r:
-			return -1
-		
-		self.storeRedirects(r, pkt)
-		rrCount = 0
+	@staticmethod
+	def provable(types):
+		"""Returns False for records not proving anything about types at
+		owner - NSEC of delegation is parent's and CNAME points elsewhere.
+		"""
+		return RR_TYPE_CNAME not in types and \
+			not (RR_TYPE_NS in types and RR_TYPE_SOA not in types)
+	
+	def add(self, key, ttl, types):
+		expires = time.time() + ttl
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (expires, frozenset(types))
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last=False)
+	
+	def addNsec(self, owner, ttl, types):
+		"""Cache NSEC record of validated NODATA answer."""
+		if self.provable(types):
+			self.add(("nsec", owner), ttl, types)
+	
+	def addNsec3(self, owner, ttl, types, salt, iterations):
+		"""Cache NSEC3 record of validated NODATA answer.
+		@param owner: hashed owner name, i.e. hash label + zone
+		"""
+		if not self.provable(types):
+			return
+		
+		zone = owner.partition(".")[2]
+		with self.lock:
+			self.nsec3Params.pop(zone, None)
+			self.nsec3Params[zone] = (salt, iterations)
+			while len(self.nsec3Params) > self.maxEntries:
+				self.nsec3Params.popitem(last=False)
+		self.add(("nsec3", owner), ttl, types)
+	
+	def match(self, key, rrType, now):
+		"""Returns True if cached record proves there's no rrType at key's
+		owner. Caller holds the lock.
+		"""
+		entry = self.entries.get(key)
+		if entry is None:
+			return False
+		if entry[0] <= now:
+			del self.entries[key]
+			return False
+		return rrType not in entry[1]
+	
+	def lookup(self, name, rrType):
+		"""Check whether name is proven to have no RRs of rrType.
+		@returns: "nsec" or "nsec3" by kind of proving record, None if
+		there's no proof
+		"""
+		#zone's own NSEC/NSEC3 says nothing about DS in parent
+		if rrType == RR_TYPE_DS:
+			return None
+		
+		name = name.lower()
+		labels = name.split(".")
+		now = time.time()
+		with self.lock:
+			self.lookups += 1
+			if self.match(("nsec", name), rrType, now):
+				self.hits += 1
+				return "nsec"
+			
+			#NSEC3 of name is in its own zone or some ancestor
+			zones = [(zone, self.nsec3Params[zone]) for zone in
+				[".".join(labels[i:]) for i in range(len(labels))]
+				if zone in self.nsec3Params]
+		
+		for (zone, (salt, iterations)) in zones:
+			key = ("nsec3", nsec3Hash(name, salt, iterations) + "." + zone)
+			with self.lock:
+				if self.match(key, rrType, now):
+					self.hits += 1
+					return "nsec3"
 		
-		if r.havedata:
-			secure = validationToDbEnum(r)
+		return None
+	
+	def logStats(self):
+		with self.lock:
+			logging.info("Negative cache: %d hits of %d lookups, %d records cached",
+				self.hits, self.lookups, len(self.entries))
+
+
+def nxdomainRule(nsResult, dsResult):
+	"""Name doesn't exist, so there's nothing to find under it."""
+	return nsResult is not None and nsResult.rcode == RCODE_NXDOMAIN
+
+def unsignedRule(nsResult, dsResult):
+	"""Parent has no DS for the zone and the NS answer isn't validated,
+	so the zone is unsigned and won't have DNSKEY nor NSEC3PARAM.
+	"""
+	return nsResult is not None and dsResult is not None and \
+		not dsResult.havedata and dsResult.rcode != RCODE_SERVFAIL and \
+		not nsResult.secure and not nsResult.bogus
+
+
+class QueryPlanner(object):
+	"""Drops queries of a domain that can't return data given the NS and DS
+	answers. Skipped queries are recorded in query_outcome table as
+	'skipped' with name of the rule, so gaps in data stay explainable.
+	"""
+	
+	#rule name -> (predicate(nsResult, dsResult), skipped parsers or None for all)
+	rules = {
+		"nxdomain": (nxdomainRule, None),
+		"unsigned": (unsignedRule, (DNSKEYParser, NSEC3PARAMParser)),
+	}
+	
+	def __init__(self, ruleNames):
+		"""@param ruleNames: names of rules to apply, in order
+		@raises ValueError: on unknown rule name
+		"""
+		for name in ruleNames:
+			if name not in self.rules:
+				raise ValueError("Unknown query_plan rule %s" % name)
+		
+		self.ruleNames = ruleNames
+		self.planned = 0
+		self.skipped = dict((name, 0) for name in ruleNames)
+		self.lock = threading.Lock()
+	
+	def plan(self, nsParser, dsParser, parserClasses):
+		"""Decide which of parserClasses should be run for the domain.
+		
+		@param nsParser: NSParser of the domain after its query
+		@param dsParser: DSParser of the domain after its query, or None
+		if DS answer isn't known
+		@returns: tuple (parser classes to run, list of (skipped parser
+		class, rule name) tuples)
+		"""
+		nsResult = nsParser.result
+		dsResult = dsParser is not None and dsParser.result or None
+		
+		run = list(parserClasses)
+		skipped = []
+		for name in self.ruleNames:
+			(predicate, ruleParsers) = self.rules[name]
+			if not run or not predicate(nsResult, dsResult):
+				continue
 			
-			rrs = pkt.rr_list_by_type(self.rrType, ldns.LDNS_SECTION_ANSWER)
+			drop = [parserClass for parserClass in run
+				if ruleParsers is None or parserClass in ruleParsers]
+			skipped.extend([(parserClass, name) for parserClass in drop])
+			run = [parserClass for parserClass in run if parserClass not in drop]
+		
+		with self.lock:
+			self.planned += len(parserClasses)
+			for (parserClass, name) in skipped:
+				self.skipped[name] += 1
+		
+		return (run, skipped)
+	
+	def logStats(self):
+		with self.lock:
+			logging.info("Query plan: %d of %d queries skipped (%s)",
+				sum(self.skipped.values()), self.planned,
+				", ".join(["%s: %d" % (name, self.skipped[name]) for name in self.ruleNames]))
+
+
+class TokenBucket(object):
+	"""Token bucket refilled at constant rate. Tokens may be reserved in
+	advance, the bucket then goes negative and the caller waits.
+	"""
+	
+	def __init__(self, rate, burst, now):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = now
+	
+	def reserve(self, amount, now):
+		"""Take amount of tokens.
+		@returns: seconds to wait until the tokens are available
+		"""
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		self.tokens -= amount
+		return max(0.0, -self.tokens / self.rate)
+	
+	def idle(self, now):
+		"""Returns True if bucket would be full by now."""
+		return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class NameserverRateLimiter(object):
+	"""Queries-per-second budget per authoritative nameserver, shared by
+	scan threads. Queries to a domain are charged evenly to its
+	nameservers, since the resolver picks one of them for each query.
+	"""
+	
+	pruneInterval = 100000 #reservations between dropping idle buckets
+	
+	def __init__(self, rate, burst, keyType="nameserver"):
+		"""@param rate: queries per second allowed per nameserver
+		@param burst: queries allowed at once after nameserver was idle
+		@param keyType: "nameserver" for bucket per NS name or "provider"
+		for bucket per parent domain of NS names (ns1.hoster.com and
+		ns2.hoster.com share bucket of hoster.com)
+		"""
+		if keyType not in ("nameserver", "provider"):
+			raise ValueError("Unknown ns_rate_key %s" % keyType)
+		
+		self.rate = rate
+		self.burst = burst
+		self.keyType = keyType
+		self.buckets = {}
+		self.reservations = 0
+		self.throttled = 0
+		self.delayedTime = 0.0
+		self.lock = threading.Lock()
+	
+	def bucketKey(self, nameserver):
+		if self.keyType == "provider" and "." in nameserver:
+			return nameserver.partition(".")[2]
+		return nameserver
+	
+	def reserve(self, nameservers, queryCount):
+		"""Charge queryCount queries to nameservers.
+		
+		@param nameservers: list of NS names of the queried domain
+		@returns: seconds the queries must be delayed to stay in budget
+		"""
+		if not nameservers or not queryCount:
+			return 0.0
+		
+		share = float(queryCount) / len(nameservers)
+		charges = {}
+		for nameserver in nameservers:
+			key = self.bucketKey(nameserver)
+			charges[key] = charges.get(key, 0.0) + share
+		
+		now = time.time()
+		delay = 0.0
+		with self.lock:
+			for (key, amount) in charges.iteritems():
+				bucket = self.buckets.get(key)
+				if bucket is None:
+					bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+				delay = max(delay, bucket.reserve(amount, now))
 			
-			sql = "INSERT INTO %stlsa_rr " % self.prefix
-			sql = sql + """(secure, fqdn_id, ttl,
-				service_prefix, cert_usage, selector, matching_type, association)
-				VALUES (%s, """+self.prefix+"""insert_unique_domain(%s), %s, %s, %s, %s, %s, %s)
-				"""
-			for i in range(rrs.rr_count()):
-				try:
-					rr = rrs.rr(i)
-					self._assertRdfCount(rr)
-					ttl = rr.ttl()
-					unparsedRr = getRdfData(rr.rdf(0))
-					if len(unparsedRr) < 4:
-						raise ValueError("TLSA record for %s.%s too short" % (self.servicePrefix, self.domain))
-					
-					cert_usage = ord(unparsedRr[0])
-					selector = ord(unparsedRr[1])
-					matching_type = ord(unparsedRr[2])
-					association = buffer(unparsedRr[3:])
-					
-					sql_data = (secure, self.domain, ttl,
-						self.servicePrefix, cert_usage, selector, matching_type, association)
-					self.sqlExecute(sql, sql_data)
-				except:
-					logging.exception("Failed to parse %s for domain %s: %s" % ("TLSA", self.domain, rr))
-				
-			rrCount = rrs.rr_count()
+			if delay > 0:
+				self.throttled += 1
+				self.delayedTime += delay
+			
+			self.reservations += 1
+			if self.reservations % self.pruneInterval == 0:
+				for key in [key for (key, b) in self.buckets.iteritems() if b.idle(now)]:
+					del self.buckets[key]
 		
-		self.storeDnssecData(pkt, r)
+		return delay
+	
+	def logStats(self):
+		with self.lock:
+			logging.info("Rate limiting: %d of %d domains throttled, delayed by %.2f s in total",
+				self.throttled, self.reservations, self.delayedTime)
+
+
+class ConcurrencyGate(object):
+	"""Limits how many of registered scan threads take new tasks. Thread
+	with slot number at or above the limit waits until the limit grows.
+	"""
+	
+	def __init__(self, limit):
+		self.limit = limit
+		self.slots = 0
+		self.condition = threading.Condition()
+	
+	def register(self):
+		"""Returns slot number for a new thread."""
+		with self.condition:
+			self.slots += 1
+			return self.slots - 1
+	
+	def enter(self, slot, timeout=None):
+		"""Block while thread with given slot is not allowed to run.
+		@param timeout: if given, wait at most timeout seconds, so that
+		gated thread can finish work it already owns
+		@returns: True if the thread may take new tasks
+		"""
+		with self.condition:
+			if timeout is None:
+				while slot >= self.limit:
+					self.condition.wait()
+				return True
+			
+			endTime = time.time() + timeout
+			while slot >= self.limit:
+				remaining = endTime - time.time()
+				if remaining <= 0:
+					return False
+				self.condition.wait(remaining)
+			return True
+	
+	def setLimit(self, limit):
+		with self.condition:
+			self.limit = limit
+			self.condition.notifyAll()
+
+
+class ConcurrencyController(threading.Thread):
+	"""Adjusts number of active scan threads in AIMD fashion: limit grows
+	by one every interval while the resolver and storage keep up, and is
+	cut by decreaseFactor when mean query latency, SERVFAIL rate, fill
+	of storage queue or rows spilled to disk exceed their thresholds.
+	"""
+	
+	decreaseFactor = 0.5
+	
+	def __init__(self, gate, resolverPool, dbQueue, minThreads, maxThreads, interval,
+		maxLatency, maxServfailRate, maxQueueFill=0.8, maxSpilled=0):
+		"""@param gate: ConcurrencyGate of scan threads
+		@param resolverPool: ResolverPool whose stats are watched
+		@param dbQueue: storage Queue.Queue or StorageRouter whose depth
+		is watched
+		@param minThreads, maxThreads: bounds of the limit
+		@param interval: seconds between decisions
+		@param maxLatency: mean query latency in seconds above which the
+		limit is cut
+		@param maxServfailRate: fraction of SERVFAIL answers above which
+		the limit is cut
+		@param maxQueueFill: fraction of dbQueue's maxsize above which the
+		limit is cut; rows spilled to disk count into the fill
+		@param maxSpilled: spilled rows above which the limit is cut, 0
+		for no such threshold
+		"""
+		self.gate = gate
+		self.resolverPool = resolverPool
+		self.dbQueue = dbQueue
+		self.minThreads = minThreads
+		self.maxThreads = maxThreads
+		self.interval = interval
+		self.maxLatency = maxLatency
+		self.maxServfailRate = maxServfailRate
+		self.maxQueueFill = maxQueueFill
+		self.maxSpilled = maxSpilled
 		
-		return rrCount
+		threading.Thread.__init__(self)
+	
+	def run(self):
+		last = self.resolverPool.totalStats()
+		while True:
+			time.sleep(self.interval)
+			current = self.resolverPool.totalStats()
+			try:
+				self.adjust(last, current)
+			except Exception:
+				logging.exception("Concurrency controller failed")
+			last = current
+	
+	def adjust(self, last, current):
+		"""Decide new limit from stats of last interval."""
+		queries = current.queries - last.queries
+		limit = self.gate.limit
+		if queries == 0:
+			#idle interval, e.g. all active threads wait for throttled
+			#domains or the input ran out; more threads can't hurt
+			if limit < self.maxThreads:
+				logging.info("Active scan threads %d -> %d (no queries in last interval)",
+					limit, limit + 1)
+				self.gate.setLimit(limit + 1)
+			return
+		
+		latency = (current.totalTime - last.totalTime) / queries
+		servfailRate = float(current.servfails - last.servfails) / queries
+		#spilled rows are backlog too, in-memory queues alone look drained
+		spilled = 0
+		if isinstance(self.dbQueue, StorageRouter):
+			spilled = self.dbQueue.spilledRows()
+		queueSize = self.dbQueue.qsize() + spilled
+		queueFill = float(queueSize) / self.dbQueue.maxsize if self.dbQueue.maxsize else 0
+		
+		reasons = []
+		if latency > self.maxLatency:
+			reasons.append("mean latency %.1f ms" % (1000 * latency))
+		if servfailRate > self.maxServfailRate:
+			reasons.append("SERVFAIL rate %.1f%%" % (100 * servfailRate))
+		if queueFill > self.maxQueueFill:
+			reasons.append("storage queue %.0f%% full" % (100 * queueFill))
+		if self.maxSpilled and spilled > self.maxSpilled:
+			reasons.append("%d rows spilled to disk" % spilled)
+		
+		if reasons:
+			newLimit = max(self.minThreads, int(limit * self.decreaseFactor))
+			reason = ", ".join(reasons)
+		else:
+			newLimit = min(self.maxThreads, limit + 1)
+			reason = "mean latency %.1f ms, SERVFAIL rate %.1f%%" % (1000 * latency, 100 * servfailRate)
+		
+		if newLimit != limit:
+			logging.info("Active scan threads %d -> %d (%s)", limit, newLimit, reason)
+			self.gate.setLimit(newLimit)
+
+
+class PendingQueries(object):
+	"""Set of parsers whose asynchronous queries were sent for one domain
+	and are still waiting for answer. Queries may be scheduled to be sent
+	later, they count as pending until then.
+	"""
+	
+	def __init__(self):
+		self.parsers = set()
+		self.delayed = [] #heap of (sendAt, parser, send)
+		self.lock = threading.Lock()
+	
+	def add(self, parser):
+		with self.lock:
+			self.parsers.add(parser)
+	
+	def delay(self, parser, sendAt, send):
+		"""Add parser whose query is to be sent by calling send() at time
+		sendAt.
+		"""
+		with self.lock:
+			self.parsers.add(parser)
+			heapq.heappush(self.delayed, (sendAt, parser, send))
+	
+	def due(self, now):
+		"""Returns list of send() functions of delayed queries due by now."""
+		sends = []
+		with self.lock:
+			while self.delayed and self.delayed[0][0] <= now:
+				sends.append(heapq.heappop(self.delayed)[2])
+		return sends
+	
+	def done(self, parser):
+		with self.lock:
+			self.parsers.discard(parser)
+	
+	def overdue(self, now):
+		"""Returns list of parsers whose queries passed their deadline.
+		Queries not sent yet are not included.
+		"""
+		with self.lock:
+			unsent = set(entry[1] for entry in self.delayed)
+			return [parser for parser in self.parsers
+				if parser not in unsent and parser.queryDeadline() is not None
+				and parser.queryDeadline() <= now]
+	
+	def __nonzero__(self):
+		return len(self.parsers) > 0
+
+
+class JournalEntry(object):
+	"""Reference count of unfinished work for one domain: scan tasks in
+	lanes and rows waiting in storage queue. When it drops to zero, the
+	domain is written to journal as completed.
+	"""
+	
+	def __init__(self, journal, domain):
+		self.journal = journal
+		self.domain = domain
+		self.lineNos = [] #more if domain is present in input repeatedly
+		self.refs = 0
+		self.lock = threading.Lock()
+	
+	def acquire(self):
+		with self.lock:
+			self.refs += 1
+	
+	def release(self):
+		with self.lock:
+			self.refs -= 1
+			completed = (self.refs == 0)
+		
+		if completed:
+			self.journal.completed(self)
 
 
+class NullQueue(object):
+	"""Storage queue discarding rows, used when answers are only archived."""
+	
+	def put(self, sqlTuple):
+		if len(sqlTuple) > 2:
+			sqlTuple[2].release()
+
+
+class JournalQueue(object):
+	"""Wrapper of storage queue that makes the rows of a domain hold its
+	JournalEntry until StorageThread commits them.
+	"""
+	
+	def __init__(self, dbQueue, entry):
+		self.dbQueue = dbQueue
+		self.entry = entry
+	
+	def put(self, sqlTuple):
+		self.entry.acquire()
+		self.dbQueue.put(sqlTuple + (self.entry,))
+
+
+class LineBitmap(object):
+	"""Set of line numbers of one worker's domains, one bit per line.
+	Lines of other workers are never members, so they take no space.
+	"""
+	
+	def __init__(self, workerIndex=0, workerCount=1):
+		self.workerIndex = workerIndex
+		self.workerCount = workerCount
+		self.bits = bytearray()
+		self.count = 0
+	
+	def add(self, lineNo):
+		if lineNo % self.workerCount != self.workerIndex:
+			return
+		(byte, bit) = divmod(lineNo // self.workerCount, 8)
+		if byte >= len(self.bits):
+			self.bits.extend(bytearray(byte + 1 - len(self.bits)))
+		if not self.bits[byte] & (1 << bit):
+			self.bits[byte] |= 1 << bit
+			self.count += 1
+	
+	def __contains__(self, lineNo):
+		if lineNo % self.workerCount != self.workerIndex:
+			return False
+		(byte, bit) = divmod(lineNo // self.workerCount, 8)
+		return byte < len(self.bits) and bool(self.bits[byte] & (1 << bit))
+	
+	def __len__(self):
+		return self.count
+
+
+class ScanJournal(object):
+	"""Append-only file with line numbers (in domain file) of domains
+	that have all parsers finished and their rows committed. Used to
+	skip those domains when resuming crashed scan.
+	"""
+	
+	def __init__(self, filename, truncate=False):
+		"""@param filename: journal file
+		@param truncate: start new journal instead of appending to old one
+		"""
+		self.file = open(filename, truncate and "w" or "a")
+		self.entries = {}
+		self.lock = threading.Lock()
+	
+	@staticmethod
+	def completedLines(filename, workerIndex=0, workerCount=1):
+		"""Returns LineBitmap of line numbers written in journal file that
+		belong to given worker. Partially written last line of crashed scan
+		is ignored.
+		"""
+		completed = LineBitmap(workerIndex, workerCount)
+		try:
+			for line in open(filename):
+				if line.endswith("\n"):
+					completed.add(int(line))
+		except IOError:
+			logging.warn("Journal %s can't be read, nothing to resume", filename)
+		
+		return completed
+	
+	def start(self, domain, lineNo):
+		"""Create (or reuse for repeated domain) entry for domain read
+		from given line.
+		"""
+		with self.lock:
+			entry = self.entries.get(domain)
+			if entry is None:
+				entry = JournalEntry(self, domain)
+				self.entries[domain] = entry
+			entry.lineNos.append(lineNo)
+			return entry
+	
+	def entry(self, domain):
+		"""Returns JournalEntry of domain being scanned."""
+		with self.lock:
+			return self.entries[domain]
+	
+	def completed(self, entry):
+		"""Write lines of completed domain to journal."""
+		with self.lock:
+			if self.entries.get(entry.domain) is entry:
+				del self.entries[entry.domain]
+			self.file.write("".join("%d\n" % lineNo for lineNo in entry.lineNos))
+			self.file.flush()
+
+
+class ScanLane(object):
+	"""Queue of scan tasks served by its own pool of scan threads, with
+	throughput counters. Items in the queue are lists of tasks, a thread
+	takes the whole list and does the tasks one after another.
+	"""
+	
+	def __init__(self, name, maxsize=0, journal=None):
+		"""@param name: name of lane used in log
+		@param maxsize: maximum size of task queue, 0 means unlimited
+		@param journal: optional ScanJournal; every queued task holds
+		its domain's entry until finished
+		"""
+		self.name = name
+		self.queue = Queue.Queue(maxsize)
+		self.journal = journal
+		self.domains = 0
+		self.startTime = time.time()
+		self.lock = threading.Lock()
+	
+	def put(self, domain, task):
+		"""Queue task for domain."""
+		self.putGroup([domain], [task])
+	
+	def putGroup(self, domains, tasks):
+		"""Queue tasks for domains, they will be done by the same thread
+		one after another.
+		"""
+		if self.journal:
+			for domain in domains:
+				self.journal.entry(domain).acquire()
+		self.queue.put(tasks)
+	
+	def taskDone(self, domain):
+		"""Mark task for domain taken from queue as finished."""
+		if self.journal:
+			self.journal.entry(domain).release()
+	
+	def hold(self, domain):
+		"""Keep work on domain counted as unfinished by queue.join() and
+		journal after its task was taken and marked done, e.g. while the
+		rest is scheduled for later by the thread. Released by
+		taskDone(domain) and queue.task_done().
+		"""
+		if self.journal:
+			self.journal.entry(domain).acquire()
+		with self.queue.all_tasks_done:
+			self.queue.unfinished_tasks += 1
+	
+	def storageQueue(self, domain, dbQueue):
+		"""Returns queue for storing rows of domain."""
+		if self.journal:
+			return JournalQueue(dbQueue, self.journal.entry(domain))
+		return dbQueue
+	
+	def domainFinished(self):
+		"""Account one domain whose scan was finished in this lane."""
+		with self.lock:
+			self.domains += 1
+	
+	def logStats(self):
+		"""Log throughput of the lane."""
+		duration = time.time() - self.startTime
+		logging.info("%s lane: %d domains in %.2f seconds, %.2f domains/s",
+			self.name.capitalize(), self.domains, duration, self.domains / duration)
+
+
+class RetryQueue(Queue.Queue):
+	"""Queue of deferred retries ordered by time they are due. The get()
+	method blocks until the earliest one is due.
+	"""
+	
+	def _init(self, maxsize):
+		self.queue = []
+		self.sequence = itertools.count() #keeps FIFO order for same due time
+	
+	def _put(self, item):
+		(due, task) = item
+		heapq.heappush(self.queue, (due, self.sequence.next(), task))
+	
+	def _get(self):
+		return heapq.heappop(self.queue)[2]
+	
+	def get(self, block=True, timeout=None):
+		"""Remove and return the earliest task once it's due.
+		@param timeout: if given, Queue.Empty is raised when no task is
+		due within timeout seconds
+		"""
+		endTime = None
+		if timeout is not None:
+			endTime = time.time() + timeout
+		with self.not_empty:
+			while True:
+				now = time.time()
+				if endTime is not None and now >= endTime:
+					raise Queue.Empty
+				
+				wait = None
+				if self._qsize():
+					wait = self.queue[0][0] - now
+					if wait <= 0:
+						task = self._get()
+						self.not_full.notify()
+						return task
+				if endTime is not None:
+					wait = min(wait, endTime - now) if wait is not None else endTime - now
+				
+				self.not_empty.wait(wait)
+
+
+class HostLane(ScanLane):
+	"""Lane of (host, parserClasses) tasks for NS and MX target hosts.
+	Every host is scanned with each parser once per scan, even if it's
+	both NS and MX target. Hosts are added from NS/MX store() that may run
+	in resolver callback of any thread sharing the context, so adding never
+	blocks: tasks not fitting into the bounded queue wait in unbounded
+	overflow list, which host threads move into the queue as it drains.
+	"""
+	
+	def __init__(self, name, maxsize, roleParsers):
+		"""@param roleParsers: dict with parser classes for "ns" and "mx"
+		target hosts
+		"""
+		ScanLane.__init__(self, name, maxsize)
+		self.roleParsers = roleParsers
+		self.seen = set() #(host, parserClass) tuples
+		self.references = 0
+		self.overflow = deque() #tasks waiting for room in queue
+		self.overflowed = 0
+	
+	def addHosts(self, hosts, role):
+		"""Queue hosts with parsers they weren't scanned with yet. Empty
+		names (null MX) are ignored.
+		@param role: "ns" or "mx"
+		"""
+		parserClasses = self.roleParsers[role]
+		tasks = []
+		with self.lock:
+			self.references += len(hosts)
+			for host in set(hosts):
+				if not host:
+					continue
+				newParsers = [parserClass for parserClass in parserClasses
+					if (host, parserClass) not in self.seen]
+				if newParsers:
+					self.seen.update([(host, parserClass) for parserClass in newParsers])
+					tasks.append((host, newParsers))
+			
+			for task in tasks:
+				if not self.overflow:
+					try:
+						self.queue.put_nowait([task])
+						continue
+					except Queue.Full:
+						pass
+				self.overflow.append(task)
+				self.overflowed += 1
+	
+	def refill(self):
+		"""Move overflowed tasks into the queue while there is room, called
+		by host thread after it took a task from the queue.
+		"""
+		with self.lock:
+			while self.overflow:
+				try:
+					self.queue.put_nowait([self.overflow[0]])
+				except Queue.Full:
+					break
+				self.overflow.popleft()
+	
+	def logStats(self):
+		ScanLane.logStats(self)
+		with self.lock:
+			logging.info("%s lane: %d unique hosts of %d references, %d tasks overflowed queue",
+				self.name.capitalize(), len(set([host for (host, parserClass) in self.seen])),
+				self.references, self.overflowed)
+
+
+class RetryLane(ScanLane):
+	"""Lane of (domain, parserClass, attempt, startTime, followUps) tasks
+	for retries of SERVFAILed queries, delayed by exponential backoff.
+	"""
+	
+	def __init__(self, name, backoff, journal=None):
+		"""@param backoff: delay in seconds before first retry, doubled
+		for every further attempt
+		"""
+		ScanLane.__init__(self, name, 0, journal)
+		self.queue = RetryQueue()
+		self.backoff = backoff
+		self.retries = 0
+		self.recovered = 0
+	
+	def defer(self, parser, followUps=()):
+		"""Schedule retry of parser's query.
+		@param followUps: parser classes to scan with after successful retry
+		"""
+		due = time.time() + self.backoff * 2 ** (parser.attempt - 1)
+		if self.journal:
+			self.journal.entry(parser.domain).acquire()
+		self.queue.put((due, [(parser.domain, parser.__class__, parser.attempt, parser.startTime,
+			list(followUps))]))
+	
+	def retryDone(self, recovered):
+		"""Account one retried query.
+		@param recovered: True if the retry didn't end with SERVFAIL or timeout
+		"""
+		with self.lock:
+			self.retries += 1
+			if recovered:
+				self.recovered += 1
+	
+	def logStats(self):
+		ScanLane.logStats(self)
+		logging.info("%s lane: %d retried queries, %d succeeded", self.name.capitalize(),
+			self.retries, self.recovered)
+
+
+class PublicSuffixList(object):
+	"""Rules of public suffix list (publicsuffix.org format) telling under
+	which names domains are registered. Without rules, every TLD is the
+	only public suffix.
+	"""
+	
+	def __init__(self, rules=()):
+		"""@param rules: rules like "co.uk", "*.ck", "!www.ck"; IDN labels
+		are converted to punycode
+		"""
+		self.rules = set()
+		self.wildcards = set() #"ck" for "*.ck"
+		self.exceptions = set() #"www.ck" for "!www.ck"
+		for rule in rules:
+			try:
+				rule = rule.decode("utf-8").encode("idna").lower()
+			except UnicodeError:
+				logging.warn("Skipping public suffix rule %r", rule)
+				continue
+			if rule.startswith("!"):
+				self.exceptions.add(rule[1:])
+			elif rule.startswith("*."):
+				self.wildcards.add(rule[2:])
+			else:
+				self.rules.add(rule)
+	
+	@classmethod
+	def fromFile(cls, filename):
+		"""Read rules from public_suffix_list.dat file."""
+		rules = []
+		for line in file(filename):
+			fields = line.split()
+			if fields and not fields[0].startswith("//"):
+				rules.append(fields[0])
+		return cls(rules)
+	
+	def suffixLength(self, labels):
+		"""Returns number of trailing labels forming the public suffix."""
+		#longest match first; exception is longer than its wildcard
+		for i in range(len(labels)):
+			name = ".".join(labels[i:])
+			if name in self.exceptions:
+				return len(labels) - i - 1
+			if name in self.rules or ".".join(labels[i+1:]) in self.wildcards:
+				return len(labels) - i
+		return 1
+	
+	def registrableParent(self, domain):
+		"""Returns registered domain that domain is under, e.g. example.com
+		for www.example.com, or None if domain is itself registered or a
+		public suffix.
+		"""
+		labels = domain.lower().rstrip(".").split(".")
+		registeredLabels = self.suffixLength(labels) + 1
+		if len(labels) <= registeredLabels:
+			return None
+		return ".".join(labels[-registeredLabels:])
+
+
+class AffinityScheduler(object):
+	"""Scheduling stage between the domain file and fast lane. Domains
+	are buffered in chunks and grouped by nameserver set known from
+	previous scan, or by registered domain they are under. Each group
+	goes as one task list to the lane, so its domains are scanned by the
+	same thread and the delegations, DNSKEYs and NS addresses stay hot in
+	its resolver cache. Registered domains themselves (e.g. second-level
+	names of TLD) are grouped only by known NS, their common parent is a
+	public suffix shared by the whole input.
+	"""
+	
+	def __init__(self, lane, chunkSize, groupSize, previousDb=None, previousPrefix="",
+			suffixes=None):
+		"""@param lane: ScanLane to feed
+		@param chunkSize: number of domains buffered and grouped at once
+		@param groupSize: maximum domains in one task list, bigger groups
+		are split so the load is spread among threads
+		@param previousDb: optional DbPool with schema of previous scan
+		used to look up NS RRs of domains
+		@param previousPrefix: prefix of previous scan's schema
+		@param suffixes: PublicSuffixList, default treats TLDs as the only
+		public suffixes
+		"""
+		self.lane = lane
+		self.chunkSize = chunkSize
+		self.groupSize = groupSize
+		self.previousDb = previousDb
+		self.previousPrefix = previousPrefix
+		self.suffixes = suffixes or PublicSuffixList()
+		self.chunk = []
+	
+	def put(self, domain):
+		"""Add domain to be scheduled."""
+		self.chunk.append(domain)
+		if len(self.chunk) >= self.chunkSize:
+			self.flush()
+	
+	def flush(self):
+		"""Group buffered domains and put the groups to lane."""
+		knownNs = self.knownNameservers(self.chunk)
+		groups = {}
+		
+		for domain in self.chunk:
+			key = self.groupKey(domain, knownNs)
+			if key is None:
+				self.lane.putGroup([domain], [domain])
+			else:
+				groups.setdefault(key, []).append(domain)
+		
+		for key in sorted(groups.keys()):
+			domains = groups[key]
+			for i in range(0, len(domains), self.groupSize):
+				self.lane.putGroup(domains[i:i+self.groupSize], domains[i:i+self.groupSize])
+		
+		self.chunk = []
+	
+	def groupKey(self, domain, knownNs):
+		"""Returns key of affinity group: NS set if known, otherwise
+		registered domain the domain is under; None if domain has no
+		group.
+		"""
+		if domain in knownNs:
+			return "ns:" + ",".join(sorted(knownNs[domain]))
+		parent = self.suffixes.registrableParent(domain)
+		if parent is not None:
+			return "zone:" + parent
+		return None
+	
+	def knownNameservers(self, domains):
+		"""Returns dict mapping domains to set of their nameservers found
+		in previous scan.
+		"""
+		knownNs = {}
+		if self.previousDb is None:
+			return knownNs
+		
+		sql = """SELECT fqdn, nameserver FROM %sns_rr
+			INNER JOIN %sdomains ON (fqdn_id = %sdomains.id)
+			WHERE fqdn = ANY(%%s)""" % ((self.previousPrefix,) * 3)
+		try:
+			cursor = self.previousDb.cursor()
+			cursor.execute(sql, (domains,))
+			for row in cursor.fetchall():
+				knownNs.setdefault(row["fqdn"], set()).add(row["nameserver"])
+			cursor.close()
+		except Exception:
+			logging.exception("Failed to look up nameservers from previous scan")
+		finally:
+			self.previousDb.rollback()
+		
+		return knownNs
 
-class DnsScanThread(threading.Thread):
 
-	def __init__(self, taskQueue, taFile, rrScanners, dbQueue, opts, prefix):
+class DnsScanThread(threading.Thread):
+	
+	pollInterval = 0.1 #seconds to wait for answers before checking pending queries again
+	
+	def __init__(self, lane, resolver, rrScanners, dbQueue, opts, prefix, progress=None, slowLane=None,
+		retryLane=None, rateLimiter=None, gate=None, archive=None, planner=None, negativeCache=None,
+		hostLane=None):
 		"""Create scanning thread.
 		
-		@param taskQueue: Queue.Queue containing domains to scan as strings
-		@param taFile: trust anchor file for libunbound
+		@param lane: ScanLane whose queue contains domains to scan as strings
+		@param resolver: ResolverContext to use, may be shared with other threads
 		@param rrScanners: list of subclasses of RRTypeParser to use for scan.
 		NSParser and DSParser are always on and shouldn't be present in the list.
 		@param dbQueue: Queue.Queue for passing things to store to StorageThread
 		@param opts: instance of DnsConfigOptions
 		@param prefix: prefix of schema
+		@param progress: optional multiprocessing.Value incremented for
+		every scanned domain
+		@param slowLane: optional ScanLane where domains exceeding latency
+		budget after NS/DS queries are moved with their remaining parsers
+		@param retryLane: RetryLane for deferred retries of SERVFAILs,
+		required if opts.retryBackoff is set
+		@param rateLimiter: optional NameserverRateLimiter delaying queries
+		to domain's nameservers
+		@param gate: optional ConcurrencyGate the thread waits on before
+		taking a task
+		@param archive: optional ArchiveWriter for answers
+		@param planner: optional QueryPlanner dropping queries made
+		pointless by NS and DS answers
+		@param negativeCache: optional NegativeCache shared by threads
+		@param hostLane: optional HostLane where NS and MX target hosts
+		are passed for address resolution
 		"""
-		self.taskQueue = taskQueue
+		self.lane = lane
+		self.taskQueue = lane.queue
+		self.resolver = resolver
 		self.rrScanners = rrScanners
 		self.dbQueue = dbQueue
 		self.opts = opts
 		self.prefix = prefix
+		self.progress = progress
+		self.slowLane = slowLane
+		self.retryLane = retryLane
+		self.rateLimiter = rateLimiter
+		self.gate = gate
+		self.archive = archive
+		self.planner = planner
+		self.negativeCache = negativeCache
+		self.hostLane = hostLane
+		self.delayed = [] #heap of throttled (due, sequence, domain, parserClasses, deadline, nameservers)
+		self.sequence = itertools.count()
+		if gate is not None:
+			self.gateSlot = gate.register()
 		
 		threading.Thread.__init__(self)
-		
-		self.resolver = ub_ctx()
-		if opts.forwarder:
-			self.resolver.set_fwd(opts.forwarder)
-		self.resolver.add_ta_file(taFile) #read public keys for DNSSEC verification
 
 	def run(self):
 		while True:
-			domain = self.taskQueue.get()
-			nsRRcount = 0
-			
+			self.runDelayed()
+			#throttled domains are held in the lane until this thread scans
+			#them, so it keeps waking up for them while the gate is closed
+			if self.gate is not None and not self.gate.enter(self.gateSlot, self.delayedWait()):
+				continue
 			try:
-				nsParser = NSParser(domain, self.resolver, self.opts, self.dbQueue, prefix)
-				nsRRcount = nsParser.fetchAndStore()
-				
-				#DS RRs are in parent zone
-				dsParser = DSParser(domain, self.resolver, self.opts, self.dbQueue, prefix)
-				dsParser.fetchAndStore()
+				tasks = self.nextTasks()
+			except Queue.Empty:
+				continue #throttled domain is due
+			
+			for task in tasks:
+				domain = self.taskDomain(task)
+				finished = True
 				
-				#don't scan other RRs dependent on NS if we got SERVFAIL on NS query
-				if nsRRcount >= 0:
-					for parserClass in self.rrScanners:
-						try:
-							parser = parserClass(domain, self.resolver, self.opts, self.dbQueue, prefix)
-							parser.fetchAndStore()
-						except Exception:
-							logging.exception("Failed to scan domain %s with %s",
-								domain, parserClass.__name__)
-				else:
-					logging.info("No NS RRs for %s", domain)
+				try:
+					finished = self.scanTask(task)
+				except:
+					logging.exception("Error scanning %s", domain)
+				finally:
+					if finished:
+						self.domainFinished(domain)
+					self.lane.taskDone(domain)
+			
+			self.taskQueue.task_done()
+	
+	def nextTasks(self):
+		"""Take next task list from the lane, waiting at most until the
+		earliest throttled domain is due.
+		@throws Queue.Empty: if throttled domain got due meanwhile
+		"""
+		if not self.delayed:
+			return self.taskQueue.get()
+		return self.taskQueue.get(True, self.delayedWait())
+	
+	def delayedWait(self):
+		"""Returns seconds until the earliest throttled domain is due,
+		None if there is none.
+		"""
+		if not self.delayed:
+			return None
+		return max(self.delayed[0][0] - time.time(), 0.001)
+	
+	def schedule(self, domain, delay, parserClasses, deadline, nameservers):
+		"""Scan domain with parserClasses after delay instead of sleeping,
+		the thread takes other tasks meanwhile. Domain's work stays
+		unfinished in its lane until then.
+		"""
+		self.lane.hold(domain)
+		heapq.heappush(self.delayed, (time.time() + delay, self.sequence.next(), domain,
+			parserClasses, deadline, nameservers))
+	
+	def runDelayed(self):
+		"""Scan throttled domains that are due."""
+		while self.delayed and self.delayed[0][0] <= time.time():
+			(due, sequence, domain, parserClasses, deadline, nameservers) = heapq.heappop(self.delayed)
+			try:
+				self.scanParsers(domain, parserClasses, deadline, nameservers)
 			except:
-				logging.exception("Error fetching NS RRs for %s", domain)
+				logging.exception("Error scanning %s", domain)
 			finally:
+				self.domainFinished(domain)
+				self.lane.taskDone(domain)
 				self.taskQueue.task_done()
-				logging.info("Finished scanning domain %s", domain)
+	
+	def taskDomain(self, task):
+		"""Returns domain of task from the lane's queue."""
+		return task
+	
+	def scanTask(self, domain):
+		"""Scan domain taken from the task queue.
+		@returns: False if the domain was moved to slow lane, True otherwise
+		"""
+		if self.opts.asyncQueries:
+			return self.scanDomainAsync(domain)
+		else:
+			return self.scanDomain(domain)
+	
+	def domainFinished(self, domain):
+		"""Account finished scan of domain."""
+		logging.info("Finished scanning domain %s", domain)
+		self.lane.domainFinished()
+		if self.progress is not None:
+			with self.progress.get_lock():
+				self.progress.value += 1
+	
+	def domainDeadline(self):
+		"""Returns deadline for domain whose scan starts now, None if unlimited."""
+		if self.opts.domainTimeout:
+			return time.time() + self.opts.domainTimeout
+		return None
+	
+	def overBudget(self, domain, startTime, parserClasses, deadline, nameservers):
+		"""Move domain to slow lane if it exceeded latency budget since
+		startTime.
+		
+		@param parserClasses: parsers yet to be run for the domain
+		@param deadline: domain's deadline, kept in slow lane
+		@param nameservers: domain's NS names for rate limiting in slow lane
+		@returns: True if domain was moved to slow lane
+		"""
+		if self.slowLane is None or time.time() - startTime <= self.opts.slowLaneBudget:
+			return False
+		
+		logging.info("Domain %s over latency budget, moving to %s lane", domain, self.slowLane.name)
+		self.slowLane.put(domain, (domain, parserClasses, deadline, nameservers))
+		return True
+	
+	def throttleDelay(self, domain, nameservers, parserClasses):
+		"""Returns seconds to wait before sending queries of parserClasses
+		to nameservers of domain.
+		"""
+		if self.rateLimiter is None:
+			return 0.0
+		
+		delay = self.rateLimiter.reserve(nameservers, len(parserClasses))
+		if delay > 0:
+			logging.debug("Throttling %s for %.2f s", domain, delay)
+		return delay
+	
+	def scanThrottled(self, domain, nameservers, parserClasses, deadline):
+		"""Scan domain with parsers once its nameservers are within
+		budget: right away, scheduled for later in this thread (one query
+		after another) or with delayed sending (async queries).
+		
+		@returns: False if the scan was scheduled for later
+		"""
+		if self.opts.asyncQueries:
+			delay = self.throttleDelay(domain, nameservers, parserClasses)
+			self.scanParsersAsync(domain, parserClasses, deadline, time.time() + delay)
+			return True
+		
+		#wave of prefixed queries is throttled by scanParsers() when it's sent
+		delay = self.throttleDelay(domain, nameservers, self.splitWave(parserClasses)[0])
+		if delay > 0:
+			self.schedule(domain, delay, parserClasses, deadline, nameservers)
+			return False
+		
+		self.scanParsers(domain, parserClasses, deadline, nameservers)
+		return True
+	
+	def newParser(self, parserClass, domain, deadline):
+		"""Create parser of given class for domain.
+		@param deadline: time after which no queries are sent for domain
+		"""
+		parser = parserClass(domain, self.resolver, self.opts,
+			self.lane.storageQueue(domain, self.dbQueue), self.prefix)
+		parser.deadline = deadline
+		parser.archive = self.archive
+		parser.negativeCache = self.negativeCache
+		parser.hostLane = self.hostLane
+		return parser
+	
+	def scanDomain(self, domain):
+		"""Scan all RR types for domain, one query after another. Once
+		domain's deadline passes, remaining queries are recorded as timed
+		out without being sent.
+		
+		@returns: False if the domain was moved to slow lane or its NS query
+		to retry lane, True otherwise
+		"""
+		startTime = time.time()
+		deadline = self.domainDeadline()
+		nsParser = self.newParser(NSParser, domain, deadline)
+		nsRRcount = nsParser.fetchAndStore()
+		
+		#DS RRs are in parent zone
+		dsParsers = self.scanParsers(domain, [DSParser], deadline)
+		
+		#don't scan other RRs dependent on NS if we got SERVFAIL on NS query
+		if nsParser.deferred:
+			self.retryLane.defer(nsParser, self.rrScanners)
+			return False
+		elif nsRRcount < 0:
+			logging.info("No NS RRs for %s", domain)
+			return True
+		
+		parserClasses = self.planQueries(domain, nsParser, dsParsers and dsParsers[0] or None,
+			self.rrScanners, deadline)
+		if self.overBudget(domain, startTime, parserClasses, deadline, nsParser.nameservers):
+			return False
+		
+		delay = self.throttleDelay(domain, nsParser.nameservers, self.splitWave(parserClasses)[0])
+		if delay > 0:
+			self.schedule(domain, delay, parserClasses, deadline, nsParser.nameservers)
+			return False
+		
+		self.scanParsers(domain, parserClasses, deadline, nsParser.nameservers)
+		return True
+	
+	def splitWave(self, parserClasses):
+		"""Split parsers into ones run one after another and the wave of
+		queries under service prefixes sent at once by scanParsers().
+		@returns: tuple (serial, wave) of parser class lists
+		"""
+		wave = [parserClass for parserClass in parserClasses if parserClass.servicePrefix is not None]
+		if len(wave) < 2:
+			wave = []
+		return ([parserClass for parserClass in parserClasses if parserClass not in wave], wave)
+	
+	def scanParsers(self, domain, parserClasses, deadline, nameservers=None):
+		"""Scan domain with given parsers, one query after another.
+		Queries under service prefixes are sent at once in one wave
+		after the others.
+		
+		@param nameservers: domain's NS names; if given, the wave is
+		rate limited on its own, callers charge only the other queries
+		@returns: list of parsers that were run
+		"""
+		(serial, wave) = self.splitWave(parserClasses)
+		
+		parsers = []
+		for parserClass in serial:
+			try:
+				parser = self.newParser(parserClass, domain, deadline)
+				parsers.append(parser)
+				parser.fetchAndStore()
+				if parser.deferred:
+					self.retryLane.defer(parser)
+			except Exception:
+				logging.exception("Failed to scan domain %s with %s",
+					domain, parserClass.__name__)
+		
+		if wave:
+			sendAt = None
+			if nameservers is not None:
+				sendAt = time.time() + self.throttleDelay(domain, nameservers, wave)
+			parsers.extend(self.scanParsersAsync(domain, wave, deadline, sendAt))
+		
+		return parsers
+	
+	def planQueries(self, domain, nsParser, dsParser, parserClasses, deadline):
+		"""Drop parsers that can't return data given NS and DS answers
+		and record them as skipped.
+		
+		@param dsParser: DSParser after its query or None if unknown
+		@returns: list of parser classes to run
+		"""
+		if self.planner is None:
+			return parserClasses
+		
+		(parserClasses, skipped) = self.planner.plan(nsParser, dsParser, parserClasses)
+		for (parserClass, rule) in skipped:
+			try:
+				self.newParser(parserClass, domain, deadline).storeOutcome("skipped", rule)
+			except Exception:
+				logging.exception("Failed to store skipped %s for %s",
+					parserClass.__name__, domain)
+		
+		return parserClasses
+	
+	def scanDomainAsync(self, domain):
+		"""Scan all RR types for domain with all queries in flight at
+		once. NS and DS queries are sent first, queries for the other RR
+		types are sent as soon as both answers arrive - unless NS answer
+		was a permanent SERVFAIL.
+		
+		@returns: False if the domain was moved to slow lane or its NS query
+		to retry lane, True otherwise
+		"""
+		pending = PendingQueries()
+		startTime = time.time()
+		deadline = self.domainDeadline()
+		movedToSlowLane = []
+		#NS and DS answers as (parser, rrCount), callbacks may run in other threads
+		answers = {}
+		answersLock = threading.Lock()
+		
+		def answerFinished(parser, rrCount):
+			with answersLock:
+				answers[parser.__class__] = (parser, rrCount)
+				if len(answers) < 2:
+					return
+			
+			(nsParser, nsRRcount) = answers[NSParser]
+			#don't scan other RRs dependent on NS if we got SERVFAIL on NS query
+			if nsRRcount < 0:
+				logging.info("No NS RRs for %s", domain)
+				return
+			
+			parserClasses = self.planQueries(domain, nsParser, answers[DSParser][0],
+				self.rrScanners, deadline)
+			if self.overBudget(domain, startTime, parserClasses, deadline, nsParser.nameservers):
+				movedToSlowLane.append(domain)
+			else:
+				#callback may run in other thread's loop, so don't sleep here
+				sendAt = time.time() + self.throttleDelay(domain, nsParser.nameservers, parserClasses)
+				for parserClass in parserClasses:
+					self.sendQuery(self.newParser(parserClass, domain, deadline), pending,
+						sendAt=sendAt)
+		
+		nsParser = self.newParser(NSParser, domain, deadline)
+		self.sendQuery(nsParser, pending, answerFinished, self.rrScanners)
+		#DS RRs are in parent zone
+		self.sendQuery(self.newParser(DSParser, domain, deadline), pending, answerFinished)
+		
+		self.waitForAnswers(pending)
+		
+		return not (movedToSlowLane or nsParser.deferred)
+	
+	def scanParsersAsync(self, domain, parserClasses, deadline, sendAt=None):
+		"""Scan domain with given parsers, all queries in flight at once.
+		@param sendAt: optional time before which queries are not sent
+		@returns: list of parsers that were run
+		"""
+		pending = PendingQueries()
+		parsers = []
+		for parserClass in parserClasses:
+			parser = self.newParser(parserClass, domain, deadline)
+			parsers.append(parser)
+			self.sendQuery(parser, pending, sendAt=sendAt)
+		
+		self.waitForAnswers(pending)
+		return parsers
+	
+	def sendQuery(self, parser, pending, finished=None, followUps=(), sendAt=None):
+		"""Send asynchronous query of parser.
+		
+		@param parser: instance of RRTypeParser subclass
+		@param pending: PendingQueries of the scanned domain
+		@param finished: optional callback(parser, rrCount) called after
+		the answer is stored; for parser without followUps also when the
+		query is deferred or could not be sent (rrCount is -1 then)
+		@param followUps: parser classes dependent on this query, they are
+		passed to retry lane if SERVFAIL answer is deferred
+		@param sendAt: optional time before which the query is not sent,
+		it's sent from waitForAnswers() of the pending queries' owner
+		"""
+		def queryDone(parser, rrCount):
+			#query stays pending until follow-up work is queued, the
+			#thread waiting for it may be other than this one
+			try:
+				if parser.deferred:
+					self.retryLane.defer(parser, followUps)
+				if finished and not (parser.deferred and followUps):
+					finished(parser, rrCount)
+			except Exception:
+				logging.exception("Failed to process answer for %s with %s",
+					parser.domain, parser.__class__.__name__)
+			finally:
+				pending.done(parser)
+		
+		def send():
+			try:
+				cached = parser.fetchAsync(queryDone)
+			except Exception:
+				logging.exception("Failed to scan domain %s with %s",
+					parser.domain, parser.__class__.__name__)
+				queryDone(parser, -1)
+				return
+			
+			#outside of try, exception from queryDone must not finish it twice
+			if cached:
+				queryDone(parser, 0)
+		
+		if sendAt is not None and sendAt > time.time():
+			pending.delay(parser, sendAt, send)
+		else:
+			pending.add(parser)
+			send()
+	
+	def waitForAnswers(self, pending):
+		"""Process answers of asynchronous queries until none is pending.
+		If the resolver is shared, answers to other threads' queries may
+		be processed here as well, their callbacks are self-contained.
+		Queries that passed their deadline are cancelled, delayed queries
+		are sent when due.
+		
+		@param pending: PendingQueries to wait for
+		@throws: DnsError if unbound reports error
+		"""
+		fd = self.resolver.fd()
+		while pending:
+			select.select([fd], [], [], self.pollInterval)
+			status = self.resolver.process()
+			if status != 0:
+				raise DnsError("Processing answers: %s" % ub_strerror(status))
+			
+			now = time.time()
+			for send in pending.due(now):
+				send()
+			for parser in pending.overdue(now):
+				parser.cancelAsync()
+
+
+class SlowLaneThread(DnsScanThread):
+	"""Scan thread finishing domains that exceeded latency budget in the
+	fast lane. Its tasks are (domain, parserClasses, deadline, nameservers)
+	tuples, the deadline is the one domain got in the fast lane.
+	"""
+	
+	def scanTask(self, task):
+		(domain, parserClasses, deadline, nameservers) = task
+		return self.scanThrottled(domain, nameservers, parserClasses, deadline)
+	
+	def taskDomain(self, task):
+		return task[0]
+
+
+class HostThread(DnsScanThread):
+	"""Thread scanning (host, parserClasses) tasks from HostLane, i.e.
+	resolving addresses of NS/MX target hosts and TLSAs of MX hosts.
+	"""
+	
+	def nextTasks(self):
+		tasks = DnsScanThread.nextTasks(self)
+		self.lane.refill()
+		return tasks
+	
+	def scanTask(self, task):
+		(host, parserClasses) = task
+		deadline = self.domainDeadline()
+		#host's zone isn't queried for NS, queries are charged to the host
+		#name; with ns_rate_key = provider it shares bucket of its parent
+		#domain, typically the provider's nameservers
+		return self.scanThrottled(host, [host], parserClasses, deadline)
+	
+	def taskDomain(self, task):
+		return task[0]
+	
+	def domainFinished(self, host):
+		#hosts don't count into progress of scanned domains
+		self.lane.domainFinished()
+
+
+class RetryThread(DnsScanThread):
+	"""Scan thread doing deferred retries of SERVFAILed queries from
+	RetryLane, one query after another. Parsers dependent on the retried
+	query (i.e. all parsers after NS) are run after successful retry.
+	"""
+	
+	def scanTask(self, task):
+		"""@returns: True if retry of NS query finished scan of domain"""
+		(domain, parserClass, attempt, startTime, followUps) = task
+		deadline = self.domainDeadline()
+		
+		parser = self.newParser(parserClass, domain, deadline)
+		parser.attempt = attempt
+		parser.startTime = startTime
+		rrCount = parser.fetchAndStore()
+		self.lane.retryDone(rrCount >= 0)
+		
+		if parser.deferred:
+			self.lane.defer(parser, followUps)
+			return False
+		
+		if followUps:
+			if rrCount >= 0:
+				#DS answer was stored in the first pass, it's not known here
+				followUps = self.planQueries(domain, parser, None, followUps, deadline)
+				delay = self.throttleDelay(domain, parser.nameservers, self.splitWave(followUps)[0])
+				if delay > 0:
+					self.schedule(domain, delay, followUps, deadline, parser.nameservers)
+					return False
+				self.scanParsers(domain, followUps, deadline, parser.nameservers)
+			else:
+				logging.info("No NS RRs for %s", domain)
+		
+		return bool(followUps)
+	
+	def taskDomain(self, task):
+		return task[0]
 
 
 def convertLoglevel(levelString):
@@ -1191,36 +3654,76 @@ class ParserParser(object):
 		"AAAA": 	AAAAParser,
 		"DNSKEY": 	DNSKEYParser,
 		"MX": 		MXParser,
-		"NSEC3PARAM": 	NSEC3PARAMParser,
 		"SOA": 		SOAParser,
 		"SPF": 		SPFParser,
-		"SSHFP": 	SSHFPParser,
 		"TXT": 		TXTParser,
-		"TLSA": 	TLSAParser,
 	}
-	
-	def __init__(self, configLine):
-		"""Parses "parsers" config value"""
+	#DS is scanned always
+	name2class.update((name, parser) for (name, parser) in registryParsers.iteritems()
+		if parser is not DSParser)
+	
+	def __init__(self, configLine, servicePrefixes=None):
+		"""Parses "parsers" config value
+		@param servicePrefixes: dict of RR type name -> list of service
+		prefixes; such type is scanned under each of the prefixes
+		"""
+		if servicePrefixes is None:
+			servicePrefixes = {}
 		strRRs = re.split(r",\s*", configLine)
-		self.parserClasses = [self.name2class[rr] for rr in strRRs]
+		self.parserClasses = []
+		for rr in strRRs:
+			if rr in servicePrefixes:
+				self.parserClasses.extend([prefixedParser(self.name2class[rr], prefix)
+					for prefix in servicePrefixes[rr]])
+			else:
+				self.parserClasses.append(self.name2class[rr])
 		
 
-if __name__ == '__main__':
-	if len(sys.argv) != 3: 
-		print >> sys.stderr, "ERROR: usage: <domain_file> <scraper_config>" 
-		sys.exit(1)
+def readDomains(domainFile, sourceEncoding, workerIndex=0, workerCount=1, skipLines=frozenset()):
+	"""Generator of (lineNo, domain) tuples read from file, one domain
+	per line. IDN domains are punycode-encoded.
+	
+	@param domainFile: file object to read domains from
+	@param sourceEncoding: encoding of the file
+	@param workerIndex: index of worker process reading the file
+	@param workerCount: number of workers the file is split among; every
+	worker gets every workerCount-th line starting at line workerIndex
+	@param skipLines: set or LineBitmap of line numbers to skip (completed in journal)
+	"""
+	for (lineNo, line) in enumerate(domainFile):
+		if lineNo % workerCount != workerIndex or lineNo in skipLines:
+			continue
 		
-	domainFilename = sys.argv[1]
-	domainFile = file(domainFilename)
-	scraperConfig = SafeConfigParser()
-	scraperConfig.read(sys.argv[2])
-	
+		#automatically punycode-encode any IDN domains
+		try:
+			domainEncoded = line.rstrip()
+			domain = domainEncoded.decode(sourceEncoding).encode("idna").rstrip(".").lower()
+		except ValueError: #UnicodeDecodeError etc. are subclasses of ValueError
+			logging.error("Could not decode string '%s' from encoding %s",
+				domainEncoded, sourceEncoding)
+			continue
+		yield (lineNo, domain)
+
+def scanDomains(domainFilename, scraperConfig, workerIndex=0, workerCount=1, progress=None,
+		resume=False):
+	"""Scan domains from file using scan and storage threads configured
+	in scraperConfig. Returns after all results are stored.
+	
+	@param domainFilename: file with domains, one per line
+	@param scraperConfig: instance of RawConfigParser or subclass
+	@param workerIndex: index of this worker process
+	@param workerCount: number of worker processes scanning the file
+	@param progress: optional multiprocessing.Value counting scanned domains
+	@param resume: skip domains recorded as completed in journal
+	@returns: number of domains scanned
+	"""
 	threadCount = scraperConfig.getint("processing", "scan_threads")
 
 	# prefix/schema to use in DB:
 	prefix = ""
 	if scraperConfig.has_option("database", "prefix"):
 		prefix = scraperConfig.get("database", "prefix")
+	InsertStatement.configure(scraperConfig)
 	
 	sourceEncoding = "utf-8"
 	if scraperConfig.has_option("dns", "source_encoding"):
@@ -1236,52 +3739,332 @@ if __name__ == '__main__':
 	storageThreads = scraperConfig.getint("processing", "storage_threads")
 	db = DbPool(scraperConfig, max_connections=storageThreads)
 	
-	logfile = scraperConfig.get("log", "logfile")
-	loglevel = convertLoglevel(scraperConfig.get("log", "loglevel"))
-	if logfile == "-":
-		logging.basicConfig(stream=sys.stderr, level=loglevel,
-			format="%(asctime)s %(levelname)s %(message)s [%(pathname)s:%(lineno)d]")
-	else:
-		logging.basicConfig(filename=logfile, level=loglevel,
-			format="%(asctime)s %(levelname)s %(message)s [%(pathname)s:%(lineno)d]")
+	logging.info("Starting scan of domains in file %s using %d threads (worker %d of %d).",
+		domainFilename, threadCount, workerIndex + 1, workerCount)
+	
+	#journal of completed domains for resuming crashed scan; it's
+	#truncated for new scan in main process before workers are started
+	journal = None
+	completedLines = frozenset()
+	if scraperConfig.has_option("processing", "journal"):
+		journalFilename = scraperConfig.get("processing", "journal")
+		if resume:
+			completedLines = ScanJournal.completedLines(journalFilename, workerIndex, workerCount)
+			logging.info("Resuming scan, skipping %d completed domains", len(completedLines))
+		journal = ScanJournal(journalFilename)
+	
+	fastLane = ScanLane("fast", 5000, journal)
+	#rows are routed to per-thread queues by domain name
+	spillDir = None
+	if scraperConfig.has_option("processing", "storage_spill_dir"):
+		spillDir = scraperConfig.get("processing", "storage_spill_dir")
+	dbQueue = StorageRouter(storageThreads, 500, spillDir)
+	spillWarning = 0
+	if scraperConfig.has_option("processing", "storage_spill_warning"):
+		spillWarning = scraperConfig.getint("processing", "storage_spill_warning")
+	storageLogInterval = 60
+	if scraperConfig.has_option("processing", "storage_log_interval"):
+		storageLogInterval = scraperConfig.getint("processing", "storage_log_interval")
+	if storageLogInterval > 0:
+		monitor = StorageMonitor(dbQueue, storageLogInterval, spillWarning)
+		monitor.setDaemon(True)
+		monitor.start()
+	
+	#optional grouping of domains sharing nameservers/zone to same thread
+	scheduler = None
+	if scraperConfig.has_option("processing", "affinity_chunk") and \
+			scraperConfig.getint("processing", "affinity_chunk") > 0:
+		previousDb = None
+		previousPrefix = ""
+		if scraperConfig.has_option("processing", "affinity_previous_prefix"):
+			previousPrefix = scraperConfig.get("processing", "affinity_previous_prefix")
+			previousDb = DbPool(scraperConfig, max_connections=1)
+		suffixes = None
+		if scraperConfig.has_option("processing", "affinity_suffix_list"):
+			suffixes = PublicSuffixList.fromFile(scraperConfig.get("processing", "affinity_suffix_list"))
+		scheduler = AffinityScheduler(fastLane,
+			scraperConfig.getint("processing", "affinity_chunk"),
+			scraperConfig.getint("processing", "affinity_group_size"),
+			previousDb, previousPrefix, suffixes)
+		logging.info("Using zone-affinity scheduling")
+	
+	parserParser = ParserParser(scraperConfig.get("dns", "rrs"), opts.servicePrefixes)
+	parsers = parserParser.parserClasses
 	
-	logging.info("Unbound version: %s", ub_version())
-	logging.info("Starting scan of domains in file %s using %d threads.", domainFilename, threadCount)
+	#answers may be archived for later replay, optionally without storing
+	archive = None
+	scanQueue = dbQueue
+	if scraperConfig.has_option("processing", "archive"):
+		archive = ArchiveWriter(scraperConfig.get("processing", "archive"), "w%d" % workerIndex)
+		if scraperConfig.has_option("processing", "archive_only") and \
+				scraperConfig.getboolean("processing", "archive_only"):
+			scanQueue = NullQueue()
+		logging.info("Archiving answers to %s", archive.directory)
+	
+	#domains over latency budget are finished in slow lane by its own threads
+	slowLane = None
+	slowThreadCount = 0
+	if opts.slowLaneBudget > 0:
+		slowLane = ScanLane("slow", 0, journal)
+		slowThreadCount = max(threadCount / 4, 1)
+		if scraperConfig.has_option("processing", "slow_lane_threads"):
+			slowThreadCount = scraperConfig.getint("processing", "slow_lane_threads")
+		logging.info("Using slow lane with %d threads for domains over %.2f seconds budget",
+			slowThreadCount, opts.slowLaneBudget)
+	
+	#unique NS/MX target hosts are resolved by host threads
+	hostLane = None
+	hostThreadCount = 0
+	if scraperConfig.has_option("processing", "host_threads"):
+		hostThreadCount = scraperConfig.getint("processing", "host_threads")
+	if hostThreadCount > 0:
+		hostQueueSize = 10000
+		if scraperConfig.has_option("processing", "host_queue_size"):
+			hostQueueSize = scraperConfig.getint("processing", "host_queue_size")
+		hostParsers = [HostAParser, HostAAAAParser]
+		hostLane = HostLane("host", hostQueueSize, {"ns": hostParsers,
+			"mx": hostParsers + [prefixedParser(TLSAParser, servicePrefix)
+			for servicePrefix in opts.mxTlsaPrefixes]})
+		logging.info("Resolving NS/MX target hosts with %d threads", hostThreadCount)
+	
+	#SERVFAILs are retried with backoff by retry threads
+	retryLane = None
+	retryThreadCount = 0
+	if opts.retryBackoff > 0:
+		retryLane = RetryLane("retry", opts.retryBackoff, journal)
+		retryThreadCount = scraperConfig.getint("processing", "retry_threads")
+		logging.info("Using %d retry threads, backoff %.2f seconds", retryThreadCount, opts.retryBackoff)
+	
+	#by default every scan thread gets its own resolver context
+	resolverContexts = threadCount + slowThreadCount + retryThreadCount
+	if scraperConfig.has_option("processing", "resolver_contexts"):
+		resolverContexts = scraperConfig.getint("processing", "resolver_contexts") or resolverContexts
+	resolverPool = ResolverPool(resolverContexts, taFile, opts)
+	logging.info("Using %d resolver contexts", resolverContexts)
+	
+	#host threads don't share contexts with scan threads: NS/MX callback of
+	#scan thread processed by host thread would wait for room in host queue
+	#that only host threads drain
+	hostResolverPool = None
+	if hostThreadCount > 0:
+		hostResolverPool = ResolverPool(min(hostThreadCount, resolverContexts), taFile, opts, "host resolver")
+	
+	#budget per nameserver is for whole scan, split among worker processes
+	rateLimiter = None
+	if opts.nsRateLimit > 0:
+		rateLimiter = NameserverRateLimiter(opts.nsRateLimit / workerCount,
+			max(opts.nsRateBurst / workerCount, 1.0), opts.nsRateKey)
+		logging.info("Limiting queries to %.2f per second per %s", opts.nsRateLimit, opts.nsRateKey)
+	
+	#queries made pointless by NS/DS answers are skipped
+	planner = None
+	if scraperConfig.has_option("processing", "query_plan") and \
+			scraperConfig.get("processing", "query_plan").strip():
+		planner = QueryPlanner(re.split(r",\s*", scraperConfig.get("processing", "query_plan").strip()))
+		logging.info("Query plan rules: %s", ", ".join(planner.ruleNames))
+	
+	#validated NODATA proofs answer later queries without sending them
+	negativeCache = None
+	if opts.negativeCache > 0:
+		negativeCache = NegativeCache(opts.negativeCache)
+		logging.info("Caching up to %d NSEC/NSEC3 records", opts.negativeCache)
+	
+	#optionally only some of fast lane threads are active, set by controller
+	gate = None
+	if scraperConfig.has_option("processing", "adaptive_threads") and \
+			scraperConfig.getboolean("processing", "adaptive_threads"):
+		minThreads = scraperConfig.getint("processing", "min_scan_threads")
+		gate = ConcurrencyGate(minThreads)
+		controller = ConcurrencyController(gate, resolverPool, dbQueue, minThreads, threadCount,
+			scraperConfig.getfloat("processing", "adaptive_interval"),
+			scraperConfig.getfloat("processing", "adaptive_max_latency"),
+			scraperConfig.getfloat("processing", "adaptive_max_servfail_rate"),
+			maxSpilled=spillWarning)
+		controller.setDaemon(True)
+		controller.start()
+		logging.info("Adapting number of active scan threads between %d and %d", minThreads, threadCount)
 	
-	taskQueue = Queue.Queue(5000)
-	dbQueue = Queue.Queue(500)
+	for i in range(threadCount):
+		t = DnsScanThread(fastLane, resolverPool.context(i), parsers, scanQueue, opts, prefix,
+			progress, slowLane, retryLane, rateLimiter, gate, archive, planner,
+			negativeCache, hostLane)
+		t.setDaemon(True)
+		t.start()
 	
-	parserParser = ParserParser(scraperConfig.get("dns", "rrs"))
-	parsers = parserParser.parserClasses
+	for i in range(slowThreadCount):
+		t = SlowLaneThread(slowLane, resolverPool.context(threadCount + i), parsers, scanQueue, opts,
+			prefix, progress, None, retryLane, rateLimiter, None, archive, planner,
+			negativeCache, hostLane)
+		t.setDaemon(True)
+		t.start()
 	
-	for i in range(threadCount):
-		t = DnsScanThread(taskQueue, taFile, parsers, dbQueue, opts, prefix)
+	for i in range(retryThreadCount):
+		t = RetryThread(retryLane, resolverPool.context(threadCount + slowThreadCount + i), parsers,
+			scanQueue, opts, prefix, progress, None, retryLane, rateLimiter, None, archive, planner,
+			negativeCache, hostLane)
+		t.setDaemon(True)
+		t.start()
+	
+	#hosts aren't domains of the journal, so their SERVFAILs are retried
+	#immediately rather than in retry lane
+	hostOpts = copy.copy(opts)
+	hostOpts.retryBackoff = 0
+	for i in range(hostThreadCount):
+		t = HostThread(hostLane, hostResolverPool.context(i),
+			[], scanQueue, hostOpts, prefix, None, None, None, rateLimiter, None,
+			archive, None, negativeCache)
 		t.setDaemon(True)
 		t.start()
 	
+	domainIds = DomainIdCache.fromConfig(scraperConfig)
+	storageThreadList = []
 	for i in range(storageThreads):
-		t = StorageThread(db, dbQueue)
+		t = StorageThread.fromConfig(db, dbQueue.queues[i], scraperConfig, domainIds)
 		t.setDaemon(True)
 		t.start()
+		storageThreadList.append(t)
 	
-	startTime = time.time()
 	domainCount = 0
 	
-	for line in domainFile:
-		#automatically punycode-encode any IDN domains
-		try:
-			domainEncoded = line.rstrip()
-			domain = domainEncoded.decode(sourceEncoding).encode("idna").rstrip(".").lower()
-		except ValueError: #UnicodeDecodeError etc. are subclasses of ValueError
-			logging.error("Could not decode string '%s' from encoding %s",
-				domainEncoded, sourceEncoding)
-			continue
-		taskQueue.put(domain)
+	for (lineNo, domain) in readDomains(file(domainFilename), sourceEncoding,
+			workerIndex, workerCount, completedLines):
+		if journal:
+			journal.start(domain, lineNo)
+		if scheduler:
+			scheduler.put(domain)
+		else:
+			fastLane.put(domain, domain)
 		domainCount += 1
+	
+	if scheduler:
+		scheduler.flush()
 		
-	taskQueue.join()
+	fastLane.queue.join()
+	if slowLane:
+		logging.info("Waiting for slow lane to finish")
+		slowLane.queue.join()
+	if retryLane:
+		logging.info("Waiting for deferred retries to finish")
+		retryLane.queue.join()
+	if hostLane:
+		logging.info("Waiting for host lane to finish")
+		hostLane.queue.join()
+	
+	if archive:
+		archive.close()
 	
 	logging.info("Waiting for storage threads to finish")
 	dbQueue.join()
 	
+	resolverStats = resolverPool.logStats()
+	if hostResolverPool:
+		resolverStats.merge(hostResolverPool.logStats())
+	logging.info("Upstream queries per domain: %.2f",
+		float(resolverStats.upstreamQueries()) / max(domainCount, 1))
+	fastLane.logStats()
+	if slowLane:
+		slowLane.logStats()
+	if retryLane:
+		retryLane.logStats()
+	if hostLane:
+		hostLane.logStats()
+	if rateLimiter:
+		rateLimiter.logStats()
+	if planner:
+		planner.logStats()
+	if negativeCache:
+		negativeCache.logStats()
+	if domainIds:
+		domainIds.logStats()
+	dbQueue.logStats()
+	for t in storageThreadList:
+		t.logStats()
+	
+	return domainCount
+
+def scanWorker(domainFilename, scraperConfig, workerIndex, workerCount, progress, resume):
+	"""Entry point of worker process, see scanDomains()."""
+	try:
+		domainCount = scanDomains(domainFilename, scraperConfig, workerIndex, workerCount, progress,
+			resume)
+		logging.info("Worker %d finished, scanned %d domains", workerIndex + 1, domainCount)
+	except:
+		logging.exception("Worker %d failed", workerIndex + 1)
+		sys.exit(1)
+
+def scanWithWorkers(domainFilename, scraperConfig, workerCount, resume=False, progressInterval=60):
+	"""Split domains from file among worker processes, each running its
+	own scan and storage threads. Progress of all workers is logged every
+	progressInterval seconds.
+	
+	@returns: number of domains scanned by all workers
+	"""
+	progress = multiprocessing.Value("L", 0)
+	workers = []
+	
+	for i in range(workerCount):
+		worker = multiprocessing.Process(target=scanWorker, name="worker-%d" % (i + 1),
+			args=(domainFilename, scraperConfig, i, workerCount, progress, resume))
+		worker.start()
+		workers.append(worker)
+	
+	startTime = time.time()
+	for worker in workers:
+		while worker.is_alive():
+			worker.join(progressInterval)
+			logging.info("Progress: %d domains scanned, %.1f domains/s", progress.value,
+				progress.value / (time.time() - startTime))
+		
+		if worker.exitcode != 0:
+			logging.error("Worker %s exited with code %s", worker.name, worker.exitcode)
+	
+	return progress.value
+	
+
+if __name__ == '__main__':
+	optionParser = OptionParser(usage="%prog [options] <domain_file> <scraper_config>")
+	optionParser.add_option("-w", "--workers", type="int", default=1,
+		help="number of worker processes the domains are split among (default 1)")
+	optionParser.add_option("-r", "--resume", action="store_true", default=False,
+		help="skip domains recorded as completed in journal (processing.journal option)")
+	(options, args) = optionParser.parse_args()
+	
+	if len(args) != 2 or options.workers < 1:
+		optionParser.print_usage(sys.stderr)
+		sys.exit(1)
+		
+	domainFilename = args[0]
+	scraperConfig = SafeConfigParser()
+	scraperConfig.read(args[1])
+	
+	logfile = scraperConfig.get("log", "logfile")
+	loglevel = convertLoglevel(scraperConfig.get("log", "loglevel"))
+	logformat = "%(asctime)s %(levelname)s %(message)s [%(pathname)s:%(lineno)d]"
+	if options.workers > 1:
+		logformat = "%(asctime)s %(levelname)s %(processName)s %(message)s [%(pathname)s:%(lineno)d]"
+	if logfile == "-":
+		logging.basicConfig(stream=sys.stderr, level=loglevel, format=logformat)
+	else:
+		logging.basicConfig(filename=logfile, level=loglevel, format=logformat)
+	
+	logging.info("Unbound version: %s", ub_version())
+	
+	#UNLOGGED staging tables are truncated by DB crash, while the journal
+	#would still mark their domains completed and --resume skip them
+	if scraperConfig.has_option("processing", "journal") and \
+			scraperConfig.has_option("database", "staging") and \
+			scraperConfig.getboolean("database", "staging"):
+		raise ValueError("journal can't be used with staging tables, staged rows don't survive DB crash")
+	
+	#new scan starts new journal, workers only append to it
+	if scraperConfig.has_option("processing", "journal") and not options.resume:
+		ScanJournal(scraperConfig.get("processing", "journal"), truncate=True).file.close()
+	
+	startTime = time.time()
+	
+	if options.workers > 1:
+		domainCount = scanWithWorkers(domainFilename, scraperConfig, options.workers, options.resume)
+	else:
+		domainCount = scanDomains(domainFilename, scraperConfig, resume=options.resume)
+	
 	logging.info("Fetch of dnskeys for %d domains took %.2f seconds", domainCount, time.time() - startTime)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Moves rows of bulk-load scan (database.staging option) from UNLOGGED
+# *_staging tables into final tables of the schema given by config.
+#
+# Every table is finalized by one worker thread: primary key and foreign
+# keys of the final table are dropped, staged rows moved and staging table
+# dropped in one transaction. Then the keys are added back, foreign keys as
+# NOT VALID and validated separately, so no transaction holding lock on the
+# referenced domains table runs longer than a catalog change. Then indices
+# from sql/create_indices_template.sql (and of registry RR types) are built
+# and the table is analyzed. Largest tables are started first.
+#
+#   ./finalize.py [--workers N] dns_scraper.config
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+import Queue
+
+from optparse import OptionParser
+from ConfigParser import SafeConfigParser
+
+from db import DbPool
+import rrtypes
+
+
+STEPS = ("drop_keys", "move", "add_keys", "validate", "indices", "analyze")
+
+#tables with unique index on these columns get only distinct rows
+DISTINCT_ON = {
+	"cname_rr": "fqdn_id, dest",
+	"dname_rr": "fqdn_id, dest",
+}
+
+def schemaName(prefix):
+	"""Returns schema name of table prefix from config."""
+	if not prefix:
+		return "public"
+	if not prefix.endswith("."):
+		raise ValueError("Only prefix naming a schema (with trailing dot) is supported")
+	return prefix[:-1]
+
+def readIndices(schema):
+	"""Returns dict of table -> list of CREATE INDEX statements."""
+	template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql",
+		"create_indices_template.sql")
+	sql = file(template).read().replace("__SCHEMAPLACEHOLDER__", schema)
+	statements = [statement.strip() for statement in sql.split(";")]
+	statements.extend([rrType.indexDdl().strip().rstrip(";") for rrType in rrtypes.registry])
+
+	indices = {}
+	for statement in statements:
+		match = re.search(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+\S+\s+ON\s+(\w+)", statement, re.I)
+		if match:
+			indices.setdefault(match.group(1), []).append(statement)
+	return indices
+
+
+class Finalizer(object):
+	"""Finalizes staged tables of schema by worker threads."""
+
+	def __init__(self, scraperConfig, workerCount):
+		prefix = ""
+		if scraperConfig.has_option("database", "prefix"):
+			prefix = scraperConfig.get("database", "prefix")
+		self.schema = schemaName(prefix)
+		self.workerCount = workerCount
+		self.db = DbPool(scraperConfig, max_connections=workerCount + 1)
+		self.indices = readIndices(self.schema)
+		self.tasks = Queue.Queue()
+		self.stepTimes = dict([(step, 0.0) for step in STEPS])
+		self.failed = []
+		self.lock = threading.Lock()
+
+	def connection(self):
+		"""Returns this thread's connection with search_path set to schema."""
+		conn = self.db.connection()
+		conn.cursor().execute("SET search_path = %s", (self.schema,))
+		conn.commit()
+		return conn
+
+	def stagedTables(self):
+		"""Returns names of final tables having staging table, largest first."""
+		cursor = self.connection().cursor()
+		cursor.execute("""SELECT tablename FROM pg_tables WHERE schemaname = %s
+			AND tablename LIKE '%%\\_staging'
+			ORDER BY pg_relation_size(quote_ident(schemaname) || '.' || quote_ident(tablename)) DESC""",
+			(self.schema,))
+		return [row[0][:-len("_staging")] for row in cursor.fetchall()]
+
+	def step(self, table, step, conn, statements):
+		"""Execute statements of step in one transaction, log and account
+		its duration.
+		"""
+		start = time.time()
+		cursor = conn.cursor()
+		for statement in statements:
+			cursor.execute(statement)
+		conn.commit()
+		duration = time.time() - start
+
+		with self.lock:
+			self.stepTimes[step] += duration
+		logging.info("%s: %s took %.2f s", table, step, duration)
+
+	def finalizeTable(self, conn, table):
+		staging = table + "_staging"
+		cursor = conn.cursor()
+		#primary key first when adding back, foreign keys reference it
+		cursor.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+			WHERE conrelid = %s::regclass AND contype IN ('p', 'f')
+			ORDER BY contype DESC""", (table,))
+		keys = cursor.fetchall()
+
+		columns = "*"
+		if table in DISTINCT_ON:
+			columns = "DISTINCT ON (%s) *" % DISTINCT_ON[table]
+
+		#dropping foreign keys locks referenced table, commit it right away
+		self.step(table, "drop_keys", conn, ["ALTER TABLE %s DROP CONSTRAINT %s" % (table, name)
+			for (name, definition) in reversed(keys)])
+		try:
+			#moving rows is atomic, staging table is kept if it fails
+			self.step(table, "move", conn, ["INSERT INTO %s SELECT %s FROM %s" % (table, columns, staging),
+				"DROP TABLE %s" % staging])
+		except Exception:
+			conn.rollback()
+			#put keys back so that finalize can be run again
+			self.addKeys(conn, table, keys)
+			raise
+
+		self.addKeys(conn, table, keys)
+		self.step(table, "indices", conn, self.indices.get(table, []))
+		self.step(table, "analyze", conn, ["ANALYZE %s" % table])
+
+	def addKeys(self, conn, table, keys):
+		"""Add primary and foreign keys back. Foreign keys are added as NOT
+		VALID and validated in separate transaction, which doesn't block
+		other workers adding keys referencing the same table.
+
+		@param keys: list of (name, definition), primary key first
+		"""
+		foreignKeys = [name for (name, definition) in keys if definition.startswith("FOREIGN KEY")]
+		self.step(table, "add_keys", conn, ["ALTER TABLE %s ADD CONSTRAINT %s %s%s" % (table, name,
+			definition, name in foreignKeys and " NOT VALID" or "") for (name, definition) in keys])
+		self.step(table, "validate", conn, ["ALTER TABLE %s VALIDATE CONSTRAINT %s" % (table, name)
+			for name in foreignKeys])
+
+	def worker(self):
+		conn = self.connection()
+		while True:
+			table = self.tasks.get()
+			try:
+				self.finalizeTable(conn, table)
+			except Exception:
+				conn.rollback()
+				logging.exception("Failed to finalize table %s", table)
+				with self.lock:
+					self.failed.append(table)
+			finally:
+				self.tasks.task_done()
+
+	def run(self):
+		"""Finalize all staged tables.
+		@returns: list of tables that failed
+		"""
+		tables = self.stagedTables()
+		logging.info("Finalizing %d staged tables of schema %s", len(tables), self.schema)
+		for table in tables:
+			self.tasks.put(table)
+
+		for i in range(min(self.workerCount, len(tables))):
+			t = threading.Thread(target=self.worker, name="finalize-%d" % (i + 1))
+			t.setDaemon(True)
+			t.start()
+
+		self.tasks.join()
+		for step in STEPS:
+			logging.info("Step %s: %.2f s summed over tables", step, self.stepTimes[step])
+		return self.failed
+
+
+if __name__ == '__main__':
+	optionParser = OptionParser(usage="%prog [options] <scraper_config>")
+	optionParser.add_option("-w", "--workers", type="int", default=4,
+		help="number of tables finalized in parallel (default 4)")
+	(options, args) = optionParser.parse_args()
+
+	if len(args) != 1 or options.workers < 1:
+		optionParser.print_usage(sys.stderr)
+		sys.exit(1)
+
+	scraperConfig = SafeConfigParser()
+	scraperConfig.read(args[0])
+
+	#progress goes to stderr, it's run by hand after scan
+	logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+		format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+
+	startTime = time.time()
+	failed = Finalizer(scraperConfig, options.workers).run()
+	logging.info("Finalize took %.2f seconds", time.time() - startTime)
+	if failed:
+		logging.error("Tables not finalized: %s", ", ".join(failed))
+		sys.exit(1)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Registry of RR types with plain rdata layout. Each type is declared once
+# as list of fields; rdata decoder, columns for INSERT and table DDL are
+# generated from the declaration. Types needing special handling (RSA key
+# split of DNSKEY, SOA from authority section, ...) keep hand-written
+# parsers in dns_scraper.py.
+#
+# DDL of registry tables is appended to the SQL templates by
+# sql/makePrefix.sh:
+#
+#   python rrtypes.py tables|indices
+
+import sys
+import struct
+
+import wire
+from wire import escapeLabel
+
+
+#field kinds
+U8 = "u8"
+U16 = "u16"
+U32 = "u32"
+NAME = "name" #domain name, compressed only in packet given to decode()
+STRING = "string" #character string prefixed by length byte
+BLOB = "blob" #rest of rdata
+
+FIXED_FORMATS = {U8: "B", U16: "H", U32: "I"}
+
+DEFAULT_SQL_TYPES = {
+	U8:	"SMALLINT",
+	U16:	"INTEGER",
+	U32:	"BIGINT",
+	NAME:	"VARCHAR(255)",
+	STRING:	"BYTEA",
+	BLOB:	"BYTEA",
+}
+
+
+class RdataError(ValueError):
+	"""Rdata doesn't match the declared fields."""
+	pass
+
+
+class Field(object):
+	"""One rdata field stored in its own column."""
+
+	def __init__(self, column, kind, sqlType=None):
+		"""@param column: name of DB column
+		@param kind: one of U8, U16, U32, NAME, STRING, BLOB
+		@param sqlType: SQL type of column, default by kind
+		"""
+		if kind not in DEFAULT_SQL_TYPES:
+			raise ValueError("Unknown field kind %s" % kind)
+
+		self.column = column
+		self.kind = kind
+		self.sqlType = sqlType or DEFAULT_SQL_TYPES[kind]
+
+
+def readName(rdata, pos, packet=None, rdataStart=0):
+	"""Read domain name from rdata. Compressed name can be read only if
+	the packet containing rdata is given.
+	@param packet: whole packet as string the rdata was taken from
+	@param rdataStart: offset of rdata in packet
+	@returns: tuple (name in lowercase without trailing dot, position after name)
+	@throws RdataError: if name is compressed without packet, malformed or
+	runs out of rdata
+	"""
+	if packet is not None:
+		try:
+			(labels, end) = wire.readName(packet, rdataStart + pos)
+		except wire.WireFormatError, e:
+			raise RdataError(str(e))
+		if end - rdataStart > len(rdata):
+			raise RdataError("Name runs out of rdata")
+		return (".".join([escapeLabel(label) for label in labels]).lower(), end - rdataStart)
+
+	labels = []
+	while True:
+		if pos >= len(rdata):
+			raise RdataError("Name runs out of rdata")
+		length = ord(rdata[pos])
+		pos += 1
+		if length == 0:
+			break
+		if length > 63:
+			raise RdataError("Compressed or invalid name in rdata")
+		labels.append(rdata[pos:pos+length])
+		pos += length
+
+	return (".".join([escapeLabel(label) for label in labels]).lower(), pos)
+
+
+class RRType(object):
+	"""Declaration of RR type. Its table has columns secure, fqdn_id, ttl,
+	service_prefix (only for types queried under service prefix) and one
+	column per field. The decoder is compiled from fields: every run of
+	fixed-size integers is unpacked by single precompiled struct.
+	"""
+
+	def __init__(self, name, code, fields, servicePrefix=None, comment=None):
+		"""@param name: mnemonic used in config and for parser class name
+		@param code: RR type number
+		@param fields: list of Field instances in rdata order
+		@param servicePrefix: prefix like "_443._tcp." prepended to the
+		scanned domain in query, None to query the domain itself
+		@param comment: comment of table in DDL
+		"""
+		self.name = name
+		self.code = code
+		self.fields = fields
+		self.servicePrefix = servicePrefix
+		self.comment = comment or "Table for %s records" % name
+		self.table = name.lower() + "_rr"
+
+		columns = ["secure", "fqdn_id", "ttl"]
+		if servicePrefix is not None:
+			columns.append("service_prefix")
+		self.columns = tuple(columns + [field.column for field in fields])
+
+		self.steps = self.compile(fields)
+
+	@staticmethod
+	def compile(fields):
+		"""Returns list of (kind, struct, binary) decoding steps; steps of
+		fixed-size runs have kind None and struct, the others no struct.
+		"""
+		steps = []
+		fixed = []
+		for field in fields:
+			if field.kind in FIXED_FORMATS:
+				fixed.append(FIXED_FORMATS[field.kind])
+				continue
+			if fixed:
+				steps.append((None, struct.Struct("!" + "".join(fixed)), False))
+				fixed = []
+			steps.append((field.kind, None, field.sqlType == "BYTEA"))
+
+		if fixed:
+			steps.append((None, struct.Struct("!" + "".join(fixed)), False))
+
+		return steps
+
+	def decode(self, rdata, packet=None, rdataStart=0):
+		"""Decode rdata in wire format into tuple of field values, binary
+		values are wrapped in buffer for BYTEA columns.
+		@param packet, rdataStart: packet containing rdata and its offset,
+		needed to decompress names (see readName())
+		@throws RdataError: if rdata doesn't match the fields
+		"""
+		values = []
+		pos = 0
+		end = len(rdata)
+		for (kind, unpacker, binary) in self.steps:
+			if unpacker is not None:
+				if pos + unpacker.size > end:
+					raise RdataError("%s rdata too short" % self.name)
+				values.extend(unpacker.unpack_from(rdata, pos))
+				pos += unpacker.size
+				continue
+
+			if kind == NAME:
+				(value, pos) = readName(rdata, pos, packet, rdataStart)
+			elif kind == STRING:
+				if pos >= end or pos + 1 + ord(rdata[pos]) > end:
+					raise RdataError("%s string runs out of rdata" % self.name)
+				value = rdata[pos+1:pos+1+ord(rdata[pos])]
+				pos += 1 + len(value)
+			else: #BLOB
+				value = rdata[pos:]
+				pos = end
+
+			if binary:
+				value = buffer(value)
+			values.append(value)
+
+		if pos != end:
+			raise RdataError("Trailing data in %s rdata" % self.name)
+
+		return tuple(values)
+
+	def tableDdl(self):
+		"""Returns CREATE TABLE statement of the type's table."""
+		columns = ["id SERIAL PRIMARY KEY", "secure validation_result",
+			"fqdn_id INTEGER REFERENCES domains(id)", "ttl INTEGER NOT NULL"]
+		if self.servicePrefix is not None:
+			columns.append("service_prefix VARCHAR(255) NOT NULL")
+		columns.extend(["%s %s NOT NULL" % (field.column, field.sqlType) for field in self.fields])
+
+		return "-- %s\nCREATE TABLE %s (\n%s\n);\n" % (self.comment, self.table,
+			",\n".join(["    " + column for column in columns]))
+
+	def indexDdl(self):
+		"""Returns CREATE INDEX statement of the type's table."""
+		return "CREATE INDEX %s_fqdn_id_idx ON %s (fqdn_id);\n" % (self.table, self.table)
+
+
+DS = RRType("DS", 43, [
+	Field("keytag", U16),
+	Field("algo", U8),
+	Field("digest_type", U8),
+	Field("digest", BLOB),
+])
+
+SSHFP = RRType("SSHFP", 44, [
+	Field("algo", U8),
+	Field("fp_type", U8),
+	Field("fingerprint", BLOB),
+])
+
+NSEC3PARAM = RRType("NSEC3PARAM", 51, [
+	Field("hash_algo", U8),
+	Field("flags", U8),
+	Field("iterations", U16),
+	Field("salt", STRING),
+])
+
+#by default scan for port 443 tcp TLSAs
+TLSA = RRType("TLSA", 52, [
+	Field("cert_usage", U8),
+	Field("selector", U8),
+	Field("matching_type", U8),
+	Field("association", BLOB),
+], servicePrefix="_443._tcp.")
+
+CDS = RRType("CDS", 59, [
+	Field("keytag", U16),
+	Field("algo", U8),
+	Field("digest_type", U8),
+	Field("digest", BLOB),
+], comment="Table for CDS records (child's copy of DS, RFC 7344)")
+
+CDNSKEY = RRType("CDNSKEY", 60, [
+	Field("flags", U16),
+	Field("protocol", U8),
+	Field("algo", U8),
+	Field("public_key", BLOB),
+], comment="Table for CDNSKEY records (child's copy of DNSKEY, RFC 7344)")
+
+SRV = RRType("SRV", 33, [
+	Field("priority", U16),
+	Field("weight", U16),
+	Field("port", U16),
+	Field("target", NAME),
+], servicePrefix="_sip._tcp.")
+
+CAA = RRType("CAA", 257, [
+	Field("flags", U8),
+	Field("tag", STRING, "VARCHAR(255)"),
+	Field("value", BLOB),
+])
+
+HTTPS = RRType("HTTPS", 65, [
+	Field("priority", U16),
+	Field("target", NAME),
+	Field("params", BLOB), #SvcParams in wire format
+])
+
+#all declared types, in order of DDL
+registry = [DS, SSHFP, NSEC3PARAM, TLSA, CDS, CDNSKEY, SRV, CAA, HTTPS]
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2 or sys.argv[1] not in ("tables", "indices"):
+		print >> sys.stderr, "Usage: rrtypes.py tables|indices"
+		sys.exit(1)
+
+	for rrType in registry:
+		if sys.argv[1] == "tables":
+			print rrType.tableDdl()
+		else:
+			sys.stdout.write(rrType.indexDdl())
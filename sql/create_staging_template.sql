@@ -0,0 +1,20 @@
+-- __SCHEMAPLACEHOLDER__ will be replaced by sed for actual schema name
+-- Run after tables are created. For bulk load (database.staging option) every
+-- table except domains gets UNLOGGED copy with _staging suffix, without
+-- primary key, foreign keys, indices and rules; ids are still drawn from
+-- sequences of the final tables. finalize.py moves rows into final tables.
+SET search_path = __SCHEMAPLACEHOLDER__;
+
+DO $$
+DECLARE
+	t RECORD;
+BEGIN
+    FOR t IN SELECT tablename FROM pg_tables
+	    WHERE schemaname = '__SCHEMAPLACEHOLDER__' AND tablename <> 'domains'
+	    AND tablename NOT LIKE '%\_staging' LOOP
+	EXECUTE format('DROP TABLE IF EXISTS %I', t.tablename || '_staging');
+	EXECUTE format('CREATE UNLOGGED TABLE %I (LIKE %I INCLUDING DEFAULTS)',
+	    t.tablename || '_staging', t.tablename);
+    END LOOP;
+END;
+$$;
@@ -6,6 +6,8 @@ SET search_path = __SCHEMAPLACEHOLDER__;
 
 DROP TYPE  IF EXISTS validation_result;
 CREATE TYPE validation_result AS ENUM ('insecure', 'secure', 'bogus');
+DROP TYPE  IF EXISTS query_outcome_kind;
+CREATE TYPE query_outcome_kind AS ENUM ('servfail', 'timeout', 'retried', 'skipped', 'negative_cache');
 
 --CREATE LANGUAGE plpgsql;
 --CREATE LANGUAGE plpythonu;
@@ -30,6 +32,59 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Returns true if raw NSEC/NSEC3 type bitmap (RFC 4034 window format) covers
+-- given RR type, e.g.:
+-- -- SELECT owner FROM nsec_rr WHERE bitmap_covers(type_bitmap_raw, 43);
+CREATE FUNCTION bitmap_covers(bitmap BYTEA, covered_type INTEGER) RETURNS BOOLEAN AS
+$$
+DECLARE
+	pos INTEGER := 0;
+	window_len INTEGER;
+	byte_pos INTEGER;
+BEGIN
+    WHILE pos + 1 < length(bitmap) LOOP
+	window_len := get_byte(bitmap, pos + 1);
+	IF get_byte(bitmap, pos) = covered_type >> 8 THEN
+	    byte_pos := (covered_type & 255) >> 3;
+	    IF byte_pos >= window_len OR pos + 2 + byte_pos >= length(bitmap) THEN
+		RETURN FALSE;
+	    END IF;
+	    RETURN get_byte(bitmap, pos + 2 + byte_pos) & (128 >> (covered_type & 7)) <> 0;
+	END IF;
+	pos := pos + 2 + window_len;
+    END LOOP;
+    RETURN FALSE;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+-- Decodes raw NSEC/NSEC3 type bitmap into array of covered RR types, same as
+-- type_bitmap column in default mode
+CREATE FUNCTION bitmap_types(bitmap BYTEA) RETURNS INTEGER[] AS
+$$
+DECLARE
+	pos INTEGER := 0;
+	window_base INTEGER;
+	window_len INTEGER;
+	value INTEGER;
+	types INTEGER[] := '{}';
+BEGIN
+    WHILE pos + 1 < length(bitmap) LOOP
+	window_base := get_byte(bitmap, pos) << 8;
+	window_len := get_byte(bitmap, pos + 1);
+	FOR i IN 0 .. LEAST(window_len, length(bitmap) - pos - 2) - 1 LOOP
+	    value := get_byte(bitmap, pos + 2 + i);
+	    FOR bit IN 0 .. 7 LOOP
+		IF value & (128 >> bit) <> 0 THEN
+		    types := types || (window_base + (i << 3) + bit);
+		END IF;
+	    END LOOP;
+	END LOOP;
+	pos := pos + 2 + window_len;
+    END LOOP;
+    RETURN types;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
 -- Only superuser may use create functions plpythonu language.
 -- If you create this function e.g. as postgres user, then example usage is:
 -- -- SELECT aa_rr.id, pyidn_decode(fqdn), secure, ttl, addr FROM aa_rr INNER JOIN domains ON (fqdn_id = domains.id);
@@ -40,6 +95,22 @@ $$ LANGUAGE plpgsql;
 --	return punycode_domain.decode('idna').encode('utf-8');
 --$$ LANGUAGE plpythonu;
 
+-- Queries that did not end with usable answer on first attempt: permanent
+-- SERVFAIL, dropped after per-query/per-domain deadline or answered only after
+-- retries of SERVFAIL; queries skipped by query planner are listed with the
+-- rule that made them pointless, queries answered from negative cache with
+-- kind of proving record (nsec, nsec3)
+CREATE TABLE query_outcome (
+    id SERIAL PRIMARY KEY,
+    fqdn_id INTEGER REFERENCES domains(id),
+    service_prefix VARCHAR(255), -- prefix of queried name like TLSA's _443._tcp.
+    rr_type INTEGER NOT NULL,
+    outcome query_outcome_kind NOT NULL,
+    reason VARCHAR(64), -- planner rule or negative cache proof
+    attempts SMALLINT NOT NULL,
+    duration REAL -- seconds spent on the query including retries, NULL if skipped
+);
+
 -- Table for RRSIGs
 CREATE TABLE rrsig_rr (
     id SERIAL PRIMARY KEY,
@@ -65,6 +136,15 @@ CREATE TABLE aa_rr (
     addr INET NOT NULL
 );
 
+-- Addresses of NS and MX target hosts, resolved once per scan by host lane
+CREATE TABLE host_addr (
+    id SERIAL PRIMARY KEY,
+    secure validation_result,
+    fqdn_id INTEGER REFERENCES domains(id), -- the host
+    ttl INTEGER NOT NULL,
+    addr INET NOT NULL
+);
+
 -- Table for DNSKEY
 CREATE TABLE dnskey_rr (
     id SERIAL PRIMARY KEY,
@@ -89,7 +169,9 @@ CREATE TABLE nsec_rr (
     ttl INTEGER NOT NULL,
     rcode SMALLINT NOT NULL,
     next_domain VARCHAR(255) NOT NULL,
-    type_bitmap INTEGER[] NOT NULL
+    type_bitmap INTEGER[], -- covered RR types, unless raw bitmap is stored
+    type_bitmap_raw BYTEA, -- raw window bitmap with database.nsec_bitmap = bytea
+    CHECK (type_bitmap IS NOT NULL OR type_bitmap_raw IS NOT NULL)
 );
 
 -- Table for NSEC3 records
@@ -106,7 +188,9 @@ CREATE TABLE nsec3_rr (
     iterations INTEGER NOT NULL,
     salt BYTEA NOT NULL,
     next_owner VARCHAR(255) NOT NULL,
-    type_bitmap INTEGER[] NOT NULL
+    type_bitmap INTEGER[], -- covered RR types, unless raw bitmap is stored
+    type_bitmap_raw BYTEA, -- raw window bitmap with database.nsec_bitmap = bytea
+    CHECK (type_bitmap IS NOT NULL OR type_bitmap_raw IS NOT NULL)
 );
 
 -- Table for NS records
@@ -118,18 +202,6 @@ CREATE TABLE ns_rr (
     nameserver VARCHAR(255) NOT NULL
 );
 
--- Table for DS records
-CREATE TABLE ds_rr (
-    id SERIAL PRIMARY KEY,
-    secure validation_result,
-    fqdn_id INTEGER REFERENCES domains(id),
-    ttl INTEGER NOT NULL,
-    keytag INTEGER NOT NULL,
-    algo SMALLINT NOT NULL,
-    digest_type SMALLINT NOT NULL,
-    digest BYTEA NOT NULL
-);
-
 -- Table for SOA records
 CREATE TABLE soa_rr (
     id SERIAL PRIMARY KEY,
@@ -147,17 +219,6 @@ CREATE TABLE soa_rr (
     minimum BIGINT NOT NULL
 );
 
--- Table for SSHFP records
-CREATE TABLE sshfp_rr (
-    id SERIAL PRIMARY KEY,
-    secure validation_result,
-    fqdn_id INTEGER REFERENCES domains(id),
-    ttl INTEGER NOT NULL,
-    algo SMALLINT NOT NULL,
-    fp_type SMALLINT NOT NULL,
-    fingerprint BYTEA NOT NULL
-);
-
 -- Table for TXT records
 CREATE TABLE txt_rr (
     id SERIAL PRIMARY KEY,
@@ -176,18 +237,6 @@ CREATE TABLE spf_rr (
     value BYTEA NOT NULL
 );
 
--- Table for NSEC3PARAM records
-CREATE TABLE nsec3param_rr (
-    id SERIAL PRIMARY KEY,
-    secure validation_result,
-    fqdn_id INTEGER REFERENCES domains(id),
-    ttl INTEGER NOT NULL,
-    hash_algo SMALLINT NOT NULL,
-    flags SMALLINT NOT NULL,
-    iterations INTEGER NOT NULL,
-    salt BYTEA NOT NULL
-);
-
 -- Table for MX records
 CREATE TABLE mx_rr (
     id SERIAL PRIMARY KEY,
@@ -216,18 +265,8 @@ CREATE TABLE dname_rr (
     dest VARCHAR(255) NOT NULL
 );
 
--- Table for DNAME records
-CREATE TABLE tlsa_rr (
-    id SERIAL PRIMARY KEY,
-    secure validation_result,
-    fqdn_id INTEGER REFERENCES domains(id),
-    ttl INTEGER NOT NULL,
-    service_prefix VARCHAR(255) NOT NULL,
-    cert_usage SMALLINT NOT NULL,
-    selector SMALLINT NOT NULL,
-    matching_type SMALLINT NOT NULL,
-    association BYTEA NOT NULL
-);
+-- tables of RR types declared in rrtypes.py (DS, SSHFP, NSEC3PARAM, TLSA, ...)
+-- are appended by makePrefix.sh
 
 -- due to fastflux DNS, CNAME/DNAME destination can change
 CREATE UNIQUE INDEX cname_rr_fqdn_id_dest_idx ON cname_rr(fqdn_id, dest);
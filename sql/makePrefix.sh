@@ -1,7 +1,8 @@
 #!/bin/bash
 if [ -z "$1" ]; then
-    echo "Usage: makePrefix.sh schema_name [tables|indices]"
-    echo "Prints out SQL for creation of schema and tables (or indices)"
+    echo "Usage: makePrefix.sh schema_name [tables|indices|staging]"
+    echo "Prints out SQL for creation of schema and tables (or indices, or"
+    echo "staging tables for bulk load)"
     echo "When second argument is empty, it defaults to generate SQL for tables."
     exit 1
 fi
@@ -12,10 +13,15 @@ if [ -n "$2" ]; then
     WHAT="$2"
 fi
 
-if [  "$WHAT" '!=' "tables" -a "$WHAT" '!=' "indices" ]; then
+if [  "$WHAT" '!=' "tables" -a "$WHAT" '!=' "indices" -a "$WHAT" '!=' "staging" ]; then
     echo "Invalid argument - $WHAT"
     exit 2
 fi
 
 sed s/__SCHEMAPLACEHOLDER__/"$1"/g "${0%%/*}/create_${WHAT}_template.sql"
 
+#tables of RR types declared in the registry, staging copies them from pg_tables
+if [ "$WHAT" '!=' "staging" ]; then
+    python "${0%%/*}/../rrtypes.py" "$WHAT"
+fi
+
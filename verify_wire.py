@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Differential check of wire.WirePacket parser against ldns on a corpus of
+# recorded answer packets (one hex-encoded packet per line).
+#
+# Record answers for all RR types selected in config:
+#   verify_wire.py record domains dns_scraper.config corpus
+# Compare both parsers on recorded answers, corpus/wire_packets.hex (recorded
+# by 'make verify_wire') is used if no corpus is given:
+#   verify_wire.py check [corpus]
+# Passed check of corpus/wire_packets.hex is stamped, packet_parser = wire
+# is refused without the stamp or after wire.py or the corpus changed.
+
+import os
+import sys
+from binascii import hexlify, unhexlify
+from ConfigParser import SafeConfigParser
+
+import ldns
+
+from dns_scraper import DnsConfigOptions, ResolverContext, ParserParser, \
+	NSParser, DSParser, readDomains, getRdfData
+from wire import WirePacket, WireFormatError, comparePackets, stampVerified, DEFAULT_CORPUS
+
+
+def record(domainFilename, configFilename, corpusFilename):
+	scraperConfig = SafeConfigParser()
+	scraperConfig.read(configFilename)
+	#answers are only recorded, packet_parser = wire isn't verified yet
+	scraperConfig.remove_option("dns", "packet_parser")
+	opts = DnsConfigOptions(scraperConfig)
+	resolver = ResolverContext(scraperConfig.get("dns", "ta_file"), opts)
+	parsers = [NSParser, DSParser] + ParserParser(scraperConfig.get("dns", "rrs")).parserClasses
+	
+	sourceEncoding = "utf-8"
+	if scraperConfig.has_option("dns", "source_encoding"):
+		sourceEncoding = scraperConfig.get("dns", "source_encoding")
+	
+	corpus = file(corpusFilename, "a")
+	count = 0
+	for (lineNo, domain) in readDomains(file(domainFilename), sourceEncoding):
+		for parserClass in parsers:
+			name = parserClass(domain, resolver, opts, None, "").queryName()
+			(status, result) = resolver.resolve(name, parserClass.rrType, parserClass.rrClass)
+			if status == 0 and result.packet:
+				corpus.write(hexlify(result.packet) + "\n")
+				count += 1
+	
+	corpus.close()
+	print "Recorded %d packets" % count
+
+def check(corpusFilename):
+	packets = 0
+	failures = 0
+	for (lineNo, line) in enumerate(file(corpusFilename)):
+		data = unhexlify(line.strip())
+		status, pkt = ldns.ldns_wire2pkt(data)
+		if status != 0:
+			continue #ldns can't parse it either
+		
+		packets += 1
+		try:
+			diffs = comparePackets(pkt, WirePacket(data), getRdfData)
+		except WireFormatError, e:
+			diffs = ["wire parser failed: %s" % e]
+		
+		if diffs:
+			failures += 1
+			print "Packet on line %d:" % (lineNo + 1)
+			for diff in diffs:
+				print "\t" + diff
+	
+	print "%d of %d packets differ" % (failures, packets)
+	if failures == 0 and packets > 0 and os.path.abspath(corpusFilename) == DEFAULT_CORPUS:
+		stampVerified(corpusFilename)
+		print "Wire parser verified, packet_parser = wire can be used"
+	return failures == 0
+
+
+if __name__ == '__main__':
+	if len(sys.argv) == 5 and sys.argv[1] == "record":
+		record(*sys.argv[2:])
+	elif len(sys.argv) in (2, 3) and sys.argv[1] == "check":
+		corpusFilename = len(sys.argv) == 3 and sys.argv[2] or DEFAULT_CORPUS
+		sys.exit(0 if check(corpusFilename) else 1)
+	else:
+		print >> sys.stderr, "Usage: verify_wire.py record domains dns_scraper.config corpus"
+		print >> sys.stderr, "       verify_wire.py check [corpus]"
+		sys.exit(1)
@@ -0,0 +1,523 @@
+#   This file is part of DNS Scraper
+#
+#   Copyright (C) 2012 Ondrej Mikle, CZ.NIC Labs
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parser of DNS response packets in wire format. It walks the packet once
+# and offers the subset of ldns_pkt/ldns_rr/ldns_rdf API used by scraper's
+# parsers, without constructing ldns objects. RDFs are split the same way
+# ldns splits them, so the parsers don't need to know which one they got.
+
+import os
+import re
+import hashlib
+import struct
+import socket
+import string
+import base64
+from binascii import hexlify
+
+#same values as ldns_pkt_section
+SECTION_QUESTION = 0
+SECTION_ANSWER = 1
+SECTION_AUTHORITY = 2
+SECTION_ADDITIONAL = 3
+
+#RDF kinds
+RDF_INT8 = "int8"
+RDF_INT16 = "int16"
+RDF_INT32 = "int32"
+RDF_DNAME = "dname"
+RDF_STR = "str" #character string prefixed by length byte
+RDF_A = "a"
+RDF_AAAA = "aaaa"
+RDF_B32 = "b32" #NSEC3 next hashed owner, prefixed by length byte
+RDF_NSEC3_SALT = "salt" #NSEC3/NSEC3PARAM salt, prefixed by length byte
+RDF_B64 = "b64" #rest of rdata
+RDF_HEX = "hex" #rest of rdata
+RDF_BITMAP = "bitmap" #NSEC/NSEC3 type bitmap, rest of rdata
+RDF_UNKNOWN = "unknown" #whole rdata of type ldns doesn't know
+
+#kinds whose str() is used by parsers and must match ldns presentation format
+TEXT_RDF_KINDS = frozenset([RDF_DNAME, RDF_STR, RDF_A, RDF_AAAA, RDF_B32, RDF_NSEC3_SALT])
+
+#RDF layout per RR type; RDF_STR as only field means repeated strings (TXT)
+RDF_LAYOUTS = {
+	1:  (RDF_A,), #A
+	2:  (RDF_DNAME,), #NS
+	5:  (RDF_DNAME,), #CNAME
+	6:  (RDF_DNAME, RDF_DNAME, RDF_INT32, RDF_INT32, RDF_INT32, RDF_INT32, RDF_INT32), #SOA
+	15: (RDF_INT16, RDF_DNAME), #MX
+	16: (RDF_STR,), #TXT
+	28: (RDF_AAAA,), #AAAA
+	39: (RDF_DNAME,), #DNAME
+	43: (RDF_INT16, RDF_INT8, RDF_INT8, RDF_HEX), #DS
+	44: (RDF_INT8, RDF_INT8, RDF_HEX), #SSHFP
+	46: (RDF_INT16, RDF_INT8, RDF_INT8, RDF_INT32, RDF_INT32, RDF_INT32,
+		RDF_INT16, RDF_DNAME, RDF_B64), #RRSIG
+	47: (RDF_DNAME, RDF_BITMAP), #NSEC
+	48: (RDF_INT16, RDF_INT8, RDF_INT8, RDF_B64), #DNSKEY
+	50: (RDF_INT8, RDF_INT8, RDF_INT16, RDF_NSEC3_SALT, RDF_B32, RDF_BITMAP), #NSEC3
+	51: (RDF_INT8, RDF_INT8, RDF_INT16, RDF_NSEC3_SALT), #NSEC3PARAM
+	99: (RDF_STR,), #SPF
+}
+
+TYPE_NAMES = {
+	1: "A", 2: "NS", 5: "CNAME", 6: "SOA", 15: "MX", 16: "TXT", 28: "AAAA",
+	39: "DNAME", 41: "OPT", 43: "DS", 44: "SSHFP", 46: "RRSIG", 47: "NSEC",
+	48: "DNSKEY", 50: "NSEC3", 51: "NSEC3PARAM", 52: "TLSA", 99: "SPF",
+}
+
+FIXED_SIZES = {RDF_INT8: 1, RDF_INT16: 2, RDF_INT32: 4, RDF_A: 4, RDF_AAAA: 16}
+
+#recorded corpus of answers and stamp written when wire parser matched ldns
+#on it (verify_wire.py check), packet_parser = wire requires a valid stamp
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "wire_packets.hex")
+VERIFIED_STAMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "wire_packets.verified")
+
+maxPointers = 64 #more compression pointers in one name mean a loop
+
+headerStruct = struct.Struct("!HHHHHH")
+rrHeaderStruct = struct.Struct("!HHIH")
+
+#characters ldns escapes in names and strings
+needsEscapeRe = re.compile(r'[^\x21-\x7e]|[.;()\\]')
+strNeedsEscapeRe = re.compile(r'[^\x20-\x7e\t]|["\\]')
+base32HexTable = string.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567",
+	"0123456789abcdefghijklmnopqrstuv")
+
+
+class WireFormatError(Exception):
+	"""Malformed packet"""
+	pass
+
+
+def escapeLabel(label):
+	"""Label in presentation format like ldns_rdf2buffer_str_dname()."""
+	if not needsEscapeRe.search(label):
+		return label
+
+	chars = []
+	for c in label:
+		if c in ".;()\\":
+			chars.append("\\" + c)
+		elif not "\x21" <= c <= "\x7e":
+			chars.append("\\%03d" % ord(c))
+		else:
+			chars.append(c)
+	return "".join(chars)
+
+def escapeString(s):
+	"""Character string in presentation format like ldns_rdf2buffer_str_str()."""
+	if not strNeedsEscapeRe.search(s):
+		return '"%s"' % s
+
+	chars = []
+	for c in s:
+		if c in '"\\':
+			chars.append("\\" + c)
+		elif "\x20" <= c <= "\x7e" or c == "\t":
+			chars.append(c)
+		else:
+			chars.append("\\%03d" % ord(c))
+	return '"%s"' % "".join(chars)
+
+def readName(packet, offset):
+	"""Read possibly compressed domain name.
+
+	@param packet: whole packet as string, pointers are relative to it
+	@param offset: where the name starts
+	@returns: tuple (list of labels, offset after the name)
+	@throws WireFormatError: on malformed name
+	"""
+	labels = []
+	end = None
+	pointers = 0
+	packetLen = len(packet)
+
+	while True:
+		if offset >= packetLen:
+			raise WireFormatError("Name runs out of packet")
+		length = ord(packet[offset])
+
+		if length == 0:
+			offset += 1
+			break
+		elif length & 0xC0 == 0xC0:
+			if offset + 1 >= packetLen:
+				raise WireFormatError("Truncated compression pointer")
+			if end is None:
+				end = offset + 2
+			pointers += 1
+			if pointers > maxPointers:
+				raise WireFormatError("Compression pointer loop")
+			offset = ((length & 0x3F) << 8) | ord(packet[offset+1])
+		elif length & 0xC0:
+			raise WireFormatError("Unsupported label type 0x%02x" % length)
+		else:
+			if offset + 1 + length > packetLen:
+				raise WireFormatError("Label runs out of packet")
+			labels.append(packet[offset+1:offset+1+length])
+			offset += 1 + length
+
+	return (labels, end if end is not None else offset)
+
+
+class WireRdf(object):
+	"""One RDF of RR. Data are in canonical form like from getRdfData()
+	on ldns_rdf (domain names uncompressed and lowercased).
+	"""
+
+	__slots__ = ("kind", "data", "labels")
+
+	def __init__(self, kind, data, labels=None):
+		self.kind = kind
+		self.data = data
+		self.labels = labels #only for RDF_DNAME
+
+	@staticmethod
+	def fromLabels(labels):
+		data = "".join([chr(len(label)) + label.lower() for label in labels]) + "\0"
+		return WireRdf(RDF_DNAME, data, labels)
+
+	def size(self):
+		return len(self.data)
+
+	def __str__(self):
+		kind = self.kind
+		if kind == RDF_DNAME:
+			if not self.labels:
+				return "."
+			return "".join([escapeLabel(label) + "." for label in self.labels])
+		elif kind == RDF_STR:
+			return escapeString(self.data[1:])
+		elif kind == RDF_A:
+			return socket.inet_ntoa(self.data)
+		elif kind == RDF_AAAA:
+			return socket.inet_ntop(socket.AF_INET6, self.data)
+		elif kind == RDF_NSEC3_SALT:
+			#like ldns_rdf2buffer_str_nsec3_salt(), "-" for empty salt
+			return hexlify(self.data[1:]) or "-"
+		elif kind == RDF_B32:
+			return base64.b32encode(self.data[1:]).translate(base32HexTable).rstrip("=")
+		elif kind == RDF_B64:
+			return base64.b64encode(self.data)
+		elif kind in FIXED_SIZES:
+			return str(struct.unpack("!" + {1: "B", 2: "H", 4: "I"}[len(self.data)], self.data)[0])
+		else:
+			return hexlify(self.data).upper()
+
+
+class WireRR(object):
+	"""RR parsed from packet, RDFs are split lazily on first access."""
+
+	__slots__ = ("packet", "ownerLabels", "rrType", "rrClass", "ttlValue",
+		"rdataStart", "rdataEnd", "rdfList")
+
+	def __init__(self, packet, ownerLabels, rrType, rrClass, ttl, rdataStart, rdataEnd):
+		self.packet = packet
+		self.ownerLabels = ownerLabels
+		self.rrType = rrType
+		self.rrClass = rrClass
+		self.ttlValue = ttl
+		self.rdataStart = rdataStart
+		self.rdataEnd = rdataEnd
+		self.rdfList = None
+
+	def owner(self):
+		return WireRdf.fromLabels(self.ownerLabels)
+
+	def ttl(self):
+		return self.ttlValue
+
+	def get_type(self):
+		return self.rrType
+
+	def get_type_str(self):
+		return TYPE_NAMES.get(self.rrType, "TYPE%d" % self.rrType)
+
+	def rd_count(self):
+		return len(self.rdfs())
+
+	def rdata(self):
+		"""Returns raw rdata, names in it may be compressed for types
+		that allow it (NS, MX, SOA, ...).
+		"""
+		return self.packet[self.rdataStart:self.rdataEnd]
+
+	def rdf(self, index):
+		"""Returns index-th RDF or None like ldns_rr.rdf()"""
+		rdfs = self.rdfs()
+		if index < len(rdfs):
+			return rdfs[index]
+		return None
+
+	def rdfs(self):
+		if self.rdfList is None:
+			self.rdfList = self.splitRdata()
+		return self.rdfList
+
+	def splitRdata(self):
+		"""Split rdata into RDFs according to RDF_LAYOUTS.
+		@throws WireFormatError: if rdata doesn't match the layout
+		"""
+		packet = self.packet
+		pos = self.rdataStart
+		end = self.rdataEnd
+		layout = RDF_LAYOUTS.get(self.rrType)
+
+		if layout is None:
+			return end > pos and [WireRdf(RDF_UNKNOWN, packet[pos:end])] or []
+
+		if layout == (RDF_STR,): #TXT-like, one RDF per character string
+			rdfs = []
+			while pos < end:
+				strEnd = pos + 1 + ord(packet[pos])
+				if strEnd > end:
+					raise WireFormatError("String runs out of rdata")
+				rdfs.append(WireRdf(RDF_STR, packet[pos:strEnd]))
+				pos = strEnd
+			return rdfs
+
+		rdfs = []
+		for kind in layout:
+			if pos >= end:
+				break #trailing RDFs missing, e.g. NSEC3 without bitmap
+
+			if kind in FIXED_SIZES:
+				rdfEnd = pos + FIXED_SIZES[kind]
+				rdf = WireRdf(kind, packet[pos:rdfEnd])
+			elif kind == RDF_DNAME:
+				(labels, rdfEnd) = readName(packet, pos)
+				rdf = WireRdf.fromLabels(labels)
+			elif kind in (RDF_STR, RDF_B32, RDF_NSEC3_SALT):
+				rdfEnd = pos + 1 + ord(packet[pos])
+				rdf = WireRdf(kind, packet[pos:rdfEnd])
+			else: #rest of rdata
+				rdfEnd = end
+				rdf = WireRdf(kind, packet[pos:rdfEnd])
+
+			if rdfEnd > end:
+				raise WireFormatError("%s RDF runs out of rdata" % self.get_type_str())
+			rdfs.append(rdf)
+			pos = rdfEnd
+
+		return rdfs
+
+	#named accessors of ldns_rr used by parsers
+	def a_address(self):
+		return self.rdf(0)
+
+	def ns_nsdname(self):
+		return self.rdf(0)
+
+	def mx_preference(self):
+		return self.rdf(0)
+
+	def mx_exchange(self):
+		return self.rdf(1)
+
+	def rrsig_typecovered(self):
+		return self.rdf(0)
+
+	def rrsig_algorithm(self):
+		return self.rdf(1)
+
+	def rrsig_labels(self):
+		return self.rdf(2)
+
+	def rrsig_origttl(self):
+		return self.rdf(3)
+
+	def rrsig_expiration(self):
+		return self.rdf(4)
+
+	def rrsig_inception(self):
+		return self.rdf(5)
+
+	def rrsig_keytag(self):
+		return self.rdf(6)
+
+	def rrsig_signame(self):
+		return self.rdf(7)
+
+	def rrsig_sig(self):
+		return self.rdf(8)
+
+	def __str__(self):
+		try:
+			rdata = " ".join([str(rdf) for rdf in self.rdfs()])
+		except WireFormatError:
+			rdata = "\\# %d %s" % (self.rdataEnd - self.rdataStart,
+				hexlify(self.packet[self.rdataStart:self.rdataEnd]))
+		return "%s\t%d\tIN\t%s\t%s" % (self.owner(), self.ttlValue, self.get_type_str(), rdata)
+
+
+class WireRRList(object):
+	"""List of RRs with ldns_rr_list-like access."""
+
+	__slots__ = ("rrs",)
+
+	def __init__(self, rrs):
+		self.rrs = rrs
+
+	def rr_count(self):
+		return len(self.rrs)
+
+	def rr(self, index):
+		return self.rrs[index]
+
+
+class WirePacket(object):
+	"""DNS response parsed in one pass over the wire format. Answer and
+	authority sections are indexed by RR type, additional section is not
+	parsed since the scraper doesn't use it.
+	"""
+
+	def __init__(self, packet):
+		"""@param packet: packet in wire format as string (ub_result.packet)
+		@throws WireFormatError: on malformed packet
+		"""
+		self.packet = packet
+		self.sections = {SECTION_ANSWER: {}, SECTION_AUTHORITY: {}}
+		self.counts = {}
+
+		if len(packet) < headerStruct.size:
+			raise WireFormatError("Packet shorter than header")
+		(self.id, self.flags, qdcount, ancount, nscount, arcount) = \
+			headerStruct.unpack_from(packet, 0)
+
+		pos = headerStruct.size
+		for i in xrange(qdcount):
+			pos = readName(packet, pos)[1] + 4
+
+		for (section, count) in ((SECTION_ANSWER, ancount), (SECTION_AUTHORITY, nscount)):
+			byType = self.sections[section]
+			for i in xrange(count):
+				(labels, pos) = readName(packet, pos)
+				if pos + rrHeaderStruct.size > len(packet):
+					raise WireFormatError("Truncated RR header")
+				(rrType, rrClass, ttl, rdlength) = rrHeaderStruct.unpack_from(packet, pos)
+				pos += rrHeaderStruct.size
+				if pos + rdlength > len(packet):
+					raise WireFormatError("Rdata runs out of packet")
+
+				rr = WireRR(packet, labels, rrType, rrClass, ttl, pos, pos + rdlength)
+				byType.setdefault(rrType, []).append(rr)
+				pos += rdlength
+			self.counts[section] = count
+
+	def rr_list_by_type(self, rrType, section):
+		"""Returns WireRRList of RRs of given type in section, None if
+		there are none (same as ldns_pkt.rr_list_by_type()).
+		"""
+		rrs = self.sections.get(section, {}).get(rrType)
+		return rrs and WireRRList(rrs) or None
+
+	def rrTypes(self, section):
+		"""Returns RR types present in section."""
+		return self.sections.get(section, {}).keys()
+
+	def ancount(self):
+		return self.counts[SECTION_ANSWER]
+
+	def nscount(self):
+		return self.counts[SECTION_AUTHORITY]
+
+
+def fileDigest(filename):
+	"""Returns SHA1 of file content in hex."""
+	with open(filename, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def parserDigest():
+	"""Returns SHA1 of this module's source."""
+	return fileDigest(os.path.splitext(os.path.abspath(__file__))[0] + ".py")
+
+def stampVerified(corpusFilename=DEFAULT_CORPUS):
+	"""Record that this parser matched ldns on the corpus."""
+	with open(VERIFIED_STAMP, "w") as stamp:
+		stamp.write("%s %s\n" % (parserDigest(), fileDigest(corpusFilename)))
+
+def isVerified(corpusFilename=DEFAULT_CORPUS):
+	"""Returns True if this parser (unchanged since) matched ldns on the
+	corpus (unchanged since).
+	"""
+	try:
+		with open(VERIFIED_STAMP) as stamp:
+			stamped = stamp.read().split()
+		return stamped == [parserDigest(), fileDigest(corpusFilename)]
+	except IOError:
+		return False
+
+def ldnsRrTypes(reference, section):
+	"""Returns RR types present in section of ldns_pkt."""
+	if section == SECTION_ANSWER:
+		rrList = reference.answer()
+	else:
+		rrList = reference.authority()
+	return [rrList.rr(i).get_type() for i in range(rrList.rr_count())]
+
+def comparePackets(reference, pkt, rdfData):
+	"""Differential check of WirePacket against ldns_pkt parsed from the
+	same data. RRs of answer and authority sections are grouped by RR types
+	found in either packet and compared by owner, TTL, RDF count, RDF data
+	and presentation format of RDFs whose str() is used by parsers.
+
+	@param reference: ldns_pkt
+	@param pkt: WirePacket
+	@param rdfData: function returning canonical RDF bytes for both ldns_rdf
+	and WireRdf (dns_scraper.getRdfData)
+	@returns: list of differences as strings, empty if packets match
+	"""
+	diffs = []
+	if reference.ancount() != pkt.ancount() or reference.nscount() != pkt.nscount():
+		diffs.append("section counts %d/%d != %d/%d" % (reference.ancount(), reference.nscount(),
+			pkt.ancount(), pkt.nscount()))
+
+	for section in (SECTION_ANSWER, SECTION_AUTHORITY):
+		rrTypes = set(pkt.rrTypes(section)) | set(ldnsRrTypes(reference, section))
+		for rrType in sorted(rrTypes):
+			refRrs = reference.rr_list_by_type(rrType, section)
+			rrs = pkt.rr_list_by_type(rrType, section)
+			refCount = refRrs and refRrs.rr_count() or 0
+			count = rrs and rrs.rr_count() or 0
+			if refCount != count:
+				diffs.append("section %d type %d: %d != %d RRs" % (section, rrType, refCount, count))
+				continue
+
+			for i in range(refCount):
+				refRr = refRrs.rr(i)
+				rr = rrs.rr(i)
+				where = "section %d type %d RR %d" % (section, rrType, i)
+
+				if str(refRr.owner()) != str(rr.owner()):
+					diffs.append("%s: owner %s != %s" % (where, refRr.owner(), rr.owner()))
+				if refRr.ttl() != rr.ttl():
+					diffs.append("%s: TTL %d != %d" % (where, refRr.ttl(), rr.ttl()))
+				if refRr.rd_count() != rr.rd_count():
+					diffs.append("%s: %d != %d RDFs" % (where, refRr.rd_count(), rr.rd_count()))
+					continue
+
+				for j in range(rr.rd_count()):
+					refRdf = refRr.rdf(j)
+					rdf = rr.rdf(j)
+					if rdfData(refRdf) != rdfData(rdf):
+						diffs.append("%s RDF %d: data %s != %s" % (where, j,
+							hexlify(rdfData(refRdf)), hexlify(rdfData(rdf))))
+					elif rdf.kind in TEXT_RDF_KINDS and str(refRdf).rstrip(" ") != str(rdf):
+						#ldns appends space after some RDFs, e.g. NSEC3 salt
+						diffs.append("%s RDF %d: %s != %s" % (where, j, refRdf, rdf))
+
+	return diffs